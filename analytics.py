@@ -0,0 +1,252 @@
+# Sales aggregates per buyer, seller, token and day in one grouped pass over the events data
+# count, min / max / mean / median price and volume in ETH and USD for every key, not only the top 10
+#   buyers = sales_stats(save_location, 'buyer', as_frame=True).sort_values('count', ascending=False)
+# Closed days are folded into a small per group state under <save_location>/analytics/ so a nightly run only
+# reads the day files that are new or were rewritten since
+from datetime import date
+import json
+import os
+import shutil
+
+import numpy as np
+
+from event_store import day_folder
+from helpers import batch_result
+from load import event_file_days, iter_events
+from windows import utc_now
+
+# group name -> (key column, username column)
+GROUPS = {'buyer': ('buyer_address', 'buyer_username'),
+          'seller': ('seller_address', 'seller_username'),
+          'token': ('token_id', None),
+          'day': ('day', None)}
+SALE_COLUMNS = ['timestamp', 'token_id', 'total_price', 'usd_price', 'buyer_address', 'buyer_username',
+                'seller_address', 'seller_username']
+STATE_FIELDS = ['key', 'count', 'volume_eth', 'volume_usd', 'min_price', 'max_price', 'username', 'indptr',
+                'prices', 'prices_usd']
+
+
+def sale_rows(columns):
+    '''
+    Sales of a {column: array} day as rows to aggregate: prices in ETH (total_price / 10**18, as in the notebook)
+    and in USD (ETH price * usd_price of the payment token), sales without a price are dropped
+    '''
+    prices = columns['total_price'] / 10. ** 18
+    keep = ~np.isnan(prices)
+    rows = {name: columns[name][keep] for name in columns if name not in ('total_price', 'usd_price')}
+    rows['price'] = prices[keep]
+    rows['price_usd'] = np.nan_to_num(prices[keep] * columns['usd_price'][keep])
+    rows['day'] = columns['timestamp'][keep].astype('datetime64[D]')
+    return rows
+
+
+def aggregate(keys, prices, prices_usd, usernames=None):
+    '''
+    Group state of one set of rows: one entry per key sorted by key, the prices of each key sorted in
+    prices[indptr[i]:indptr[i + 1]] so medians (and later merges) need no Python loop
+    usernames keeps the last non-empty username of every key
+    '''
+    key, inverse = np.unique(keys, return_inverse=True)
+    order = np.lexsort((prices, inverse))
+    count = np.bincount(inverse, minlength=len(key))
+    indptr = np.concatenate([[0], np.cumsum(count)])
+    sorted_prices = prices[order]
+    state = {'key': key,
+             'count': count,
+             'volume_eth': np.bincount(inverse, weights=prices, minlength=len(key)),
+             'volume_usd': np.bincount(inverse, weights=prices_usd, minlength=len(key)),
+             'min_price': sorted_prices[indptr[:-1]] if len(key) else sorted_prices,
+             'max_price': sorted_prices[indptr[1:] - 1] if len(key) else sorted_prices,
+             'username': np.full(len(key), '', dtype='U1' if usernames is None else usernames.dtype),
+             'indptr': indptr,
+             'prices': sorted_prices,
+             'prices_usd': prices_usd[order]}
+    if usernames is not None and len(usernames):
+        named = np.flatnonzero(usernames != '')
+        state['username'][inverse[named]] = usernames[named]
+    return state
+
+
+def empty_state():
+    return aggregate(np.array([], dtype='U1'), np.array([]), np.array([]))
+
+
+def merge_states(old, new):
+    '''
+    State of the rows of old and new, a username seen in new replaces the one in old
+    new (e.g. one day) is merged into old with binary searches: the keys and prices of old keep their order and are
+    only copied, so a nightly update costs the size of the new day plus one copy of the history, not a sort of it
+    '''
+    if old is None or not len(old['key']):
+        return new
+    if not len(new['key']):
+        return old
+    # merged keys: the keys old does not have yet inserted in order, keys and usernames may need wider strings
+    at = np.searchsorted(old['key'], new['key'])
+    known = at < len(old['key'])
+    known[known] = old['key'][at[known]] == new['key'][known]
+    added = new['key'][~known]
+    key = np.insert(old['key'].astype(np.result_type(old['key'], new['key'])), at[~known], added)
+    old_rows = np.arange(len(old['key'])) + np.searchsorted(added, old['key'])
+    new_rows = np.searchsorted(key, new['key'])
+
+    count = np.zeros(len(key), dtype=old['count'].dtype)
+    count[old_rows] = old['count']
+    count[new_rows] += new['count']
+    state = {'key': key, 'count': count, 'indptr': np.concatenate([[0], np.cumsum(count)])}
+    for name in ['volume_eth', 'volume_usd']:
+        state[name] = np.zeros(len(key))
+        state[name][old_rows] = old[name]
+        state[name][new_rows] += new[name]
+    state['min_price'] = np.full(len(key), np.inf)
+    state['min_price'][old_rows] = old['min_price']
+    state['min_price'][new_rows] = np.minimum(state['min_price'][new_rows], new['min_price'])
+    state['max_price'] = np.full(len(key), -np.inf)
+    state['max_price'][old_rows] = old['max_price']
+    state['max_price'][new_rows] = np.maximum(state['max_price'][new_rows], new['max_price'])
+    state['username'] = np.full(len(key), '', dtype=np.result_type(old['username'], new['username']))
+    state['username'][old_rows] = old['username']
+    named = new['username'] != ''
+    state['username'][new_rows[named]] = new['username'][named]
+
+    # every price is sorted by (merged key row, price), a new price goes after the equal ones of old
+    sort_key = np.dtype([('row', 'int64'), ('price', 'float64')])
+    old_sorted = np.empty(len(old['prices']), dtype=sort_key)
+    old_sorted['row'] = np.repeat(old_rows, old['count'])
+    old_sorted['price'] = old['prices']
+    new_sorted = np.empty(len(new['prices']), dtype=sort_key)
+    new_sorted['row'] = np.repeat(new_rows, new['count'])
+    new_sorted['price'] = new['prices']
+    position = np.searchsorted(old_sorted, new_sorted, side='right')
+    state['prices'] = np.insert(old['prices'], position, new['prices'])
+    state['prices_usd'] = np.insert(old['prices_usd'], position, new['prices_usd'])
+    return state
+
+
+def state_stats(state, as_frame=False):
+    '''
+    {column: array} of a group state: key, username, count, min/max/mean/median price, volume_eth, volume_usd
+    '''
+    count = state['count']
+    indptr = state['indptr']
+    if len(count):
+        median = (state['prices'][indptr[:-1] + (count - 1) // 2] + state['prices'][indptr[:-1] + count // 2]) / 2
+    else:
+        median = np.array([], dtype='float64')
+    columns = {'key': state['key'],
+               'username': state['username'],
+               'count': count,
+               'min_price': state['min_price'],
+               'max_price': state['max_price'],
+               'mean_price': np.divide(state['volume_eth'], count, out=np.zeros(len(count)), where=count > 0),
+               'median_price': median,
+               'volume_eth': state['volume_eth'],
+               'volume_usd': state['volume_usd']}
+    return batch_result(columns, as_frame)
+
+
+def group_states(parts):
+    '''
+    One state per group of GROUPS for a list of sale_rows dicts
+    '''
+    rows = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    return {group: aggregate(rows[key], rows['price'], rows['price_usd'],
+                             rows[username] if username is not None else None)
+            for group, (key, username) in GROUPS.items()}
+
+
+def analytics_folder(save_location):
+    return os.path.join(save_location, 'analytics')
+
+
+def day_fingerprint(save_location, day, kind):
+    # modification time of the day file, changes whenever the day is saved again
+    if kind == 'columnar':
+        path = os.path.join(day_folder(save_location, day), 'id.npy')
+    else:
+        path = str(save_location) + 'assets_events_list_' + str(day) + '.npz'
+    return os.stat(path).st_mtime_ns
+
+
+def load_states(save_location):
+    '''
+    (states, folded days) persisted by update_sales_stats, ({}, {}) when there are none
+    '''
+    folder = analytics_folder(save_location)
+    try:
+        with open(os.path.join(folder, 'days.json')) as f:
+            days = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    states = {}
+    for group in GROUPS:
+        with np.load(os.path.join(folder, group + '.npz'), allow_pickle=False) as data:
+            states[group] = {name: data[name] for name in STATE_FIELDS}
+    return states, days
+
+
+def save_states(save_location, states, days):
+    # written to a tmp folder swapped in one step, like write_event_day, so states and days.json always match
+    folder = analytics_folder(save_location)
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for group, state in states.items():
+        np.savez(os.path.join(tmp_folder, group + '.npz'), **state)
+    with open(os.path.join(tmp_folder, 'days.json'), 'w') as f:
+        json.dump(days, f)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+
+def read_sales(save_location, days):
+    parts = []
+    for day in days:
+        for _, columns in iter_events(save_location, day, day, event_types=['successful'], columns=SALE_COLUMNS):
+            parts.append(sale_rows(columns))
+    return parts
+
+
+def update_sales_stats(save_location, rebuild=False):
+    '''
+    Fold every closed day (before today in UTC) not folded yet into the persisted group states and return them
+    A folded day whose file changed since (e.g. downloaded again) makes the states be rebuilt from scratch,
+    since a min / max cannot be taken back out
+    '''
+    file_days = event_file_days(save_location)
+    closed = {str(day): day_fingerprint(save_location, day, kind)
+              for day, kind in file_days.items() if day < utc_now().date()}
+    states, days = ({}, {}) if rebuild else load_states(save_location)
+    if any(closed.get(day) != fingerprint for day, fingerprint in days.items()):
+        print('event files changed since the last update, rebuilding the sales stats')
+        states, days = {}, {}
+    new_days = sorted(day for day in closed if day not in days)
+    parts = read_sales(save_location, [date.fromisoformat(day) for day in new_days])
+    if parts:
+        new_states = group_states(parts)
+        states = {group: merge_states(states.get(group), new_states[group]) for group in GROUPS}
+    if new_days:
+        # days without sales are recorded too, so they are not read again on every call
+        states = {group: states.get(group) or empty_state() for group in GROUPS}
+        days.update({day: closed[day] for day in new_days})
+        save_states(save_location, states, days)
+    return states
+
+
+def sales_stats(save_location, by='buyer', as_frame=False, update=True):
+    '''
+    Per key sales stats of a collection for by in 'buyer', 'seller', 'token', 'day'
+    The persisted states (brought up to date first when update is set) are combined with today's sales,
+    which are read fresh every call as the day is still being downloaded
+    '''
+    states = update_sales_stats(save_location) if update else load_states(save_location)[0]
+    state = states.get(by)
+    today = [day for day in event_file_days(save_location) if day >= utc_now().date()]
+    parts = read_sales(save_location, today)
+    if parts:
+        state = merge_states(state, group_states(parts)[by])
+    if state is None:
+        state = empty_state()
+    return state_stats(state, as_frame)
@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta, datetime
+from functools import partial
+import asyncio
+import os
+import time
+import requests
+
+from checkpoint import Checkpoint
+from client import RetryPolicy, RetryingSession, retry_after_seconds
+from event_index import EventIndex
+from event_store import save_event_day
+from metrics import NullMetrics
+from windows import AdaptiveWindow, FixedWindow, utc_now
+
+EVENT_TYPES = ['created', 'successful', 'cancelled', 'bid_entered', 'bid_withdrawn']
+
+
+class TokenBucket:
+    '''
+    Requests-per-second limiter shared by every worker of a crawl
+    rate = tokens added per second, capacity = largest burst allowed
+    pause() empties the bucket for a while, used when the API answers 429
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+def day_windows(day, hour_chunks=24):
+    '''
+    Split a day into (after, before) windows of hour_chunks hours, today (UTC) ends at the current time
+    '''
+    after = datetime.combine(day, datetime.min.time())
+    if day == utc_now().date():
+        day_end = utc_now()
+    else:
+        day_end = after + timedelta(days=1)
+    windows = []
+    chunk = 0
+    while after + timedelta(hours=hour_chunks * chunk) < day_end:
+        changed_after = after + timedelta(hours=hour_chunks * chunk)
+        changed_before = min(after + timedelta(hours=hour_chunks * (chunk + 1)), day_end)
+        windows.append((changed_after, changed_before))
+        chunk += 1
+    return windows
+
+
+async def download_event_info_async(save_location, contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
+                                    start_date=date(2021, 7, 30), end_date=utc_now().date(), event_type='all',
+                                    hour_chunks=24, requests_per_second=2, concurrency=8, page_size=300,
+                                    max_offset=10000, max_retries=5, url="https://api.opensea.io/api/v1/events",
+                                    api_key=None, resume=True, storage='npz', session=None, bucket=None,
+                                    metrics=None, retry=None):
+    '''
+    Concurrent version of download.download_event_info writing the same assets_events_list_<date>.npz files
+    Every (day, chunk, event_type, offset) page is a work unit handed to a pool of concurrency workers
+    A full page queues the next offset of its window, an empty or short page ends that window
+    hour_chunks='adaptive' starts every (day, event_type) as one window and bisects it when it reaches max_offset,
+    see windows.AdaptiveWindow, so quiet days cost one request per type and busy days are not truncated
+    All workers share one pooled requests.Session and one token bucket of requests_per_second
+    429 responses pause the bucket for Retry-After seconds and the unit is retried up to max_retries times
+    url can point at a local simulator.start_server for offline runs
+    resume shares the save_location checkpoint with download.download_event_info: complete days are skipped
+    and unfinished units restart at their last offset
+    storage = 'npz' or 'columnar' as in download.download_event_info
+    bucket replaces the crawl's own TokenBucket, to share one rate limit between several downloads (see crawler.py)
+    session can be a prepared requests.Session (e.g. cache.CachedSession), it is given a pool of concurrency
+    connections and left open
+    metrics (a metrics.Metrics) records every request, the time spent waiting for the rate limit and writing
+    retry (a client.RetryPolicy) sets the timeouts, and retries server errors and dropped connections with backoff
+    in the worker threads, 429s are left to the bucket above
+    '''
+    metrics = metrics or NullMetrics()
+    if not os.path.isdir(save_location):
+        os.makedirs(save_location)
+    event_types = EVENT_TYPES if event_type == 'all' else [event_type]
+    headers = {"Accept": "application/json"}
+    if api_key:
+        headers["X-API-KEY"] = api_key
+
+    bucket = bucket or TokenBucket(requests_per_second)
+    queue = asyncio.Queue()
+    # per day: finished window events keyed by (chunk, event type index) and number of units still pending
+    pages = {}
+    pending = {}
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    checkpoint = Checkpoint(save_location)
+    index = EventIndex(save_location)
+    for day in days:
+        if resume and checkpoint.day_complete(contract, day, save_location):
+            continue
+        pages[day] = {}
+        pending[day] = 0
+        if hour_chunks == 'adaptive':
+            day_start, day_end = day_windows(day, 24)[0]
+            chunks = [('adaptive', day_start, day_end)]
+        else:
+            chunks = [(after.strftime('%H:%M'), after, before) for after, before in day_windows(day, hour_chunks)]
+        for chunk, after, before in chunks:
+            for type_index, e_type in enumerate(event_types):
+                unit = {'offset': 0, 'complete': False}
+                if resume and day < utc_now().date():
+                    unit = checkpoint.unit(contract, day, chunk, e_type)
+                checkpoint.update_unit(contract, day, chunk, e_type, unit['offset'], unit['complete'])
+                if unit['complete']:
+                    continue
+                if chunk == 'adaptive':
+                    window = AdaptiveWindow(after, before, page_size=page_size, max_offset=max_offset)
+                else:
+                    window = FixedWindow(after, before, page_size=page_size, max_offset=max_offset,
+                                         offset=unit['offset'])
+                queue.put_nowait((day, chunk, type_index, e_type, window, 0))
+                pending[day] += 1
+        if pending[day] == 0:
+            # every unit finished in an earlier run, only the day flag was missing
+            with metrics.stage('write', day=str(day)):
+                path, event_count = save_day(save_location, day, pages.pop(day), merge=True, storage=storage,
+                                             index=index)
+            checkpoint.finish_day(contract, day, event_count, closed=day < utc_now().date())
+
+    own_session = session is None
+    session = session or requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    retry = retry or RetryPolicy()
+    http = RetryingSession(metrics.wrap(session), retry, metrics,
+                           retry_statuses=[status for status in retry.retry_statuses if status != 429])
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop = asyncio.get_running_loop()
+    saved = []
+    # day files are written one at a time off the event loop, the checkpoint and index are not thread safe
+    write_lock = asyncio.Lock()
+    errors = []
+
+    finished = set()
+
+    async def finish_unit(day, chunk, type_index, e_type, window, complete):
+        # adaptive windows cannot resume mid-way, a failed one is fetched again from the start
+        finished.add((day, chunk, type_index))
+        offset = window.offset if chunk != 'adaptive' else 0
+        checkpoint.update_unit(contract, day, chunk, e_type, offset, complete)
+        pages[day][(chunk, type_index)] = window.result()
+        pending[day] -= 1
+        if pending[day] == 0:
+            day_pages = pages.pop(day)
+            async with write_lock:
+                try:
+                    with metrics.stage('write', day=str(day)):
+                        path, event_count = await loop.run_in_executor(
+                            None, partial(save_day, save_location, day, day_pages, merge=resume, storage=storage,
+                                          index=index))
+                except Exception:
+                    # nothing of the day reached the disk, every unit is fetched again by the next run
+                    for unit in checkpoint.day_entry(contract, day)['units'].values():
+                        unit.update(offset=0, complete=False)
+                    checkpoint.save()
+                    raise
+                saved.append(path)
+                checkpoint.finish_day(contract, day, event_count, closed=day < utc_now().date())
+
+    async def fetch_unit(day, chunk, type_index, e_type, window, attempt):
+        after, before, offset = window.next_request()
+        with metrics.stage('wait'):
+            await bucket.acquire()
+        querystring = {"asset_contract_address": contract,
+                       "event_type": e_type,
+                       "only_opensea": "false",
+                       "offset": offset,
+                       "occurred_before": before,
+                       "occurred_after": after,
+                       "limit": page_size}
+        try:
+            response = await loop.run_in_executor(
+                executor, partial(http.get, url, headers=headers, params=querystring))
+        except requests.RequestException as error:
+            response = None
+            print('error', e_type, after, offset, error)
+
+        asset_events = None
+        if response is not None and response.status_code == 429 and attempt < max_retries:
+            bucket.pause(retry_after_seconds(response))
+            queue.put_nowait((day, chunk, type_index, e_type, window, attempt + 1))
+        elif response is None or response.status_code != 200:
+            if response is not None:
+                print('error', response.status_code, e_type, after, offset)
+        else:
+            try:
+                asset_events = response.json()['asset_events']
+            except (ValueError, KeyError):
+                print('error', 'bad response body', e_type, after, offset)
+
+        if asset_events is not None:
+            window.feed(asset_events)
+            if window.done:
+                await finish_unit(day, chunk, type_index, e_type, window, True)
+            else:
+                queue.put_nowait((day, chunk, type_index, e_type, window, 0))
+        elif response is None or response.status_code != 429 or attempt >= max_retries:
+            await finish_unit(day, chunk, type_index, e_type, window, False)
+
+    async def worker():
+        while True:
+            unit = await queue.get()
+            day, chunk, type_index, e_type, window, attempt = unit
+            try:
+                await fetch_unit(*unit)
+            except Exception as error:
+                # anything else (an odd payload, a failed write) leaves the unit unfinished for the next run,
+                # the worker carries on so queue.join() still returns and the error is raised after it
+                print('error', e_type, day, chunk, repr(error))
+                errors.append(error)
+                if (day, chunk, type_index) not in finished:
+                    try:
+                        await finish_unit(day, chunk, type_index, e_type, window, False)
+                    except Exception as write_error:
+                        errors.append(write_error)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        executor.shutdown(wait=False)
+        if own_session:
+            session.close()
+    if errors:
+        raise RuntimeError(str(len(errors)) + ' work units failed, they are left unfinished in the checkpoint') \
+            from errors[0]
+    return [path for path in saved if path]
+
+
+def save_day(save_location, day, day_pages, merge=True, storage='npz', index=None):
+    '''
+    Write one day's windows in chunk, event type order, see event_store.save_event_day
+    '''
+    events_that_day = [event for key in sorted(day_pages) for event in day_pages[key]]
+    return save_event_day(save_location, day, events_that_day, storage=storage, merge=merge, index=index)
+
+
+def download_event_info_concurrent(save_location, **kwargs):
+    '''
+    Blocking wrapper around download_event_info_async for scripts and notebooks without a running loop
+    Returns the list of day files written
+    '''
+    return asyncio.run(download_event_info_async(save_location, **kwargs))
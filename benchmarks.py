@@ -0,0 +1,307 @@
+# Micro-benchmarks, results are printed as JSON so runs can be compared between versions
+#   python benchmarks.py parsers 1000000
+#   python benchmarks.py download_assets 10000 0.005     (10k tokens, 5 ms simulated latency)
+#   python benchmarks.py download_assets 20000 0 1000 7  (20k tokens with ids 1000, 1007, ...)
+#   python benchmarks.py suite 1000 10000 100000         (every benchmark for each collection size)
+#   python benchmarks.py parallel_load 10000 28 4 4      (28 .npz days parsed by 1, 2 and 4 processes)
+#   python benchmarks.py startup 5                       (interpreter start + imports of every cli.py subcommand)
+# Downloads run against a local simulator.FakeOpenSea, nothing touches the live API
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from async_download import download_event_info_concurrent
+from download import download_asset_info, download_event_info
+from event_store import save_event_day
+from helpers import parse_assets_data, parse_assets_batch, parse_events_data, parse_events_batch
+from load import load_assets_info, load_events_info, load_events_columns, query_events, query_events_parallel
+from load import pool_workers
+from simulator import FakeOpenSea, make_assets, make_events, start_server
+from windows import event_time
+
+CONTRACT = "0x0000000000000000000000000000000000000000"
+START = datetime(2021, 8, 1)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def quiet_timed(function, *args, **kwargs):
+    # the downloaders print progress, keep it out of the JSON output
+    with redirect_stdout(io.StringIO()):
+        return timed(function, *args, **kwargs)
+
+
+def collection_events(tokens, days=7, events_per_token=2, event_types=None, seed=0):
+    '''
+    Synthetic events of a collection of tokens spread over days, events_per_token events per token in total
+    '''
+    kwargs = {'event_types': event_types} if event_types else {}
+    return make_events(START, days=days, events_per_day=max(1, tokens * events_per_token // days), num_tokens=tokens,
+                       contract=CONTRACT, seed=seed, **kwargs)
+
+
+def object_column(values):
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def record_columns(records):
+    # what a downloader needs from the per-record parsers: the dicts turned into one array per field
+    return {name: object_column([record[name] for record in records]) for name in records[0]} if records else {}
+
+
+def bench_parsers(n=1000000, seed=0):
+    '''
+    Per-record parse_events_data (+ turning the dicts into columns, + pd.DataFrame(list_of_dicts) when pandas is
+    installed) against parse_events_batch on a synthetic fixture of n sales, the only event type the per-record
+    parser accepts
+    speedup compares parsing alone, columns_speedup what the downloaders need: typed columns
+    '''
+    events = make_events(datetime(2021, 8, 1), events_per_day=n, event_types=['successful'], seed=seed)
+    results = {'benchmark': 'parsers', 'events': n}
+
+    seconds, records = timed(lambda: [parse_events_data(event) for event in events])
+    results['per_record_seconds'] = seconds
+    seconds, _ = timed(record_columns, records)
+    results['per_record_columns_seconds'] = results['per_record_seconds'] + seconds
+    seconds, columns = timed(parse_events_batch, events)
+    results['batch_seconds'] = seconds
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+    if pd is not None:
+        seconds, frame = timed(pd.DataFrame, records)
+        results['per_record_frame_seconds'] = results['per_record_seconds'] + seconds
+        seconds, frame = timed(pd.DataFrame, columns)
+        results['batch_frame_seconds'] = results['batch_seconds'] + seconds
+    results['speedup'] = results['per_record_seconds'] / results['batch_seconds']
+    results['columns_speedup'] = results['per_record_columns_seconds'] / results['batch_seconds']
+    return results
+
+
+def bench_asset_parsers(tokens=10000, seed=0):
+    '''
+    parse_assets_data per asset (alone and + turning the dicts into columns) against parse_assets_batch on a
+    synthetic collection
+    '''
+    assets = make_assets(tokens, contract=CONTRACT, seed=seed)
+    results = {'benchmark': 'asset_parsers', 'tokens': tokens}
+    results['per_record_seconds'], records = timed(lambda: [parse_assets_data(asset) for asset in assets])
+    seconds, _ = timed(record_columns, records)
+    results['per_record_columns_seconds'] = results['per_record_seconds'] + seconds
+    results['batch_seconds'], columns = timed(parse_assets_batch, assets)
+    results['speedup'] = results['per_record_seconds'] / results['batch_seconds']
+    results['columns_speedup'] = results['per_record_columns_seconds'] / results['batch_seconds']
+    return results
+
+
+def bench_download_assets(tokens=1000, latency=0, first_id=0, spacing=1, seed=0):
+    '''
+    download_asset_info of a whole synthetic collection from a local simulator, token ids first_id,
+    first_id + spacing, ... guessed 30 at a time from 0 (pagination='blocks') against listed and
+    gap-filled (pagination='discover')
+    '''
+    token_ids = range(first_id, first_id + tokens * spacing, spacing)
+    api = FakeOpenSea(assets=make_assets(tokens, contract=CONTRACT, seed=seed, token_ids=token_ids), latency=latency)
+    server, base_url = start_server(api)
+    results = {'benchmark': 'download_assets', 'tokens': tokens, 'latency': latency, 'first_id': first_id,
+               'spacing': spacing}
+    try:
+        for mode in ['blocks', 'discover']:
+            folder = tempfile.mkdtemp() + '/'
+            before = api.request_count
+            try:
+                seconds, _ = quiet_timed(download_asset_info, folder, asset_name='bench', contract=CONTRACT,
+                                         limit=token_ids[-1] // 30 + 2, request_buffer=0, resume=False,
+                                         url=base_url + '/api/v1/assets', pagination=mode)
+                saved = len(load_assets_info(folder, 'bench'))
+            finally:
+                shutil.rmtree(folder)
+            results[mode] = {'seconds': seconds, 'requests': api.request_count - before, 'assets': saved,
+                             'lost': tokens - saved, 'assets_per_second': saved / seconds}
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_download_events(tokens=1000, days=7, events_per_token=2, latency=0, seed=0):
+    '''
+    Sales of a synthetic collection downloaded from a local simulator with download_event_info (fixed 24 hour
+    windows and hour_chunks='adaptive') and download_event_info_concurrent
+    lost counts the generated events missing from the saved files (windows past the offset ceiling)
+    '''
+    events = collection_events(tokens, days, events_per_token, event_types=['successful'], seed=seed)
+    api = FakeOpenSea(events, latency=latency)
+    server, base_url = start_server(api)
+    url = base_url + '/api/v1/events'
+    end_date = START.date() + timedelta(days=days - 1)
+    common = {'contract': CONTRACT, 'start_date': START.date(), 'end_date': end_date, 'event_type': 'successful',
+              'resume': False, 'storage': 'columnar', 'url': url}
+    modes = {'fixed': lambda folder: download_event_info(folder, hour_chunks=24, request_buffer=0, **common),
+             'adaptive': lambda folder: download_event_info(folder, hour_chunks='adaptive', request_buffer=0,
+                                                            **common),
+             'async': lambda folder: download_event_info_concurrent(folder, hour_chunks='adaptive',
+                                                                    requests_per_second=1000, **common)}
+    results = {'benchmark': 'download_events', 'tokens': tokens, 'events': len(events), 'days': days,
+               'latency': latency}
+    try:
+        for mode, download in modes.items():
+            folder = tempfile.mkdtemp() + '/'
+            before = api.request_count
+            try:
+                seconds, _ = quiet_timed(download, folder)
+                saved = len(load_events_columns(folder, ['id'])['id'])
+            finally:
+                shutil.rmtree(folder)
+            results[mode] = {'seconds': seconds, 'requests': api.request_count - before, 'saved': saved,
+                             'lost': len(events) - saved, 'events_per_second': saved / seconds}
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_load(tokens=1000, days=7, events_per_token=2, seed=0):
+    '''
+    load_assets_info and load_events_info on the original .npz files against the columnar loaders
+    '''
+    folder = tempfile.mkdtemp() + '/'
+    events = collection_events(tokens, days, events_per_token, seed=seed)
+    by_day = {}
+    for event in events:
+        by_day.setdefault(event_time(event).date(), []).append(event)
+    try:
+        with redirect_stdout(io.StringIO()):
+            np.savez(folder + 'bench_list' + str(date.today()) + '.npz', make_assets(tokens, CONTRACT, seed=seed))
+            for day, day_events in by_day.items():
+                save_event_day(folder, day, day_events, storage='npz', merge=False)
+                save_event_day(folder, day, day_events, storage='columnar', merge=False)
+        results = {'benchmark': 'load', 'tokens': tokens, 'events': len(events), 'days': len(by_day)}
+        results['load_assets_info_seconds'], _ = timed(load_assets_info, folder, 'bench')
+        results['load_events_info_seconds'], _ = timed(load_events_info, folder)
+        results['load_events_columns_seconds'], _ = timed(load_events_columns, folder)
+        results['query_sales_prices_seconds'], _ = timed(query_events, folder, event_types=['successful'],
+                                                         columns=['timestamp', 'total_price'])
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def bench_parallel_load(tokens=10000, days=28, events_per_token=4, workers=None, seed=0):
+    '''
+    query_events over .npz day files (parsed from the pickled events) in one process against process pools of
+    1, 2, 4, ... workers up to workers (default every core), with load_events_info as the original baseline
+    '''
+    folder = tempfile.mkdtemp() + '/'
+    events = collection_events(tokens, days, events_per_token, seed=seed)
+    by_day = {}
+    for event in events:
+        by_day.setdefault(event_time(event).date(), []).append(event)
+    workers = workers or os.cpu_count()
+    try:
+        with redirect_stdout(io.StringIO()):
+            for day, day_events in by_day.items():
+                save_event_day(folder, day, day_events, storage='npz', merge=False)
+        results = {'benchmark': 'parallel_load', 'events': len(events), 'days': len(by_day), 'cpus': os.cpu_count()}
+        results['load_events_info_seconds'], _ = timed(load_events_info, folder)
+        results['query_events_seconds'], serial = timed(query_events, folder)
+        # what query_events(workers=...) runs by default on this machine, fewer than 2 means in process
+        results['pool_workers'] = pool_workers(len(by_day), workers)
+        results['workers'] = {}
+        count = 1
+        while True:
+            seconds, columns = timed(query_events_parallel, folder, workers=count, fallback=False)
+            assert all(np.array_equal(columns[name], serial[name], equal_nan=columns[name].dtype.kind == 'f')
+                       for name in serial)
+            results['workers'][count] = {'seconds': seconds, 'speedup': results['query_events_seconds'] / seconds}
+            if count >= workers:
+                break
+            count = min(count * 2, workers)
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def import_times(stderr):
+    # {top level module: cumulative microseconds} from the output of python -X importtime
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('| imported package'):
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def bench_startup(repeat=5, top=5):
+    '''
+    Wall time of a fresh interpreter importing cli.py and each subcommand's modules (cli.COMMAND_MODULES),
+    best of repeat runs, with the slowest top level imports from -X importtime and whether pandas got loaded
+    '''
+    from cli import COMMAND_MODULES
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    scripts = {'python': 'pass', 'cli': 'import cli'}
+    scripts.update({command: 'import cli; cli.import_command(%r)' % command for command in COMMAND_MODULES})
+    results = {'benchmark': 'startup', 'repeat': repeat, 'commands': {}}
+    for command, script in scripts.items():
+        best, stderr = None, ''
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=folder, capture_output=True,
+                                 text=True, check=True)
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best, stderr = seconds, run.stderr
+        times = import_times(stderr)
+        slowest = sorted(times.items(), key=lambda item: -item[1])[:top]
+        results['commands'][command] = {'seconds': best, 'import_seconds': sum(times.values()) / 10 ** 6,
+                                        'slowest_imports_ms': {name: us / 1000 for name, us in slowest},
+                                        'pandas': 'pandas' in times}
+    return results
+
+
+def bench_suite(*sizes):
+    '''
+    Every benchmark for each collection size in tokens (default 1k, 10k and 100k)
+    '''
+    results = []
+    for tokens in sizes or (1000, 10000, 100000):
+        results.append(bench_parsers(tokens * 2))
+        results.append(bench_asset_parsers(tokens))
+        results.append(bench_download_assets(tokens))
+        results.append(bench_download_events(tokens))
+        results.append(bench_load(tokens))
+    return {'benchmark': 'suite', 'python': platform.python_version(), 'numpy': np.__version__,
+            'results': results}
+
+
+BENCHMARKS = {'parsers': bench_parsers,
+              'asset_parsers': bench_asset_parsers,
+              'download_assets': bench_download_assets,
+              'download_events': bench_download_events,
+              'load': bench_load,
+              'parallel_load': bench_parallel_load,
+              'startup': bench_startup,
+              'suite': bench_suite}
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'parsers'
+    args = [json.loads(arg) for arg in sys.argv[2:]]
+    print(json.dumps(BENCHMARKS[name](*args)))
@@ -0,0 +1,222 @@
+# On-disk cache for OpenSea API responses
+# Keyed by endpoint + canonical query params, with per endpoint TTLs, LRU eviction by size and conditional
+# revalidation (ETag / Last-Modified) of stale entries
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.models import Response
+
+# seconds an entry is fresh, per endpoint (last path segment), None = never expires
+DEFAULT_TTLS = {'events': 300, 'assets': 86400, 'collection': 3600}
+
+
+def canonical_params(params):
+    '''
+    Query params as a sorted list of (key, value) strings, list values sorted so token_ids order does not matter
+    '''
+    items = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ','.join(sorted(str(item) for item in value))
+        items.append((str(key), str(value)))
+    return sorted(items)
+
+
+def cache_key(url, params):
+    text = url.rstrip('/') + '?' + json.dumps(canonical_params(params))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def parse_param_time(value):
+    '''
+    occurred_before / occurred_after as an aware UTC datetime, naive times are UTC like the API's, None if unreadable
+    '''
+    if not isinstance(value, datetime):
+        try:
+            return datetime.fromtimestamp(float(value), timezone.utc)
+        except (TypeError, ValueError, OverflowError, OSError):
+            pass
+        try:
+            value = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def file_size(path):
+    # 0 for an entry that is missing or was just evicted
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+class ResponseCache:
+    '''
+    Stores successful JSON responses under cache_dir, one file per request
+    ttls maps the endpoint name (e.g. 'events', 'assets') to seconds, endpoints not listed use default_ttl
+    /events windows whose occurred_before is older than history_horizon are closed: they never expire
+    and are served without touching the network
+    max_bytes caps the cache size, the least recently used entries are removed first
+    '''
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, ttls=None, default_ttl=3600,
+                 history_horizon=timedelta(days=2)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.history_horizon = history_horizon
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.total_bytes = sum(os.path.getsize(path) for path in self.entry_paths())
+
+    def entry_paths(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith('.json'):
+                    yield os.path.join(root, filename)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def ttl(self, url, params):
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        if endpoint == 'events' and params and params.get('occurred_before') is not None:
+            before = parse_param_time(params['occurred_before'])
+            if before is not None and before < datetime.now(timezone.utc) - self.history_horizon:
+                return None
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, url, params):
+        '''
+        Returns (entry, fresh) or (None, False), entry holds body, headers and stored_at
+        '''
+        path = self.path(cache_key(url, params))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, False
+        # touching the file keeps the LRU order, an entry evicted meanwhile is a miss
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None, False
+        ttl = self.ttl(url, params)
+        fresh = ttl is None or time.time() - entry['stored_at'] < ttl
+        return entry, fresh
+
+    def put(self, url, params, body, headers):
+        key = cache_key(url, params)
+        path = self.path(key)
+        entry = {'url': url,
+                 'params': canonical_params(params),
+                 'stored_at': time.time(),
+                 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'),
+                 'body': body}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old_size = file_size(path)
+        tmp_path = path + '.%d.tmp' % threading.get_ident()
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += os.path.getsize(path) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def touch(self, url, params):
+        # a 304 makes the stored entry fresh again, rewritten like put so readers never see half a file
+        path = self.path(cache_key(url, params))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return
+        entry['stored_at'] = time.time()
+        old_size = file_size(path)
+        tmp_path = path + '.%d.tmp' % threading.get_ident()
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += os.path.getsize(path) - old_size
+
+    def count(self, outcome):
+        # 'hits', 'revalidated' or 'misses', sessions in several threads share the cache
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is back under 90% of max_bytes
+        '''
+        entries = sorted((os.path.getmtime(path), os.path.getsize(path), path) for path in self.entry_paths())
+        for mtime, size, path in entries:
+            if self.total_bytes <= self.max_bytes * .9:
+                break
+            os.remove(path)
+            self.total_bytes -= size
+
+
+def cached_response(url, body, status_code=200):
+    response = Response()
+    response.status_code = status_code
+    response.url = url
+    response._content = json.dumps(body).encode('utf-8')
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+class CachedSession(requests.Session):
+    '''
+    requests.Session that answers GET requests from a ResponseCache
+    Fresh entries are returned without a request, stale ones are revalidated with If-None-Match /
+    If-Modified-Since when the server gave an ETag or Last-Modified, otherwise fetched again
+    Pass it as session= to the download functions
+    '''
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != 'GET':
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+        entry, fresh = self.cache.get(url, params)
+        if entry is not None and fresh:
+            self.cache.count('hits')
+            return cached_response(url, entry['body'])
+
+        headers = dict(headers or {})
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.count('revalidated')
+            self.cache.touch(url, params)
+            return cached_response(url, entry['body'])
+        self.cache.count('misses')
+        if response.status_code == 200:
+            try:
+                body = response.json()
+            except ValueError:
+                return response
+            self.cache.put(url, params, body, response.headers)
+        return response
@@ -0,0 +1,100 @@
+# Persistent crawl manifest so interrupted backfills only fetch what is missing
+# One checkpoint.json per save_location, written atomically after every day / asset block
+import json
+import os
+
+import numpy as np
+
+
+class Checkpoint:
+    '''
+    Records which (contract, day, chunk, event_type) units are complete and the next offset of unfinished ones
+    plus how far download_asset_info got for each contract
+    chunk is the window start as HH:MM so a rerun with a different hour_chunks simply refetches the day
+    '''
+    def __init__(self, save_location, filename='checkpoint.json'):
+        self.path = os.path.join(save_location, filename)
+        self.data = {'events': {}, 'assets': {}}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.data.update(json.load(f))
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    # Events
+    def day_entry(self, contract, day):
+        days = self.data['events'].setdefault(contract.lower(), {})
+        return days.setdefault(str(day), {'complete': False, 'units': {}})
+
+    def day_complete(self, contract, day, save_location):
+        '''
+        A day is skipped only if it is marked complete and its .npz or columnar folder is still on disk
+        (or it had no events)
+        '''
+        entry = self.data['events'].get(contract.lower(), {}).get(str(day))
+        if not entry or not entry['complete']:
+            return False
+        return (entry.get('events') == 0 or os.path.isfile(event_file(save_location, day)) or
+                os.path.isdir(os.path.join(save_location, 'events', str(day))))
+
+    def unit(self, contract, day, chunk, event_type):
+        '''
+        Returns {'offset': next offset to request, 'complete': bool}
+        '''
+        units = self.day_entry(contract, day)['units']
+        return units.get(chunk + '|' + event_type, {'offset': 0, 'complete': False})
+
+    def update_unit(self, contract, day, chunk, event_type, offset, complete):
+        units = self.day_entry(contract, day)['units']
+        units[chunk + '|' + event_type] = {'offset': offset, 'complete': complete}
+
+    def finish_day(self, contract, day, event_count, closed=True):
+        '''
+        Mark the day complete when every unit finished and the day is over (closed), then persist
+        '''
+        entry = self.day_entry(contract, day)
+        entry['events'] = event_count
+        entry['complete'] = closed and all(unit['complete'] for unit in entry['units'].values())
+        self.save()
+        return entry['complete']
+
+    # Assets
+    def asset_progress(self, contract):
+        return self.data['assets'].get(contract.lower(), {'next_block': 0, 'complete': False, 'file': None})
+
+    def update_assets(self, contract, next_block, complete, file=None):
+        self.data['assets'][contract.lower()] = {'next_block': next_block, 'complete': complete, 'file': file}
+        self.save()
+
+
+def event_file(save_location, day):
+    return save_location + "assets_events_list_" + str(day) + '.npz'
+
+
+def event_key(event):
+    # the API id is unique per event, fall back to the transaction for old dumps without it
+    if event.get('id') is not None:
+        return event['id']
+    return (event.get('event_type'), (event.get('transaction') or {}).get('transaction_hash'),
+            event.get('created_date'))
+
+
+def merge_day_file(save_location, day, new_events):
+    '''
+    Combine newly fetched events with what a previous partial run left in the day file, dropping repeats
+    '''
+    path = event_file(save_location, day)
+    if not os.path.isfile(path):
+        return list(new_events)
+    events = list(np.load(path, allow_pickle=True)['arr_0'])
+    seen = {event_key(event) for event in events}
+    for event in new_events:
+        key = event_key(event)
+        if key not in seen:
+            seen.add(key)
+            events.append(event)
+    return events
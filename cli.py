@@ -0,0 +1,278 @@
+# Command line entry points for cron jobs and quick checks, no notebook kernel needed
+#   python cli.py download assets static/animeta/ --name animeta --contract 0x18df...
+#   python cli.py download events static/animeta/ --contract 0x18df... --since-days 2 --storage columnar
+#   python cli.py load stats static/animeta/ --since-days 1          (what is new since yesterday)
+#   python cli.py export static/animeta/ sales.csv --event-types successful --columns timestamp,token_id,total_price
+#   python cli.py tail static --interval 10                          (poll new events until Ctrl-C, see tail.py)
+# Only argparse and the standard library are imported up front, a subcommand imports the modules it runs
+# (COMMAND_MODULES) after the arguments are parsed, so --help and bad arguments answer at interpreter speed
+# and nothing pulls in pandas; benchmarks.py startup tracks the import cost of each subcommand
+from datetime import date, timedelta
+import argparse
+import csv
+import glob
+import importlib
+import json
+import os
+import sys
+
+# modules each subcommand imports when it runs
+COMMAND_MODULES = {'download assets': ['download'],
+                   'download events': ['download'],
+                   'load stats': ['load'],
+                   'export': ['load'],
+                   'tail': ['tail', 'crawler']}
+
+
+def import_command(command):
+    '''
+    Import the modules of a subcommand ('download events', 'load stats', ...), the startup benchmark times this
+    '''
+    return [importlib.import_module(name) for name in COMMAND_MODULES[command]]
+
+
+def parse_day(text):
+    return date.fromisoformat(text)
+
+
+def date_range(args):
+    # --since-days N wins over --start, the range is inclusive
+    start = args.start
+    if args.since_days is not None:
+        start = date.today() - timedelta(days=args.since_days)
+    return start, args.end
+
+
+def retry_policy(args):
+    from client import CircuitBreaker, RetryPolicy
+
+    return RetryPolicy(args.max_retries, breaker=CircuitBreaker(cooldown=args.cooldown))
+
+
+def open_metrics(args):
+    if not args.metrics:
+        return None
+    from metrics import JsonLinesSink, Metrics, PrometheusSink
+
+    return Metrics(JsonLinesSink(args.metrics + '.jsonl'), PrometheusSink(args.metrics + '.prom'))
+
+
+def run_download(args, download):
+    # shared by both download subcommands: metrics are closed and summarised whatever happens
+    metrics = open_metrics(args)
+    try:
+        result = download(retry_policy(args), metrics)
+    finally:
+        if metrics is not None:
+            metrics.close()
+    if isinstance(result, dict):
+        print(json.dumps(result, default=str))
+    if metrics is not None:
+        print(json.dumps(metrics.summary()))
+
+
+def download_assets(args):
+    import_command('download assets')
+    from download import download_asset_info
+
+    run_download(args, lambda retry, metrics: download_asset_info(
+        args.save_location, args.name, args.contract, request_buffer=args.request_buffer, snapshots=args.snapshots,
+        pagination=args.pagination, metrics=metrics, retry=retry))
+
+
+def download_events(args):
+    import_command('download events')
+    from download import download_event_info
+
+    start, end = date_range(args)
+    hour_chunks = args.hour_chunks if args.hour_chunks == 'adaptive' else int(args.hour_chunks)
+    run_download(args, lambda retry, metrics: download_event_info(
+        args.save_location, args.contract, start_date=start or date(2021, 7, 30), end_date=end or date.today(),
+        event_type=args.event_type, hour_chunks=hour_chunks, request_buffer=args.request_buffer,
+        storage=args.storage, metrics=metrics, retry=retry))
+
+
+def event_counts(save_location, start=None, end=None):
+    '''
+    {day: {event type: count}} of the stored events of a collection between start and end (inclusive)
+    '''
+    import numpy as np
+
+    from load import iter_events
+
+    counts = {}
+    for day, columns in iter_events(save_location, start, end, columns=['event_type']):
+        types, number = np.unique(columns['event_type'], return_counts=True)
+        counts[str(day)] = {str(e_type): int(n) for e_type, n in zip(types, number)}
+    return counts
+
+
+def load_stats(args):
+    import_command('load stats')
+    from load import event_file_days
+
+    start, end = date_range(args)
+    file_days = event_file_days(args.save_location) if os.path.isdir(args.save_location) else {}
+    counts = event_counts(args.save_location, start, end) if file_days else {}
+    totals = {}
+    for day_counts in counts.values():
+        for e_type, n in day_counts.items():
+            totals[e_type] = totals.get(e_type, 0) + n
+    snapshots = sorted(path[-len('????-??-??.npz'):-len('.npz')] for path in
+                       glob.glob(args.save_location + '*_list????-??-??.npz'))
+    print(json.dumps({'save_location': args.save_location,
+                      'days_stored': len(file_days),
+                      'first_day': str(min(file_days)) if file_days else None,
+                      'last_day': str(max(file_days)) if file_days else None,
+                      'start': str(start) if start else None, 'end': str(end) if end else None,
+                      'events': sum(totals.values()),
+                      'event_types': totals,
+                      'days': counts if args.per_day else len(counts),
+                      'latest_asset_snapshot': snapshots[-1] if snapshots else None}))
+
+
+def export_events(args):
+    import_command('export')
+    from load import iter_events
+
+    start, end = date_range(args)
+    event_types = args.event_types.split(',') if args.event_types else None
+    columns = args.columns.split(',') if args.columns else None
+    rows = 0
+    out = sys.stdout if args.output == '-' else open(args.output + '.tmp', 'w', newline='')
+    try:
+        writer = None
+        for day, data in iter_events(args.save_location, start, end, event_types=event_types, columns=columns):
+            names = list(data)
+            values = [data[name].tolist() for name in names]
+            if args.format == 'csv':
+                if writer is None:
+                    writer = csv.writer(out)
+                    writer.writerow(names)
+                writer.writerows(zip(*values))
+            else:
+                for row in zip(*values):
+                    out.write(json.dumps(dict(zip(names, row)), default=str) + '\n')
+            rows += len(values[0]) if values else 0
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if out is not sys.stdout:
+        os.replace(args.output + '.tmp', args.output)
+        print(json.dumps({'output': args.output, 'rows': rows}))
+
+
+def tail_events(args):
+    import_command('tail')
+    import requests
+
+    from crawler import COLLECTIONS, load_collections
+    from tail import EventTail, run_tail
+
+    collections = load_collections(args.collections) if args.collections else [dict(c) for c in COLLECTIONS]
+
+    def report(tail, events):
+        # one JSON line per poll that found something
+        types = {}
+        for event in events:
+            types[event['event_type']] = types.get(event['event_type'], 0) + 1
+        print(json.dumps({'asset_name': tail.asset_name, 'newest': events[-1]['created_date'], 'events': types}),
+              flush=True)
+
+    metrics = open_metrics(args)
+    session = requests.Session()
+    tails = [EventTail(os.path.join(args.root, collection['asset_name'], ''), collection['contract'],
+                       collection['asset_name'], event_type=args.event_type,
+                       overlap=timedelta(seconds=args.overlap), storage=args.storage, flush_every=args.flush_every,
+                       callback=report, session=session, url=args.url, metrics=metrics,
+                       retry=retry_policy(args))
+             for collection in collections]
+    try:
+        run_tail(tails, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics is not None:
+            metrics.close()
+    print(json.dumps([tail.stats() for tail in tails]))
+
+
+def add_range_arguments(parser):
+    parser.add_argument('--start', type=parse_day, help='first day, YYYY-MM-DD')
+    parser.add_argument('--end', type=parse_day, help='last day, YYYY-MM-DD')
+    parser.add_argument('--since-days', type=int, help='only the last N days (overrides --start)')
+
+
+def add_download_arguments(parser):
+    parser.add_argument('save_location', help='collection folder, with a trailing slash')
+    parser.add_argument('--contract', default="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5")
+    parser.add_argument('--request-buffer', type=float, default=.5, help='seconds slept between requests')
+    add_client_arguments(parser)
+
+
+def add_client_arguments(parser):
+    parser.add_argument('--metrics', help='write request metrics to METRICS.jsonl and METRICS.prom')
+    parser.add_argument('--max-retries', type=int, default=5, help='retries of a throttled or failed request')
+    parser.add_argument('--cooldown', type=float, default=30,
+                        help='seconds to pause when the API keeps throttling, doubled while it goes on')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Download, inspect and export OpenSea collection data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    download = commands.add_parser('download', help='download assets or events of a collection')
+    kinds = download.add_subparsers(dest='kind', required=True)
+    assets = kinds.add_parser('assets', help='asset snapshot, see download.download_asset_info')
+    add_download_arguments(assets)
+    assets.add_argument('--name', default='animeta', help='asset_name of the snapshot files')
+    assets.add_argument('--snapshots', choices=['full', 'delta'], default='full')
+    assets.add_argument('--pagination', choices=['blocks', 'discover'], default='blocks')
+    assets.set_defaults(run=download_assets)
+    events = kinds.add_parser('events', help='events by day, see download.download_event_info')
+    add_download_arguments(events)
+    add_range_arguments(events)
+    events.add_argument('--event-type', default='all')
+    events.add_argument('--hour-chunks', default='24', help="hours per request window or 'adaptive'")
+    events.add_argument('--storage', choices=['npz', 'columnar'], default='npz')
+    events.set_defaults(run=download_events)
+
+    load = commands.add_parser('load', help='inspect stored data')
+    views = load.add_subparsers(dest='view', required=True)
+    stats = views.add_parser('stats', help='stored days, event counts by type and the latest asset snapshot')
+    stats.add_argument('save_location')
+    add_range_arguments(stats)
+    stats.add_argument('--per-day', action='store_true', help='list the counts of every day')
+    stats.set_defaults(run=load_stats)
+
+    export = commands.add_parser('export', help='write stored events as CSV or JSON lines')
+    export.add_argument('save_location')
+    export.add_argument('output', help="file to write, '-' for stdout")
+    add_range_arguments(export)
+    export.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    export.add_argument('--event-types', help='comma separated, e.g. successful,created')
+    export.add_argument('--columns', help='comma separated event_store columns, default all')
+    export.set_defaults(run=export_events)
+
+    tail = commands.add_parser('tail', help='poll new events of several collections until interrupted')
+    tail.add_argument('root', help='folder that gets one sub folder per collection')
+    tail.add_argument('collections', nargs='?', help='JSON file of collection specs, default crawler.COLLECTIONS')
+    tail.add_argument('--interval', type=float, default=10, help='seconds between polls of a collection')
+    tail.add_argument('--overlap', type=float, default=300, help='seconds read again for late indexed events')
+    tail.add_argument('--flush-every', type=float, default=60, help='seconds between writes to the day files')
+    tail.add_argument('--event-type', default='all')
+    tail.add_argument('--storage', choices=['npz', 'columnar'], default='npz')
+    tail.add_argument('--url', default="https://api.opensea.io/api/v1/events",
+                      help='events endpoint, e.g. a local simulator.start_server')
+    add_client_arguments(tail)
+    tail.set_defaults(run=tail_events)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
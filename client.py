@@ -0,0 +1,166 @@
+# Shared client layer of the downloaders: connect / read timeouts, retries with exponential backoff and jitter
+# honoring Retry-After, and a circuit breaker that pauses every request of a crawl while the API keeps throttling
+#   retry = RetryPolicy(max_retries=8, breaker=CircuitBreaker(threshold=3, cooldown=60))
+#   download_event_info(save_location, retry=retry)
+# The download functions send through api_session(session, metrics, retry), one pooled requests.Session per run
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import threading
+import time
+
+import requests
+
+from metrics import NullMetrics
+
+# answers worth asking again: throttled, and the gateway / server errors the API gives under load
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retry_after_seconds(response, default=1.0):
+    '''
+    Seconds asked for by the Retry-After header of response, given either as seconds or as an HTTP date
+    '''
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class CircuitBreaker:
+    '''
+    Stops every request sent through it while the API is throttling or failing
+    threshold throttled / failed answers in a row open the breaker for cooldown seconds, doubled (up to
+    max_cooldown) each time it opens again before a request succeeds; a Retry-After pauses it at least that long
+    Share one breaker between the sessions of a crawl so a pause holds for all of them, it is thread safe
+    '''
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=600):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0.0
+
+    def remaining(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def wait(self, metrics=None):
+        # sleep while the breaker is open, it can be opened again by another thread in the meantime
+        metrics = metrics or NullMetrics()
+        while self.remaining() > 0:
+            metrics.sleep(self.remaining())
+
+    def pause(self, seconds):
+        with self.lock:
+            self.open_until = max(self.open_until, time.monotonic() + seconds)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold:
+                return
+            seconds = min(self.max_cooldown, self.cooldown * 2 ** self.opened)
+            self.failures = 0
+            self.opened += 1
+            self.open_until = max(self.open_until, time.monotonic() + seconds)
+        print('API keeps throttling, pausing requests for ' + str(seconds) + ' seconds', end=" ")
+
+
+class RetryPolicy:
+    '''
+    How the downloaders retry a request
+    timeout = (connect, read) seconds, a request hanging longer counts as a failed attempt
+    max_retries attempts more after the first for the statuses of retry_statuses and connection errors / timeouts,
+    waiting a random time up to backoff * 2 ** attempt seconds (at most max_backoff) and at least Retry-After
+    breaker is the CircuitBreaker shared by every session using this policy
+    '''
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60, timeout=(10, 60), retry_statuses=RETRY_STATUSES,
+                 breaker=None, seed=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retry_statuses = tuple(retry_statuses)
+        self.breaker = breaker or CircuitBreaker()
+        self.rng = random.Random(seed)
+
+    def delay(self, attempt, response=None):
+        '''
+        Seconds to wait before attempt (1 for the first retry): full jitter over the exponential backoff,
+        never less than the Retry-After of response
+        '''
+        delay = self.rng.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if response is not None and 'Retry-After' in response.headers:
+            delay = max(delay, retry_after_seconds(response))
+        return delay
+
+
+class RetryingSession(requests.Session):
+    '''
+    requests.Session that sends through another session (e.g. a metrics.InstrumentedSession, so every attempt
+    is recorded) with the timeouts, retries and circuit breaker of a RetryPolicy
+    The last answer is returned once retries run out, the last connection error / timeout is raised
+    retry_statuses replaces the statuses of the policy, e.g. to leave 429s to a caller with its own rate limiter
+    '''
+    def __init__(self, session, policy=None, metrics=None, retry_statuses=None):
+        super().__init__()
+        self.session = session
+        self.policy = policy or RetryPolicy()
+        self.metrics = metrics or NullMetrics()
+        self.retry_statuses = self.policy.retry_statuses if retry_statuses is None else tuple(retry_statuses)
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, url, **kwargs):
+        policy = self.policy
+        breaker = policy.breaker
+        kwargs.setdefault('timeout', policy.timeout)
+        attempt = 0
+        while True:
+            breaker.wait(self.metrics)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.failure()
+                if attempt >= policy.max_retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in self.retry_statuses:
+                    breaker.success()
+                    return response
+                breaker.failure()
+                if attempt >= policy.max_retries:
+                    return response
+                if response.status_code == 429 and 'Retry-After' in response.headers:
+                    breaker.pause(retry_after_seconds(response))
+            attempt += 1
+            delay = policy.delay(attempt, response)
+            if response is not None and response.raw is not None:
+                # the retried answer is dropped, its connection goes back to the pool even if streamed and unread
+                response.close()
+            self.metrics.sleep(delay)
+
+
+def api_session(session=None, metrics=None, retry=None):
+    '''
+    Session the download functions send their requests through: session (a new pooled requests.Session when
+    None) recorded by metrics and wrapped in a RetryingSession of retry (a RetryPolicy, defaults when None)
+    '''
+    metrics = metrics or NullMetrics()
+    return RetryingSession(metrics.wrap(session or requests.Session()), retry, metrics)
@@ -0,0 +1,285 @@
+# Crawl several collections at once: asset and event jobs for every collection go through one worker pool,
+# one global API rate limit shared round robin between collections, with per collection progress reports
+#   python crawler.py --root static --rps 2 --workers 4                 (the collections of download_dataset.ipynb)
+#   python crawler.py collections.json --root static --since-days 2     (nightly tail of a custom list)
+from collections import deque
+from datetime import date, timedelta
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import requests
+
+from async_download import TokenBucket, download_event_info_async
+from client import CircuitBreaker, RetryPolicy
+from download import download_asset_info
+from metrics import JsonLinesSink, Metrics, PrometheusSink
+
+COLLECTIONS = [
+    {'asset_name': 'animeta', 'contract': "0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
+     'start_date': date(2021, 7, 30)},
+    {'asset_name': 'BAYC', 'contract': "0xBC4CA0EdA7647A8aB7C2061c2E118A18a936f13D",
+     'start_date': date(2021, 5, 24)},
+    {'asset_name': 'meebit', 'contract': "0x7Bd29408f11D2bFC23c34f18275bBf23bB716Bc7",
+     'start_date': date(2021, 5, 3)},
+    {'asset_name': 'hashmask', 'contract': "0xC2C747E0F7004F9E8817Db2ca4997657a7746928",
+     'start_date': date(2021, 1, 30)},
+    {'asset_name': 'penguin', 'contract': "0xBd3531dA5CF5857e7CfAA92426877b022e612cf8",
+     'start_date': date(2021, 7, 23)},
+    {'asset_name': 'veefriend', 'contract': "0xa3AEe8BcE55BEeA1951EF834b99f3Ac60d1ABeeB",
+     'start_date': date(2021, 5, 17)},
+    {'asset_name': 'coolcat', 'contract': "0x1A92f7381B9F03921564a437210bB9396471050C",
+     'start_date': date(2021, 7, 1)},
+    {'asset_name': 'cranium', 'contract': "0x85f740958906b317de6ed79663012859067E745B",
+     'start_date': date(2021, 6, 17)},
+    {'asset_name': 'droids', 'contract': "0xa6794dec66df7d8b69752956df1b28ca93f77cd7",
+     'start_date': date(2021, 9, 7)},
+]
+
+
+class FairLimiter:
+    '''
+    Global requests-per-second limit handed out round robin between collections
+    A collection with many waiting requests cannot starve the others: each token goes to the next collection
+    in turn that has a request waiting
+    handle(name) gives the TokenBucket-like object (acquire / pause) a single collection uses
+    '''
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate)
+        self.waiting = {}
+        self.order = deque()
+        self.dispatcher = None
+
+    def handle(self, name):
+        return LimiterHandle(self, name)
+
+    async def acquire(self, name):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiting.setdefault(name, deque())
+        if not queue:
+            self.order.append(name)
+        queue.append(future)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        while self.order:
+            await self.bucket.acquire()
+            name = self.order.popleft()
+            queue = self.waiting[name]
+            future = queue.popleft()
+            if queue:
+                self.order.append(name)
+            if not future.done():
+                future.set_result(None)
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+
+class LimiterHandle:
+    def __init__(self, limiter, name):
+        self.limiter = limiter
+        self.name = name
+        self.requests = 0
+
+    async def acquire(self):
+        await self.limiter.acquire(self.name)
+        self.requests += 1
+
+    def pause(self, seconds):
+        self.limiter.pause(seconds)
+
+
+class LimitedSession(requests.Session):
+    '''
+    requests.Session for the blocking downloaders run in worker threads, every request waits for a token
+    from the crawl's event loop
+    '''
+    def __init__(self, handle, loop):
+        super().__init__()
+        self.handle = handle
+        self.loop = loop
+
+    def request(self, *args, **kwargs):
+        asyncio.run_coroutine_threadsafe(self.handle.acquire(), self.loop).result()
+        return super().request(*args, **kwargs)
+
+
+def collection_jobs(collection, end_date, days_per_job=30, assets=True):
+    '''
+    Jobs of one collection in the order they have to run: the asset snapshot, then events in days_per_job blocks
+    '''
+    jobs = []
+    if assets:
+        jobs.append(('assets', None, None))
+    day = collection['start_date']
+    while day <= end_date:
+        last = min(end_date, day + timedelta(days=days_per_job - 1))
+        jobs.append(('events', day, last))
+        day = last + timedelta(days=1)
+    return jobs
+
+
+async def crawl(collections, root, requests_per_second=2, workers=4, event_concurrency=4, days_per_job=30,
+                end_date=None, assets=True, report_every=30, event_url="https://api.opensea.io/api/v1/events",
+                metrics=None, retry=None, **event_kwargs):
+    '''
+    Run the asset and event jobs of every collection over a pool of workers
+    Jobs of one collection run one after another (they share its checkpoint), jobs of different collections
+    run in parallel, all requests share one FairLimiter of requests_per_second
+    Each collection is saved under root/<asset_name>/, extra keyword arguments go to download_event_info_async
+    metrics (a metrics.Metrics) records the requests and stages of every job
+    retry (a client.RetryPolicy) is shared by every job, so its circuit breaker pauses the whole crawl when the
+    API keeps throttling
+    Returns per collection stats: jobs, requests, day files written, seconds and requests per second
+    '''
+    end_date = end_date or date.today()
+    loop = asyncio.get_running_loop()
+    limiter = FairLimiter(requests_per_second)
+    retry = retry or RetryPolicy()
+    # collections whose next job is ready, in round robin order; a collection is out of it while its job runs
+    ready = deque()
+    stats = {}
+    for collection in collections:
+        name = collection['asset_name']
+        jobs = collection_jobs(collection, end_date, days_per_job, assets)
+        if jobs:
+            ready.append((collection, deque(jobs)))
+        stats[name] = {'jobs': len(jobs), 'jobs_done': 0, 'day_files': 0, 'errors': 0,
+                       'started': None, 'seconds': 0.0, 'handle': limiter.handle(name)}
+    remaining = [len(ready)]
+    changed = asyncio.Condition()
+
+    async def run_job(collection, kind, first, last):
+        name = collection['asset_name']
+        save_location = os.path.join(root, name, '')
+        handle = stats[name]['handle']
+        if kind == 'assets':
+            session = LimitedSession(handle, loop)
+            await loop.run_in_executor(None, lambda: download_asset_info(
+                save_location, asset_name=name, contract=collection['contract'], request_buffer=0, session=session,
+                metrics=metrics, retry=retry))
+            return 0
+        saved = await download_event_info_async(save_location, contract=collection['contract'], start_date=first,
+                                                end_date=last, concurrency=event_concurrency, bucket=handle,
+                                                url=event_url, metrics=metrics, retry=retry, **event_kwargs)
+        return len(saved)
+
+    async def worker():
+        while True:
+            async with changed:
+                while not ready and remaining[0] > 0:
+                    await changed.wait()
+                if not ready:
+                    return
+                collection, jobs = ready.popleft()
+            name = collection['asset_name']
+            kind, first, last = jobs.popleft()
+            entry = stats[name]
+            entry['started'] = entry['started'] or time.time()
+            try:
+                entry['day_files'] += await run_job(collection, kind, first, last)
+            except Exception as error:
+                entry['errors'] += 1
+                print('error', name, kind, first, last, error)
+            entry['jobs_done'] += 1
+            entry['seconds'] = time.time() - entry['started']
+            async with changed:
+                if jobs:
+                    ready.append((collection, jobs))
+                else:
+                    remaining[0] -= 1
+                changed.notify_all()
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(report_every)
+            print_progress(stats)
+
+    report_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*[worker() for _ in range(workers)])
+    finally:
+        report_task.cancel()
+    print_progress(stats)
+    return {name: summary(entry) for name, entry in stats.items()}
+
+
+def summary(entry):
+    requests_made = entry['handle'].requests
+    return {'jobs': entry['jobs'],
+            'jobs_done': entry['jobs_done'],
+            'errors': entry['errors'],
+            'requests': requests_made,
+            'day_files': entry['day_files'],
+            'seconds': round(entry['seconds'], 1),
+            'requests_per_second': round(requests_made / entry['seconds'], 2) if entry['seconds'] else 0.0}
+
+
+def print_progress(stats):
+    for name, entry in stats.items():
+        entry = summary(entry)
+        print(name + ': ' + str(entry['jobs_done']) + '/' + str(entry['jobs']) + ' jobs, ' +
+              str(entry['requests']) + ' requests, ' + str(entry['requests_per_second']) + ' req/s, ' +
+              str(entry['day_files']) + ' day files, ' + str(entry['errors']) + ' errors')
+
+
+def load_collections(path):
+    '''
+    Read collection specs from a JSON list of {"asset_name", "contract", "start_date": "YYYY-MM-DD"}
+    '''
+    with open(path) as f:
+        collections = json.load(f)
+    for collection in collections:
+        collection['start_date'] = date.fromisoformat(collection['start_date'])
+    return collections
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download assets and events for several collections')
+    parser.add_argument('collections', nargs='?', help='JSON file of collection specs, default the notebook list')
+    parser.add_argument('--root', default='static', help='folder that gets one sub folder per collection')
+    parser.add_argument('--rps', type=float, default=2, help='requests per second for the whole crawl')
+    parser.add_argument('--workers', type=int, default=4, help='collections crawled at the same time')
+    parser.add_argument('--event-concurrency', type=int, default=4, help='requests in flight per event job')
+    parser.add_argument('--days-per-job', type=int, default=30)
+    parser.add_argument('--since-days', type=int, help='only fetch events of the last N days')
+    parser.add_argument('--skip-assets', action='store_true')
+    parser.add_argument('--adaptive', action='store_true', help="use hour_chunks='adaptive'")
+    parser.add_argument('--storage', choices=['npz', 'columnar'], default='npz')
+    parser.add_argument('--report-every', type=float, default=30, help='seconds between progress lines')
+    parser.add_argument('--metrics', help='write request metrics to METRICS.jsonl and METRICS.prom')
+    parser.add_argument('--max-retries', type=int, default=5, help='retries of a throttled or failed request')
+    parser.add_argument('--cooldown', type=float, default=30,
+                        help='seconds the crawl pauses when the API keeps throttling, doubled while it goes on')
+    args = parser.parse_args(argv)
+
+    collections = load_collections(args.collections) if args.collections else [dict(c) for c in COLLECTIONS]
+    if args.since_days is not None:
+        since = date.today() - timedelta(days=args.since_days)
+        for collection in collections:
+            collection['start_date'] = max(collection['start_date'], since)
+    metrics = None
+    if args.metrics:
+        metrics = Metrics(JsonLinesSink(args.metrics + '.jsonl'), PrometheusSink(args.metrics + '.prom'))
+    try:
+        stats = asyncio.run(crawl(collections, args.root, requests_per_second=args.rps, workers=args.workers,
+                                  event_concurrency=args.event_concurrency, days_per_job=args.days_per_job,
+                                  assets=not args.skip_assets, report_every=args.report_every,
+                                  hour_chunks='adaptive' if args.adaptive else 24, storage=args.storage,
+                                  metrics=metrics, retry=RetryPolicy(args.max_retries,
+                                                                     breaker=CircuitBreaker(cooldown=args.cooldown))))
+    finally:
+        if metrics is not None:
+            metrics.close()
+    print(json.dumps(stats))
+    if metrics is not None:
+        print(json.dumps(metrics.summary()))
+
+
+if __name__ == '__main__':
+    main()
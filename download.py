@@ -1,38 +1,79 @@
-from helpers import parse_assets_data, parse_sale_data, parse_listing_data
+from checkpoint import Checkpoint
+from client import api_session
+from event_index import EventIndex
+from event_store import save_event_day
+from metrics import NullMetrics
+from snapshots import save_snapshot
+from windows import AdaptiveWindow, split_by_day, utc_now
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta, datetime
 import os
 import numpy as np
 import requests
-import time
 
 
 def download_asset_info(save_location, asset_name="animeta", contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
-                        limit=1000, request_buffer=0):
+                        limit=1000, request_buffer=0, resume=True, session=None, snapshots='full',
+                        url="https://api.opensea.io/api/v1/assets", metrics=None, pagination='blocks',
+                        retry=None):
     '''
     Download assets from a specific contract
     OpenSea API  only supports offset up to 10,000 as a result we increment token_ids
     Some projects do not start at the same number(e.g. 0 or 1) or increment at all
     Default is taking the first 50,000 assets, (limit = 1000) * 50 per call
     request_buffer is time in seconds to sleep between requests to avoid throttling
+    resume uses the save_location checkpoint: an error keeps the blocks fetched so far in <asset_name>_partial.npz
+    and the next run continues from the failed block, a snapshot already completed today is not downloaded again
+    session is any requests.Session to send the requests through, e.g. a cache.CachedSession
+    snapshots='delta' stores the snapshot as a diff against the previous run (see snapshots.py) instead of
+    a full <asset_name>_list<date>.npz
+    url can point at a local simulator.start_server for offline runs
+    metrics (a metrics.Metrics) records every request and the time spent sleeping and writing
+    retry (a client.RetryPolicy) sets the timeouts, retries with backoff and circuit breaker of the requests
+    pagination = 'discover' lists the collection instead of guessing token ids, see download_asset_info_discover
     '''
-    url = "https://api.opensea.io/api/v1/assets"
+    metrics = metrics or NullMetrics()
+    http = api_session(session, metrics, retry)
     listofassets = []
     # If saved folder doesn't exist, then create it.
     if not os.path.isdir(save_location):
         os.makedirs(save_location)
-    for i in range(0, limit):
-        time.sleep(request_buffer)
+    partial_file = save_location + asset_name + '_partial.npz'
+    checkpoint = Checkpoint(save_location)
+    progress = checkpoint.asset_progress(contract)
+    start_block = 0
+    if resume and progress['complete'] and progress['file'] and \
+            progress['file'].endswith(str(date.today()) + '.npz') and os.path.isfile(progress['file']):
+        print(progress['file'] + " already downloaded")
+        return
+    if pagination == 'discover':
+        return download_asset_info_discover(save_location, asset_name=asset_name, contract=contract,
+                                            request_buffer=request_buffer, session=session, snapshots=snapshots,
+                                            url=url, metrics=metrics, retry=retry)
+    if resume and not progress['complete'] and os.path.isfile(partial_file):
+        listofassets.append(list(np.load(partial_file, allow_pickle=True)['arr_0']))
+        start_block = progress['next_block']
+
+    failed = False
+    for i in range(start_block, limit):
+        metrics.sleep(request_buffer)
         querystring = {"token_ids": list(range((i * 30), (i * 30) + 30)),
                        "asset_contract_address": contract,
                        "order_direction": "desc",
                        "offset": "0",
                        "limit": "30"}
-        response = requests.request("GET", url, params=querystring)
+        try:
+            response = http.request("GET", url, params=querystring)
+        except requests.RequestException as error:
+            print('error', error)
+            failed = True
+            break
 
         print(i, end=" ")
         if response.status_code != 200:
-            print(response.json())
+            print(response.text)
             print('error')
+            failed = True
             break
 
         # Getting asset data
@@ -43,19 +84,143 @@ def download_asset_info(save_location, asset_name="animeta", contract="0x18df6c5
         # parsed_assets = [parse_assets_data(asset) for asset in assets]
         # storing parsed assets data into list
         listofassets.append(assets)
-        if i == limit:
-            print("There are likely more assets that exist in this collection than were downloaded")
+    else:
+        # no empty block before limit: the blocks past it were never asked for
+        print("There are likely more assets that exist in this collection than were downloaded")
 
     # Flatten everything
     listofassets = [item for sublist in listofassets for item in sublist]
-    print(str(len(listofassets)) + " assets saved to" + save_location + asset_name + '_list' +
-          str(date.today()) + r'.npz')
-    np.savez(save_location + asset_name + '_list' + str(date.today()) + r'.npz', listofassets)
+    if failed:
+        np.savez(partial_file, listofassets)
+        checkpoint.update_assets(contract, i, False)
+        print(str(len(listofassets)) + " assets kept in " + partial_file + ", rerun to resume from block " + str(i))
+        return
+    save_asset_snapshot(save_location, asset_name, contract, listofassets, snapshots, metrics)
+
+
+def save_asset_snapshot(save_location, asset_name, contract, listofassets, snapshots='full', metrics=None):
+    '''
+    Write a finished snapshot (full <asset_name>_list<date>.npz or a delta, see snapshots.py), mark it complete
+    in the checkpoint and drop the partial file of an earlier failed run
+    '''
+    metrics = metrics or NullMetrics()
+    snapshot_file = save_location + asset_name + '_list' + str(date.today()) + r'.npz'
+    with metrics.stage('write'):
+        if snapshots == 'delta':
+            snapshot_file = save_snapshot(save_location, asset_name, listofassets)
+        else:
+            print(str(len(listofassets)) + " assets saved to" + snapshot_file)
+            np.savez(snapshot_file, listofassets)
+    Checkpoint(save_location).update_assets(contract, 0, True, snapshot_file)
+    partial_file = save_location + asset_name + '_partial.npz'
+    if os.path.isfile(partial_file):
+        os.remove(partial_file)
+
+
+def list_assets(http, url, contract, order_direction, page_size=50, max_offset=10000, request_buffer=0,
+                metrics=None):
+    '''
+    Page through the assets of a contract in token id order_direction ('asc' or 'desc') by offset
+    Returns (assets, complete), complete is False when the offset ceiling was reached before a short page
+    '''
+    metrics = metrics or NullMetrics()
+    assets = []
+    for offset in range(0, max_offset + 1, page_size):
+        metrics.sleep(request_buffer)
+        querystring = {"asset_contract_address": contract,
+                       "order_direction": order_direction,
+                       "offset": str(offset),
+                       "limit": str(page_size)}
+        try:
+            response = http.request("GET", url, params=querystring)
+        except requests.RequestException as error:
+            raise RuntimeError('assets listing failed at offset ' + str(offset) + ': ' + str(error))
+        if response.status_code != 200:
+            raise RuntimeError('assets listing failed with ' + str(response.status_code) + ' at offset ' +
+                               str(offset))
+        page = response.json()['assets']
+        assets.extend(page)
+        if len(page) < page_size:
+            return assets, True
+    return assets, False
+
+
+def fetch_token_block(http, url, contract, token_ids, request_buffer=0, metrics=None):
+    # one request for up to 30 token ids, an empty answer only means these ids do not exist
+    (metrics or NullMetrics()).sleep(request_buffer)
+    querystring = {"token_ids": [str(token_id) for token_id in token_ids],
+                   "asset_contract_address": contract,
+                   "order_direction": "desc",
+                   "offset": "0",
+                   "limit": str(len(token_ids))}
+    try:
+        response = http.request("GET", url, params=querystring)
+    except requests.RequestException as error:
+        raise RuntimeError('assets request failed for token ids ' + str(token_ids[0]) + '-' + str(token_ids[-1]) +
+                           ': ' + str(error))
+    if response.status_code != 200:
+        raise RuntimeError('assets request failed with ' + str(response.status_code) + ' for token ids ' +
+                           str(token_ids[0]) + '-' + str(token_ids[-1]))
+    return response.json()['assets']
+
+
+def download_asset_info_discover(save_location, asset_name="animeta",
+                                 contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5", request_buffer=0,
+                                 session=None, snapshots='full', url="https://api.opensea.io/api/v1/assets",
+                                 metrics=None, page_size=50, max_offset=10000, block_size=30, max_gap_blocks=5000,
+                                 workers=4, retry=None):
+    '''
+    Download every asset of a contract without assuming where its token ids start or that they are sequential
+    1. the collection is listed by contract in ascending token id order, page_size assets a request up to the
+       max_offset ceiling: a collection of up to ~10,000 assets is complete here whatever its ids are
+    2. a larger one is also listed from the top (descending), which gives the ~10,000 highest ids
+    3. the token ids left between the two listings are requested block_size at a time by workers threads,
+       empty blocks are skipped rather than ending the download
+    A gap of more than max_gap_blocks blocks (huge non-sequential ids) is not probed, the snapshot is then saved
+    with what the listings returned and a warning
+    A request still failing after the retries of retry (a client.RetryPolicy) ends the run without saving,
+    a rerun starts over
+    '''
+    metrics = metrics or NullMetrics()
+    http = api_session(session, metrics, retry)
+    if not os.path.isdir(save_location):
+        os.makedirs(save_location)
+    found = {}
+    try:
+        ascending, complete = list_assets(http, url, contract, 'asc', page_size, max_offset, request_buffer, metrics)
+        found.update((int(asset['token_id']), asset) for asset in ascending)
+        print(str(len(found)) + " assets listed", end=" ")
+        if not complete:
+            descending, complete = list_assets(http, url, contract, 'desc', page_size, max_offset, request_buffer,
+                                               metrics)
+            found.update((int(asset['token_id']), asset) for asset in descending)
+            print(str(len(found)) + " assets listed from both ends", end=" ")
+            if not complete:
+                low = max(int(asset['token_id']) for asset in ascending)
+                high = min(int(asset['token_id']) for asset in descending)
+                blocks = [list(range(start, min(start + block_size, high))) for start in
+                          range(low + 1, high, block_size)]
+                if len(blocks) > max_gap_blocks:
+                    print("token ids " + str(low + 1) + "-" + str(high - 1) + " are too sparse to probe, " +
+                          "the snapshot is likely incomplete")
+                else:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        for assets in executor.map(lambda block: fetch_token_block(
+                                http, url, contract, block, request_buffer, metrics), blocks):
+                            found.update((int(asset['token_id']), asset) for asset in assets)
+                    print(str(len(found)) + " assets after probing " + str(len(blocks)) + " blocks", end=" ")
+    except RuntimeError as error:
+        print('error', error)
+        Checkpoint(save_location).update_assets(contract, 0, False)
+        return
+    listofassets = [found[token_id] for token_id in sorted(found)]
+    save_asset_snapshot(save_location, asset_name, contract, listofassets, snapshots, metrics)
 
 
 def download_event_info(save_location, contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
-                        start_date=date(2021, 7, 30), end_date=date.today(), event_type='all', hour_chunks=24,
-                        request_buffer=.5):
+                        start_date=date(2021, 7, 30), end_date=utc_now().date(), event_type='all', hour_chunks=24,
+                        request_buffer=.5, resume=True, storage='npz', session=None,
+                        url="https://api.opensea.io/api/v1/events", metrics=None, retry=None):
     '''
     Download events from a specific contract
     We increment by date to save historical context and avoid OpenSea API limitations
@@ -66,111 +231,200 @@ def download_event_info(save_location, contract="0x18df6c571f6fe9283b87f910e41dc
     Event types include: 'created' for new auctions, 'successful' for sales, 'cancelled', 'bid_entered', 'bid_withdrawn'
     Both 'transfer' and 'approve' are supposed to be event types but don't seem to be used by most collections
     hour_chunks = number of hours to search at a time, if > 10,000 of one type of event in a day need to reduce from 24
+    hour_chunks = 'adaptive' sizes the windows automatically instead, see download_event_info_adaptive
     request_buffer is time in seconds to sleep between requests to avoid throttling
+    resume uses the save_location checkpoint: finished days are skipped and failed (chunk, event_type) units
+    restart from their last offset, new events are merged into the existing day file
+    events already stored in any day file of save_location are dropped on write, see event_index
+    storage = 'npz' for the assets_events_list_<date>.npz files or 'columnar' for typed columns, see event_store
+    session is any requests.Session to send the requests through, e.g. a cache.CachedSession
+    url can point at a local simulator.start_server for offline runs
+    metrics (a metrics.Metrics) records every request and the time spent sleeping and writing
+    retry (a client.RetryPolicy) sets the timeouts, retries with backoff and circuit breaker of the requests,
+    a window still failing after them is left unfinished in the checkpoint for the next run
     '''
-    url = "https://api.opensea.io/api/v1/events"
+    metrics = metrics or NullMetrics()
+    http = api_session(session, metrics, retry)
     # get the number of days that we want to download and save an event for for
     delta = end_date - start_date
     count_days = int(delta.days)
     # If saved folder doesn't exist, then create it.
     if not os.path.isdir(save_location):
         os.makedirs(save_location)
+    if hour_chunks == 'adaptive':
+        return download_event_info_adaptive(save_location, contract=contract, start_date=start_date,
+                                            end_date=end_date, event_type=event_type,
+                                            request_buffer=request_buffer, resume=resume, storage=storage,
+                                            session=session, url=url, metrics=metrics, retry=retry)
+    checkpoint = Checkpoint(save_location)
+    index = EventIndex(save_location)
+    if event_type != 'all':
+        event_types = [event_type]
+        page_size = 300
+    else:
+        event_types = ['created', 'successful', 'cancelled', 'bid_entered', 'bid_withdrawn']
+        page_size = 100
 
     for i in range(count_days + 1):
+        day = start_date + timedelta(days=i)
+        if resume and checkpoint.day_complete(contract, day, save_location):
+            print(str(day) + " complete", end=" ")
+            continue
         events_that_day = []
-        # set start and end of the day we are checking, if it's today set end to current time
-        if date.today() == (start_date + timedelta(days=i)):
-            before = datetime.now()
-            after = datetime.combine((start_date + timedelta(days=i)), datetime.min.time())
+        # set start and end of the day we are checking, if it's today (UTC) set end to current time
+        if utc_now().date() == day:
+            before = utc_now()
+            after = datetime.combine(day, datetime.min.time())
         else:
             before = datetime.combine((start_date + timedelta(days=i + 1)), datetime.min.time())
-            after = datetime.combine((start_date + timedelta(days=i)), datetime.min.time())
+            after = datetime.combine(day, datetime.min.time())
         # There are too many transactions, now have to break them up by chunks in the day
         chunk_count = 24 / hour_chunks
-        time.sleep(request_buffer)
+        metrics.sleep(request_buffer)
         for chunk in range(int(chunk_count)):
-            end = False
-            for j in range(0, 50):
-                # add the hour_chunk to the start of the day (after) time for each chunk
-                # use the actual before if we pass it chronologically though
-                changed_before = after + timedelta(hours=hour_chunks * (chunk + 1)) - timedelta(minutes=1)
-                changed_after = after + timedelta(hours=hour_chunks * (chunk))
-
-                # this should only happen on the last chunk of a split day or if on current day
-                if before < changed_before:
-                    changed_before = before
-                    end = True
-                # if it's a single type run through the request normally
-                if event_type != 'all':
+            # add the hour_chunk to the start of the day (after) time for each chunk
+            # use the actual before if we pass it chronologically though
+            # occurred_before is exclusive, so chunks meet exactly: a gap between them would drop its events
+            changed_before = after + timedelta(hours=hour_chunks * (chunk + 1))
+            changed_after = after + timedelta(hours=hour_chunks * (chunk))
+            if changed_after >= before:
+                break
+            # this should only happen on the last chunk of a split day or if on current day
+            if before < changed_before:
+                changed_before = before
+            chunk_name = changed_after.strftime('%H:%M')
+
+            # run through each event type separately, page by page from the last saved offset
+            for e_type in event_types:
+                # today's units keep growing so they always start again from the first page
+                if resume and day < utc_now().date():
+                    unit = checkpoint.unit(contract, day, chunk_name, e_type)
+                else:
+                    unit = {'offset': 0, 'complete': False}
+                if unit['complete']:
+                    continue
+                offset = unit['offset']
+                complete = False
+                for j in range(offset // page_size, 50):
+                    if event_type == 'all':
+                        metrics.sleep(.5)
                     querystring = {"asset_contract_address": contract,
-                                   "event_type": event_type,
+                                   "event_type": e_type,
                                    "only_opensea": "false",
-                                   "offset": j * 300,
+                                   "offset": j * page_size,
                                    "occurred_before": changed_before,
                                    "occurred_after": changed_after,
-                                   "limit": "300"}
+                                   "limit": str(page_size)}
                     headers = {"Accept": "application/json"}
 
-                    response = requests.request("GET", url, headers=headers, params=querystring)
+                    try:
+                        response = http.request("GET", url, headers=headers, params=querystring)
+                    except requests.RequestException as error:
+                        print('error', error)
+                        break
 
-                    print(str(j) + event_type + str(changed_before.date()), end=" ")
+                    print(str(j) + e_type + str(changed_before.date()), end=" ")
                     if response.status_code != 200:
                         print('error')
-                        print(response.json())
+                        print(response.text)
                         break
 
                     # Getting assets events data
                     asset_events = response.json()['asset_events']
-
-                    if asset_events == []:
-                        end = True
-                        break
+                    offset = (j + 1) * page_size
 
                     # Parsing assets events data
                     # parsed_asset_events = [parse_event_data(event) for event in asset_events]
                     # storing parsed assets data into list
-                    events_that_day.append(asset_events)
-
-                # if we want to do all types, do the above but once for each type
-                else:
-                    event_types = ['created', 'successful', 'cancelled', 'bid_entered', 'bid_withdrawn']
-                    for e_type in event_types:
-                        time.sleep(.5)
-                        querystring = {"asset_contract_address": contract,
-                                       "event_type": e_type,
-                                       "only_opensea": "false",
-                                       "offset": j * 100,
-                                       "occurred_before": changed_before,
-                                       "occurred_after": changed_after,
-                                       "limit": "100"}
-                        headers = {"Accept": "application/json"}
-
-                        response = requests.request("GET", url, headers=headers, params=querystring)
-
-                        print(str(j) + e_type + str(changed_before.date()), end=' ')
-                        if response.status_code != 200:
-                            print('error')
-                            print(response.json())
-                            break
-
-                        # Getting assets events data
-                        asset_events = response.json()['asset_events']
-
-                        if asset_events == []:
-                            end = True
-                            break
-
-                        # Parsing assets events data
-                        # parsed_asset_events = [parse_event_data(event) for event in asset_events]
-                        # storing parsed assets data into list
+                    if asset_events != []:
                         events_that_day.append(asset_events)
-                if end:
+                    if len(asset_events) < page_size:
+                        complete = True
+                        break
+                # nothing past the offset ceiling can be requested, see hour_chunks
+                if offset >= 50 * page_size:
+                    complete = True
+                checkpoint.update_unit(contract, day, chunk_name, e_type, offset, complete)
+
+        events_that_day = [item for sublist in events_that_day for item in sublist]
+        with metrics.stage('write', day=str(day)):
+            path, event_count = save_event_day(save_location, day, events_that_day, storage=storage, merge=resume,
+                                               index=index)
+        # today's window is still open so it is never marked complete
+        checkpoint.finish_day(contract, day, event_count, closed=day < utc_now().date())
+
+
+def download_event_info_adaptive(save_location, contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
+                                 start_date=date(2021, 7, 30), end_date=utc_now().date(), event_type='all',
+                                 request_buffer=.5, resume=True, page_size=300, max_window_days=7, storage='npz',
+                                 session=None, url="https://api.opensea.io/api/v1/events", metrics=None, retry=None):
+    '''
+    Download events like download_event_info but without guessing hour_chunks
+    Consecutive days still to fetch are swept in runs of up to max_window_days with windows.AdaptiveWindow:
+    a window reaching the 10,000 offset ceiling is bisected so busy mint days are captured completely,
+    and quiet windows grow back so a quiet day costs one request per event type instead of one per chunk
+    Events are split back into the usual assets_events_list_<date>.npz day files
+    '''
+    metrics = metrics or NullMetrics()
+    http = api_session(session, metrics, retry)
+    if not os.path.isdir(save_location):
+        os.makedirs(save_location)
+    checkpoint = Checkpoint(save_location)
+    index = EventIndex(save_location)
+    event_types = [event_type] if event_type != 'all' else ['created', 'successful', 'cancelled', 'bid_entered',
+                                                             'bid_withdrawn']
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    days = [day for day in days if not (resume and checkpoint.day_complete(contract, day, save_location))]
+
+    # group the days left into runs of consecutive days so quiet stretches can share a window
+    runs = []
+    for day in days:
+        if runs and runs[-1][-1] + timedelta(days=1) == day and len(runs[-1]) < max_window_days:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+
+    for run in runs:
+        after = datetime.combine(run[0], datetime.min.time())
+        before = min(datetime.combine(run[-1] + timedelta(days=1), datetime.min.time()), utc_now())
+        events_by_day = {day: [] for day in run}
+        for e_type in event_types:
+            window = AdaptiveWindow(after, before, page_size=page_size, initial_window=timedelta(days=1))
+            while not window.done:
+                changed_after, changed_before, offset = window.next_request()
+                metrics.sleep(request_buffer)
+                querystring = {"asset_contract_address": contract,
+                               "event_type": e_type,
+                               "only_opensea": "false",
+                               "offset": offset,
+                               "occurred_before": changed_before,
+                               "occurred_after": changed_after,
+                               "limit": str(page_size)}
+                headers = {"Accept": "application/json"}
+
+                try:
+                    response = http.request("GET", url, headers=headers, params=querystring)
+                except requests.RequestException as error:
+                    print('error', error)
                     break
-            if end:
-                break
-        if len(events_that_day) > 0:
-            events_that_day = [item for sublist in events_that_day for item in sublist]
-            np.savez(save_location + "assets_events_list_" + str((start_date + timedelta(days=i))) + '.npz', events_that_day)
-            print(str(len(events_that_day)) + " events saved to" + save_location + "assets_events_list_" + str(
-                start_date + timedelta(days=i)) + '.npz')
 
+                print(str(offset // page_size) + e_type + str(changed_before.date()), end=" ")
+                if response.status_code != 200:
+                    print('error')
+                    print(response.text)
+                    break
+                window.feed(response.json()['asset_events'])
+
+            for day, day_events in split_by_day(window.result()).items():
+                if day in events_by_day:
+                    events_by_day[day].extend(day_events)
+            # the sweep walks backwards, so after an error only the days after window.end are complete
+            for day in run:
+                complete = window.done or datetime.combine(day, datetime.min.time()) >= window.end
+                checkpoint.update_unit(contract, day, 'adaptive', e_type, 0, complete)
+
+        for day in run:
+            with metrics.stage('write', day=str(day)):
+                path, event_count = save_event_day(save_location, day, events_by_day[day], storage=storage,
+                                                   merge=resume, index=index)
+            checkpoint.finish_day(contract, day, event_count, closed=day < utc_now().date())
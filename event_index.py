@@ -0,0 +1,228 @@
+# Persistent dedup index of the events stored for a collection, so a repeated run, an overlapping window or
+# the same event landing in two day files is dropped when it is written instead of after loading
+#   <save_location>/event_index/<date>.npy    sorted uint64 keys of the events stored in that day file
+# An event is keyed by its API id, like checkpoint.event_key; only events without an id (old dumps) fall back to a
+# hash of (transaction_hash, token_id, event_type), created_date instead of the transaction when there is none
+# The fallback is coarser than an event: two id-less bids on the same token in the same second collapse into one
+from hashlib import blake2b
+from datetime import date
+import os
+import shutil
+
+import numpy as np
+
+from event_store import EVENT_COLUMNS, read_event_day, write_event_day
+from load import event_file_days
+
+NO_KEY = np.uint64(2 ** 64 - 1)
+# composite keys have the top bit set so they never collide with an id
+COMPOSITE = 2 ** 63
+# written to <save_location>/event_index/format, an index built with other keys is rebuilt on load
+FORMAT = '2'
+
+
+def composite_key(transaction_hash, token_id, event_type, created):
+    if not transaction_hash and not created:
+        return NO_KEY
+    text = '|'.join([transaction_hash or 'at ' + created, token_id or '', event_type or ''])
+    return np.uint64(int.from_bytes(blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big') | COMPOSITE)
+
+
+def row_keys(ids, transaction_hashes, token_ids, event_types, created):
+    '''
+    (id keys, composite keys) as uint64 arrays: the id key of events with an id, the composite key of the others,
+    NO_KEY in the other slot
+    '''
+    ids = np.asarray(ids, dtype='int64')
+    id_keys = ids.astype('uint64')
+    id_keys[ids < 0] = NO_KEY
+    composite = np.array([composite_key(*fields) if event_id < 0 else NO_KEY for event_id, *fields in
+                          zip(ids.tolist(), transaction_hashes, token_ids, event_types, created)], dtype='uint64')
+    return id_keys, composite
+
+
+def event_keys(events):
+    '''
+    row_keys of raw /events dicts, token ids and times formatted as in event_store.events_to_columns
+    '''
+    ids, hashes, tokens, types, created = [], [], [], [], []
+    for event in events:
+        asset = event.get('asset') or {}
+        if asset:
+            token_id = str(asset.get('token_id'))
+        else:
+            bundle = (event.get('asset_bundle') or {}).get('assets') or []
+            token_id = ','.join(str(item.get('token_id')) for item in bundle)
+        ids.append(event['id'] if event.get('id') is not None else -1)
+        hashes.append((event.get('transaction') or {}).get('transaction_hash'))
+        tokens.append(token_id)
+        types.append(event.get('event_type'))
+        created.append((event.get('created_date') or '')[:19])
+    return row_keys(ids, hashes, tokens, types, created)
+
+
+def column_keys(columns):
+    '''
+    row_keys of {column: array} events (event_store layout, byte or str strings)
+    '''
+    def text(name):
+        values = columns[name]
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'utf-8')
+        return values.tolist()
+    created = [stamp if stamp != 'NaT' else '' for stamp in
+               np.datetime_as_string(np.asarray(columns['timestamp'], dtype='datetime64[s]')).tolist()]
+    return row_keys(columns['id'], text('transaction_hash'), text('token_id'), text('event_type'), created)
+
+
+def first_rows(id_keys, composite):
+    # mask of rows whose keys did not appear on an earlier row of the same batch
+    n = len(id_keys)
+    keys = np.concatenate([id_keys, composite])
+    rows = np.concatenate([np.arange(n), np.arange(n)])
+    valid = keys != NO_KEY
+    unique, inverse = np.unique(keys[valid], return_inverse=True)
+    first = np.full(len(unique), n)
+    np.minimum.at(first, inverse, rows[valid])
+    keep = np.ones(n, dtype=bool)
+    keep[rows[valid][first[inverse] < rows[valid]]] = False
+    return keep
+
+
+class EventIndex:
+    '''
+    Keys of every event stored in a collection folder, loaded from <save_location>/event_index/ (built from the
+    day files on first use)
+    new_rows(keys) says which events of a batch are not stored yet, add(day, keys) records a written day
+    Keys are held as one big sorted array plus a small unsorted pending one merged into it from time to time,
+    so adding a day does not re-sort the whole index
+    '''
+    def __init__(self, save_location):
+        self.save_location = save_location
+        self.folder = os.path.join(save_location, 'event_index')
+        self.days = {}
+        if os.path.isdir(self.folder) and self.stored_format() == FORMAT:
+            for filename in os.listdir(self.folder):
+                if filename.endswith('.npy'):
+                    self.days[date.fromisoformat(filename[:-len('.npy')])] = np.load(
+                        os.path.join(self.folder, filename), allow_pickle=False)
+            self.reset()
+        else:
+            self.rebuild()
+
+    def stored_format(self):
+        try:
+            with open(os.path.join(self.folder, 'format')) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def reset(self):
+        keys = [keys for keys in self.days.values()]
+        self.known = np.unique(np.concatenate(keys)) if keys else np.array([], dtype='uint64')
+        self.pending = np.array([], dtype='uint64')
+
+    def __len__(self):
+        return len(self.known) + len(self.pending)
+
+    def contains(self, keys, replacing=None):
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.known):
+            position = np.minimum(np.searchsorted(self.known, keys), len(self.known) - 1)
+            found = self.known[position] == keys
+        if len(self.pending):
+            found |= np.isin(keys, self.pending)
+        if replacing in self.days:
+            found &= ~np.isin(keys, self.days[replacing])
+        return found & (keys != NO_KEY)
+
+    def new_rows(self, keys, replacing=None):
+        '''
+        Mask of the rows of (id keys, composite keys) that are neither stored nor repeated earlier in the batch
+        Events stored in the day file of replacing (a day about to be rewritten) count as not stored
+        '''
+        id_keys, composite = keys
+        return first_rows(id_keys, composite) & ~self.contains(id_keys, replacing) & \
+            ~self.contains(composite, replacing)
+
+    def filter_events(self, events, replacing=None):
+        '''
+        (raw events not stored yet, their keys), see new_rows for replacing
+        '''
+        keys = event_keys(events)
+        keep = self.new_rows(keys, replacing)
+        return [event for event, kept in zip(events, keep) if kept], tuple(values[keep] for values in keys)
+
+    def filter_columns(self, columns, replacing=None):
+        '''
+        ({column: array} of the events not stored yet, their keys), see new_rows for replacing
+        '''
+        keys = column_keys(columns)
+        keep = self.new_rows(keys, replacing)
+        return {name: values[keep] for name, values in columns.items()}, tuple(values[keep] for values in keys)
+
+    def add(self, day, keys, rows=None):
+        '''
+        Record the events (optionally only rows) of keys as stored in the day file of day
+        '''
+        added = np.concatenate([values if rows is None else values[rows] for values in keys])
+        added = added[added != NO_KEY]
+        stored = np.union1d(self.days.get(day, np.array([], dtype='uint64')), added)
+        self.days[day] = stored
+        self.write_day(day)
+        self.pending = np.concatenate([self.pending, added])
+        if len(self.pending) > max(100000, len(self.known) // 4):
+            self.known = np.union1d(self.known, self.pending)
+            self.pending = np.array([], dtype='uint64')
+
+    def remove_day(self, day):
+        '''
+        Forget the events of a day file that is about to be replaced
+        '''
+        if day in self.days:
+            del self.days[day]
+            os.remove(os.path.join(self.folder, str(day) + '.npy'))
+            self.reset()
+
+    def write_day(self, day):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, str(day) + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, self.days[day], allow_pickle=False)
+        os.replace(path + '.tmp', path)
+
+    def rebuild(self, clean=False):
+        '''
+        Index every day file of the collection from scratch, in date order
+        clean rewrites the day files without the events already stored in an earlier day (or earlier in the
+        same day), which removes the duplicates left by runs made before the index existed
+        Returns the number of events dropped
+        '''
+        self.days = {}
+        self.reset()
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+        with open(os.path.join(self.folder, 'format'), 'w') as f:
+            f.write(FORMAT)
+        dropped = 0
+        file_days = event_file_days(self.save_location) if os.path.isdir(self.save_location) else {}
+        for day, kind in sorted(file_days.items()):
+            if kind == 'columnar':
+                columns = read_event_day(self.save_location, day, decode=False)
+                keys = column_keys(columns)
+            else:
+                path = str(self.save_location) + 'assets_events_list_' + str(day) + '.npz'
+                events = list(np.load(path, allow_pickle=True)['arr_0'])
+                keys = event_keys(events)
+            keep = self.new_rows(keys)
+            if clean and not keep.all():
+                dropped += int((~keep).sum())
+                if kind == 'columnar':
+                    write_event_day(self.save_location, day, {name: columns[name][keep] for name in EVENT_COLUMNS})
+                else:
+                    np.savez(path, [event for event, kept in zip(events, keep) if kept])
+                self.add(day, keys, keep)
+            else:
+                self.add(day, keys)
+        return dropped
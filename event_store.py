@@ -0,0 +1,210 @@
+# Columnar storage for events: one folder per collection (the save_location), one sub folder per day,
+# one typed .npy file per column, so nothing needs unpickling and a reader only opens the columns it wants
+#   <save_location>/events/2021-08-01/timestamp.npy, total_price.npy, ...
+from datetime import date
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+from checkpoint import event_file, merge_day_file
+from helpers import parse_events_batch
+
+# column name -> numpy dtype, strings are stored as utf-8 bytes ('S') and sized per day file
+EVENT_COLUMNS = {'id': 'int64',
+                 'event_type': 'S',
+                 'timestamp': 'datetime64[s]',
+                 'token_id': 'S',
+                 'is_bundle': 'bool',
+                 'auction_type': 'S',
+                 'total_price': 'float64',
+                 'starting_price': 'float64',
+                 'payment_token': 'S',
+                 'usd_price': 'float64',
+                 'seller_address': 'S',
+                 'seller_username': 'S',
+                 'buyer_address': 'S',
+                 'buyer_username': 'S',
+                 'from_address': 'S',
+                 'transaction_hash': 'S'}
+STRING_COLUMNS = [name for name, dtype in EVENT_COLUMNS.items() if dtype == 'S']
+
+
+def string_column(values):
+    # utf-8 bytes, missing strings are stored empty
+    if len(values) == 0:
+        return np.array([], dtype='S1')
+    return np.char.encode(np.array(['' if value is None else str(value) for value in values], dtype='U'), 'utf-8')
+
+
+def events_to_columns(events):
+    '''
+    Flatten raw /events dicts into {column: typed array} with helpers.parse_events_batch, for every event type
+    timestamp is when the event occurred (created_date), bundle token ids are joined with ','
+    '''
+    parsed = parse_events_batch(events)
+    token_ids = [','.join(str(token_id) for token_id in assets_id) if bundled else assets_id
+                 for assets_id, bundled in zip(parsed['assets_id'], parsed['is_bundle'])]
+    columns = {'id': parsed['id'],
+               'event_type': string_column(parsed['event_type']),
+               'timestamp': parsed['created_date'],
+               'token_id': string_column(token_ids),
+               'is_bundle': parsed['is_bundle']}
+    for name in EVENT_COLUMNS:
+        if name not in columns:
+            if EVENT_COLUMNS[name] == 'S':
+                columns[name] = string_column(parsed[name])
+            else:
+                columns[name] = parsed[name]
+    return columns
+
+
+def day_folder(save_location, day):
+    return os.path.join(save_location, 'events', str(day))
+
+
+def event_days(save_location):
+    '''
+    Days stored in columnar form for a collection, sorted
+    '''
+    folder = os.path.join(save_location, 'events')
+    if not os.path.isdir(folder):
+        return []
+    return sorted(date.fromisoformat(name) for name in os.listdir(folder) if len(name) == 10 and
+                  os.path.isfile(os.path.join(folder, name, 'id.npy')))
+
+
+def read_event_day(save_location, day, columns=None, mmap=False, decode=True):
+    '''
+    Read the requested columns of one day, mmap memory-maps the files instead of reading them
+    decode turns the byte string columns into str arrays
+    '''
+    folder = day_folder(save_location, day)
+    result = {}
+    for name in columns or EVENT_COLUMNS:
+        values = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r' if mmap else None, allow_pickle=False)
+        if decode and name in STRING_COLUMNS:
+            values = np.char.decode(values, 'utf-8')
+        result[name] = values
+    return result
+
+
+def write_event_day(save_location, day, columns):
+    '''
+    Write a day's columns, replacing any previous version of the day in one step
+    '''
+    folder = day_folder(save_location, day)
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_folder, name + '.npy'), values, allow_pickle=False)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+
+def concat_columns(parts, columns=None):
+    '''
+    Concatenate a list of {column: array} dicts, string columns are widened to the largest width
+    '''
+    names = columns or EVENT_COLUMNS
+    if not parts:
+        return {name: np.array([], dtype=EVENT_COLUMNS[name] if EVENT_COLUMNS[name] != 'S' else 'U1')
+                for name in names}
+    return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+
+def merge_columns(old, new):
+    '''
+    Append new to old dropping events whose id is already present, events without id are always kept
+    '''
+    seen = set(old['id'][old['id'] >= 0].tolist())
+    keep = np.array([event_id < 0 or event_id not in seen for event_id in new['id'].tolist()], dtype=bool)
+    return {name: np.concatenate([old[name], new[name][keep]]) for name in EVENT_COLUMNS}
+
+
+def stored_rows(path):
+    '''
+    Number of events of a stored day (a columnar folder or an .npz file) read from the .npy header alone, the
+    columns or pickled events are not loaded
+    '''
+    if os.path.isdir(path):
+        f = open(os.path.join(path, 'id.npy'), 'rb')
+    else:
+        f = zipfile.ZipFile(path).open('arr_0.npy')
+    with f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            shape = np.lib.format.read_array_header_1_0(f)[0]
+        else:
+            shape = np.lib.format.read_array_header_2_0(f)[0]
+    return shape[0]
+
+
+def save_event_day(save_location, day, events, storage='npz', merge=True, index=None):
+    '''
+    Save one day's raw events either as the original assets_events_list_<date>.npz ('npz')
+    or as typed columns ('columnar'), merging with what is already stored for the day when merge is set
+    index (an event_index.EventIndex of the save_location) drops the events already stored in any day file
+    of the collection, or repeated within events, and records the ones written
+    Returns the path written (None for a day without events) and the number of events stored
+    '''
+    if storage == 'columnar':
+        path = day_folder(save_location, day)
+        exists = merge and os.path.isdir(path)
+        columns = events_to_columns(events)
+        if index is not None:
+            # a day that is replaced keeps its index entries until the new file is written
+            columns, keys = index.filter_columns(columns, None if exists else day)
+            if exists and len(columns['id']) == 0:
+                return path, stored_rows(path)
+        if exists:
+            columns = merge_columns(read_event_day(save_location, day, decode=False), columns)
+        if len(columns['id']) == 0:
+            return None, 0
+        write_event_day(save_location, day, columns)
+        if index is not None:
+            if not exists:
+                index.remove_day(day)
+            index.add(day, keys)
+        print(str(len(columns['id'])) + " events saved to" + path)
+        return path, len(columns['id'])
+
+    path = event_file(save_location, day)
+    exists = merge and os.path.isfile(path)
+    if index is not None:
+        events, keys = index.filter_events(events, None if exists else day)
+        if exists and len(events) == 0:
+            return path, stored_rows(path)
+    if merge:
+        events = merge_day_file(save_location, day, events)
+    if len(events) == 0:
+        return None, 0
+    np.savez(path, events)
+    if index is not None:
+        if not exists:
+            index.remove_day(day)
+        index.add(day, keys)
+    print(str(len(events)) + " events saved to" + path)
+    return path, len(events)
+
+
+def convert_event_files(save_location, index=None):
+    '''
+    Convert every assets_events_list_<date>.npz of a collection folder into the columnar layout
+    The converted days replace their entries in index (the save_location's event_index.EventIndex by default)
+    '''
+    # event_index imports this module
+    from event_index import EventIndex, column_keys
+
+    index = index or EventIndex(save_location)
+    for filename in sorted(os.listdir(save_location)):
+        if filename.startswith('assets_events_list_') and filename.endswith('.npz'):
+            day = date.fromisoformat(filename[len('assets_events_list_'):-len('.npz')])
+            events = np.load(os.path.join(save_location, filename), allow_pickle=True)['arr_0']
+            columns = events_to_columns(events)
+            write_event_day(save_location, day, columns)
+            index.remove_day(day)
+            index.add(day, column_keys(columns))
@@ -0,0 +1,200 @@
+# Feature matrix for trait ML (UMAP, regression): a sparse one-hot asset x trait value matrix from an asset
+# snapshot joined with per token sales aggregates, cached next to the snapshot and keyed by its date
+#   features = feature_matrix(save_location, 'animeta')
+#   embedding = umap.UMAP().fit_transform(features.to_scipy())      (or features.to_dense() without scipy)
+# The one-hot part stays CSR (indptr / indices, every stored value is 1) so 10k tokens x hundreds of values
+# cost a few hundred KB instead of a dense float matrix
+from datetime import date
+import hashlib
+import os
+
+import numpy as np
+
+from analytics import day_fingerprint
+from helpers import parse_assets_batch
+from load import event_file_days, load_assets_snapshot, query_events, snapshot_sources, snapshot_stamp
+from rarity import MISSING, build_trait_index, trait_counts, trait_index
+
+# num_sales is the count the API reports in the snapshot, stored_sales the sale events downloaded up to its day
+SALES_FEATURES = ['last_price', 'num_sales', 'days_since_last_sale', 'stored_sales']
+
+
+class FeatureMatrix:
+    '''
+    Row i is asset_id[i]: one-hot trait columns indices[indptr[i]:indptr[i + 1]] (named in columns as
+    'trait_type=value') and the dense sales aggregates dense[i] (named in dense_columns)
+    '''
+    def __init__(self, asset_id, indptr, indices, columns, dense, dense_columns, snapshot_date, fingerprint=''):
+        self.asset_id = asset_id
+        self.indptr = indptr
+        self.indices = indices
+        self.columns = columns
+        self.dense = dense
+        self.dense_columns = dense_columns
+        self.snapshot_date = snapshot_date
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.asset_id)
+
+    @property
+    def shape(self):
+        return len(self.asset_id), len(self.columns) + len(self.dense_columns)
+
+    @property
+    def feature_names(self):
+        return list(self.columns) + list(self.dense_columns)
+
+    def to_scipy(self, sales=True):
+        '''
+        scipy.sparse.csr_matrix of the one-hot traits, followed by the sales aggregates when sales is set
+        Needs scipy
+        '''
+        from scipy import sparse
+
+        onehot = sparse.csr_matrix((np.ones(len(self.indices), dtype='float32'), self.indices, self.indptr),
+                                   shape=(len(self), len(self.columns)))
+        if not sales:
+            return onehot
+        return sparse.hstack([onehot, sparse.csr_matrix(self.dense.astype('float32'))], format='csr')
+
+    def to_dense(self, sales=True):
+        '''
+        Dense float32 array of the same matrix, for small collections or libraries without sparse input
+        '''
+        matrix = np.zeros((len(self), len(self.columns)), dtype='float32')
+        matrix[np.repeat(np.arange(len(self)), np.diff(self.indptr)), self.indices] = 1
+        if not sales:
+            return matrix
+        return np.hstack([matrix, self.dense.astype('float32')])
+
+    def save(self, path):
+        np.savez(path, asset_id=self.asset_id, indptr=self.indptr, indices=self.indices, columns=self.columns,
+                 dense=self.dense, dense_columns=self.dense_columns, snapshot_date=np.array(str(self.snapshot_date)),
+                 fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['asset_id'], data['indptr'], data['indices'], data['columns'], data['dense'],
+                       data['dense_columns'], date.fromisoformat(str(data['snapshot_date'])), str(data['fingerprint']))
+
+
+def onehot_traits(index, include_missing=True):
+    '''
+    (indptr, indices, column names) of the one-hot trait matrix of a rarity.TraitIndex, with one more
+    'trait_type=<none>' column per type some assets lack when include_missing is set
+    '''
+    n = len(index)
+    names = np.char.add(np.char.add(index.trait_types[index.trait_type], '='), index.trait_value)
+    if not include_missing:
+        return index.indptr, index.indices, names
+    counts, missing, present, trait_number = trait_counts(index)
+    has_missing = np.flatnonzero(missing > 0)
+    # extra entries (row, column) for the missing types, merged row by row with the existing ones
+    rows, types = np.nonzero(~present[:, has_missing])
+    extra_columns = len(names) + types
+    all_rows = np.concatenate([index.rows, rows])
+    all_columns = np.concatenate([index.indices.astype('int64'), extra_columns])
+    order = np.lexsort((all_columns, all_rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(all_rows, minlength=n))])
+    names = np.concatenate([names, np.char.add(index.trait_types[has_missing], '=' + MISSING)])
+    return indptr, all_columns[order].astype('int32'), names
+
+
+def snapshot_num_sales(assets, asset_id):
+    '''
+    num_sales of the snapshot assets in asset_id order, NaN where the API did not report it
+    '''
+    parsed = parse_assets_batch(assets)
+    ids = np.array([str(token_id) for token_id in parsed['asset_id']], dtype='U')
+    num_sales = np.full(len(asset_id), np.nan)
+    if len(ids):
+        order = np.argsort(ids)
+        position = order[np.minimum(np.searchsorted(ids, asset_id, sorter=order), len(ids) - 1)]
+        found = (ids[position] == asset_id) & (parsed['num_sales'][position] >= 0)
+        num_sales[found] = parsed['num_sales'][position[found]]
+    return num_sales
+
+
+def sales_features(save_location, asset_id, as_of, num_sales=None):
+    '''
+    Per asset sales aggregates (SALES_FEATURES) up to the end of the day as_of: last price in ETH, num_sales
+    (given from the snapshot, NaN when missing), days since the last sale (NaN for assets never sold) and the
+    number of stored sales
+    '''
+    n = len(asset_id)
+    dense = np.zeros((n, len(SALES_FEATURES)))
+    dense[:, 0] = np.nan
+    dense[:, 1] = np.nan if num_sales is None else num_sales
+    dense[:, 2] = np.nan
+    if not os.path.isdir(save_location) or not event_file_days(save_location):
+        return dense
+    sales = query_events(save_location, end_date=as_of, event_types=['successful'],
+                         columns=['timestamp', 'token_id', 'total_price'])
+    order = np.argsort(asset_id)
+    position = np.minimum(np.searchsorted(asset_id, sales['token_id'], sorter=order), max(n - 1, 0))
+    rows = order[position] if n else position
+    known = (asset_id[rows] == sales['token_id']) & ~np.isnat(sales['timestamp']) if n else np.zeros(0, bool)
+    rows, stamps, prices = rows[known], sales['timestamp'][known], sales['total_price'][known] / 10. ** 18
+    dense[:, 3] = np.bincount(rows, minlength=n)
+    if len(rows):
+        # the last sale of every asset is the last of its rows in (asset, time) order
+        by_time = np.lexsort((stamps, rows))
+        last = by_time[np.concatenate([rows[by_time][1:] != rows[by_time][:-1], [True]])]
+        end = np.datetime64(as_of, 'D') + np.timedelta64(1, 'D')
+        dense[rows[last], 0] = prices[last]
+        dense[rows[last], 2] = (end - stamps[last]) / np.timedelta64(1, 'D')
+    return dense
+
+
+def snapshot_source(save_location, asset_name, snapshot_date=None):
+    # (date, load.snapshot_stamp) of the snapshot that load_assets_snapshot picks for snapshot_date, (None, '')
+    # without one
+    sources = {day: path for day, (kind, path) in snapshot_sources(save_location, asset_name).items()
+               if snapshot_date is None or day <= snapshot_date}
+    if not sources:
+        return None, ''
+    return max(sources), snapshot_stamp(sources[max(sources)])
+
+
+def sales_fingerprint(save_location, as_of):
+    # changes when a day file up to as_of is added or saved again, so cached sales aggregates are rebuilt
+    file_days = event_file_days(save_location) if os.path.isdir(save_location) else {}
+    text = ','.join(str(day) + ':' + str(day_fingerprint(save_location, day, kind))
+                    for day, kind in sorted(file_days.items()) if day <= as_of)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def feature_file(save_location, asset_name, snapshot_date):
+    return save_location + asset_name + '_features' + str(snapshot_date) + '.npz'
+
+
+def feature_matrix(save_location, asset_name="animeta", snapshot_date=None, include_missing=True, rebuild=False):
+    '''
+    FeatureMatrix of the full asset snapshot taken on or before snapshot_date (default the latest) with the
+    sales aggregates as of that day, cached as <asset_name>_features<date>.npz and reused until a day file up to
+    that date or the snapshot itself changes
+    '''
+    file_date, source = snapshot_source(save_location, asset_name, snapshot_date)
+    if file_date is None:
+        raise FileNotFoundError('no ' + asset_name + ' asset snapshot in ' + str(save_location))
+    path = feature_file(save_location, asset_name, file_date)
+    fingerprint = sales_fingerprint(save_location, file_date) + ':' + source + ('' if include_missing else '-present')
+    if not rebuild and os.path.isfile(path):
+        features = FeatureMatrix.load(path)
+        if features.fingerprint == fingerprint and list(features.dense_columns) == SALES_FEATURES:
+            return features
+    assets = load_assets_snapshot(save_location, asset_name, file_date)
+    if file_date == snapshot_source(save_location, asset_name)[0]:
+        # the latest snapshot already has a persisted trait index, picked by the same date in the file name
+        index = trait_index(save_location, asset_name)
+    else:
+        index = build_trait_index(assets, source)
+    indptr, indices, columns = onehot_traits(index, include_missing)
+    features = FeatureMatrix(index.asset_id, indptr, indices, columns,
+                             sales_features(save_location, index.asset_id, file_date,
+                                            snapshot_num_sales(assets, index.asset_id)),
+                             np.array(SALES_FEATURES), file_date, fingerprint)
+    features.save(path)
+    return features
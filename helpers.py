@@ -1,3 +1,5 @@
+import numpy as np
+
 # Parse asset data retrieved from OpenSea, reference https://docs.opensea.io/reference/
 # Additional info on data sources https://www.figma.com/file/mIN2XA1vSH2HktxQ0dDH7z/TheOracle_Data?node-id=0%3A1
 
@@ -87,6 +89,95 @@ def parse_events_data(event_dict):
     return result
 
 
+# Batch versions of parse_assets_data / parse_events_data: take a whole page or day of raw records and return
+# {column: numpy array} (or a DataFrame with as_frame=True) instead of one dict per record, for every event type
+# Missing nested fields (seller.user, winner_account, asset_bundle, payment_token, transaction, ...) become None / NaN
+# through `or {}` lookups rather than exceptions
+# The records are nested Python dicts, so reading them stays a Python loop: one pass builds a tuple per record, numpy
+# turns the tuples into a 2D object table in C and the columns are its slices, typed (ints, floats, datetime64) on
+# the whole column. A comprehension per field is slower here, every field walks all the records again
+EMPTY = {}
+
+
+def batch_result(columns, as_frame):
+    if as_frame:
+        import pandas as pd
+        return pd.DataFrame(columns)
+    return columns
+
+
+def object_table(rows, names):
+    # rows may hold lists (traits, bundle token ids), filling an empty table keeps them as single cells
+    table = np.empty((len(rows), len(names)), dtype=object)
+    if rows:
+        table[:] = rows
+    return {name: table[:, i] for i, name in enumerate(names)}
+
+
+ASSET_BATCH_COLUMNS = ['asset_id', 'creator_username', 'creator_address', 'owner_username', 'owner_address', 'traits',
+                       'num_sales']
+
+
+def parse_assets_batch(assets, as_frame=False):
+    rows = []
+    append = rows.append
+    for asset in assets:
+        get = asset.get
+        creator = get('creator') or EMPTY
+        owner = get('owner') or EMPTY
+        num_sales = get('num_sales')
+        append((get('token_id'), (creator.get('user') or EMPTY).get('username'), creator.get('address'),
+                (owner.get('user') or EMPTY).get('username'), owner.get('address'), get('traits') or [],
+                # -1 when the API did not report num_sales
+                -1 if num_sales is None else num_sales))
+    columns = object_table(rows, ASSET_BATCH_COLUMNS)
+    columns['num_sales'] = columns['num_sales'].astype('int64')
+    return batch_result(columns, as_frame)
+
+
+# Same fields as parse_events_data (except the raw 'asset' dict) plus id, event_type, created_date, starting_price and
+# from_address so every event type can go through it, not only sales
+# created_date is datetime64[s] (NaT when missing), the transaction timestamp stays a string like in parse_events_data
+EVENT_BATCH_COLUMNS = ['id', 'event_type', 'created_date', 'is_bundle', 'assets_id', 'auction_type', 'seller_address',
+                       'buyer_address', 'from_address', 'buyer_username', 'seller_username', 'timestamp',
+                       'total_price', 'starting_price', 'payment_token', 'usd_price', 'transaction_hash']
+
+
+def parse_events_batch(events, as_frame=False):
+    rows = []
+    append = rows.append
+    for event in events:
+        get = event.get
+        asset = get('asset') or EMPTY
+        seller = get('seller') or EMPTY
+        winner = get('winner_account') or EMPTY
+        payment_token = get('payment_token') or EMPTY
+        transaction = get('transaction') or EMPTY
+        event_id = get('id')
+        is_bundle = False
+        assets_id = asset.get('token_id')
+        if not asset:
+            bundle = (get('asset_bundle') or EMPTY).get('assets')
+            if bundle:
+                is_bundle = True
+                assets_id = [item['token_id'] for item in bundle]
+        append((-1 if event_id is None else event_id, get('event_type'), get('created_date'), is_bundle, assets_id,
+                get('auction_type'), seller.get('address'), winner.get('address'),
+                (get('from_account') or EMPTY).get('address'), (winner.get('user') or EMPTY).get('username'),
+                (seller.get('user') or EMPTY).get('username'), transaction.get('timestamp'),
+                get('total_price') or 'nan', get('starting_price') or 'nan', payment_token.get('symbol'),
+                payment_token.get('usd_price') or 'nan', transaction.get('transaction_hash')))
+
+    columns = object_table(rows, EVENT_BATCH_COLUMNS)
+    columns['id'] = columns['id'].astype('int64')
+    columns['is_bundle'] = columns['is_bundle'].astype(bool)
+    # microseconds are parsed and dropped, None becomes NaT
+    columns['created_date'] = columns['created_date'].astype('datetime64[us]').astype('datetime64[s]')
+    for name in ['total_price', 'starting_price', 'usd_price']:
+        columns[name] = columns[name].astype('float64')
+    return batch_result(columns, as_frame)
+
+
 # legacy function
 def parse_animetas_data(animetas_dict):
     animetas_id = animetas_dict['token_id']
@@ -1,15 +1,22 @@
-from helpers import parse_assets_data, parse_sale_data, parse_listing_data
-from datetime import date, timedelta, datetime
+from event_store import event_days, read_event_day, concat_columns, events_to_columns, EVENT_COLUMNS, STRING_COLUMNS
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from multiprocessing import resource_tracker, shared_memory
+from snapshots import load_snapshot_view, snapshot_files
 
+import json
 import numpy as np
-import requests
-import time
 import os
 import glob
+import re
 
 
 # load most recent saved version of assets
+# a streamed or delta snapshot newer than every _list<date>.npz is loaded through load_assets_snapshot
 def load_assets_info(save_location, asset_name="animeta"):
+    sources = snapshot_sources(save_location, asset_name)
+    if sources and sources[max(sources)][0] != 'list':
+        return load_assets_snapshot(save_location, asset_name)
     files = glob.glob(str(save_location) + asset_name + '_list' + '????-??-??.npz')
     listofassets = np.load(max(files, key=os.path.getctime), allow_pickle=True)['arr_0']
     return listofassets
@@ -26,4 +33,229 @@ def load_events_info(save_location):
     # flatten into one list
     all_events = [item for sublist in all_events for item in sublist]
 
-    return all_events
\ No newline at end of file
+    return all_events
+
+
+# load the columnar events of a collection (see event_store), only the columns asked for are read
+# e.g. load_events_columns(save_location, columns=['timestamp', 'total_price'])
+def load_events_columns(save_location, columns=None):
+    days = event_days(save_location)
+    parts = [read_event_day(save_location, day, columns) for day in days]
+    return concat_columns(parts, columns)
+
+
+# dates of the day files/folders of a collection, taken from the names so nothing has to be opened
+def event_file_days(save_location):
+    days = {}
+    for filename in os.listdir(save_location):
+        match = re.fullmatch(r'assets_events_list_(\d{4}-\d{2}-\d{2})\.npz', filename)
+        if match:
+            days[date.fromisoformat(match.group(1))] = 'npz'
+    # columnar days win over the pickled file of the same day
+    for day in event_days(save_location):
+        days[day] = 'columnar'
+    return days
+
+
+# stream events one day at a time, restricted to a date range (inclusive), event types and token ids
+# days outside the range are pruned by name before opening, columnar days are memory-mapped and only the
+# requested columns plus the ones needed for filtering are touched, older .npz days are flattened on the fly
+# yields (day, {column: array}) with only the matching rows, string columns as str unless decode is False
+def iter_events(save_location, start_date=None, end_date=None, event_types=None, token_ids=None, columns=None,
+                mmap=True, decode=True):
+    columns = list(columns or EVENT_COLUMNS)
+    needed = list(columns)
+    if event_types is not None and 'event_type' not in needed:
+        needed.append('event_type')
+    if token_ids is not None and 'token_id' not in needed:
+        needed.append('token_id')
+    wanted_types = np.array([str(e_type).encode() for e_type in event_types or []], dtype='S')
+    wanted_tokens = np.array([str(token_id).encode() for token_id in token_ids or []], dtype='S')
+
+    file_days = event_file_days(save_location)
+    for day in sorted(file_days):
+        if (start_date is not None and day < start_date) or (end_date is not None and day > end_date):
+            continue
+        if file_days[day] == 'columnar':
+            data = read_event_day(save_location, day, needed, mmap=mmap, decode=False)
+        else:
+            events = np.load(str(save_location) + 'assets_events_list_' + str(day) + '.npz',
+                             allow_pickle=True)['arr_0']
+            data = events_to_columns(events)
+        mask = np.ones(len(data[needed[0]]), dtype=bool)
+        if event_types is not None:
+            mask &= np.isin(data['event_type'], wanted_types)
+        if token_ids is not None:
+            mask &= np.isin(data['token_id'], wanted_tokens)
+        if not mask.any():
+            continue
+        selected = {}
+        for name in columns:
+            values = data[name][mask]
+            selected[name] = np.char.decode(values, 'utf-8') if decode and name in STRING_COLUMNS else values
+        yield day, selected
+
+
+# same filters as iter_events but combined into one {column: array}
+# e.g. last 7 days of sales: query_events(save_location, start_date=date.today() - timedelta(days=7),
+#                                         event_types=['successful'], columns=['timestamp', 'total_price'])
+# workers > 1 reads and parses the day files in that many processes (see query_events_parallel), worth it for the
+# pickled .npz days whose parsing is CPU bound on a machine with spare cores, columnar days are mostly I/O
+def query_events(save_location, start_date=None, end_date=None, event_types=None, token_ids=None, columns=None,
+                 mmap=True, workers=None):
+    if workers is not None and workers > 1:
+        return query_events_parallel(save_location, start_date, end_date, event_types, token_ids, columns, workers)
+    parts = [part for day, part in iter_events(save_location, start_date, end_date, event_types, token_ids, columns,
+                                               mmap)]
+    return concat_columns(parts, columns)
+
+
+# worker of query_events_parallel: read and parse one day file with iter_events and copy every column into a new
+# shared memory block, only {column: (block name, dtype, shape)} goes back through the pipe instead of the arrays
+# string columns stay utf-8 bytes (decoded by take_shared), a U copy would be 4x their size
+# blocks created before an error are unlinked here, the parent never hears of them
+def load_day_shared(save_location, day, event_types, token_ids, columns):
+    blocks = {}
+    try:
+        for _, selected in iter_events(save_location, day, day, event_types, token_ids, columns, mmap=False,
+                                       decode=False):
+            for name, values in selected.items():
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                try:
+                    blocks[name] = (block.name, values.dtype.str, values.shape)
+                    np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+                finally:
+                    block.close()
+    except BaseException:
+        unlink_shared(blocks)
+        raise
+    return blocks
+
+
+def unlink_shared(blocks):
+    for block_name, dtype, shape in blocks.values():
+        try:
+            block = shared_memory.SharedMemory(name=block_name)
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+
+# copy the columns of a load_day_shared result out of shared memory and free the blocks, all of them even when a
+# copy fails, string columns are decoded here
+def take_shared(blocks):
+    part = {}
+    try:
+        for name, (block_name, dtype, shape) in blocks.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            try:
+                values = np.ndarray(shape, dtype, buffer=block.buf).copy()
+            finally:
+                block.close()
+                block.unlink()
+            part[name] = np.char.decode(values, 'utf-8') if name in STRING_COLUMNS else values
+    finally:
+        unlink_shared({name: blocks[name] for name in blocks if name not in part})
+    return part
+
+
+# processes worth starting for days day files: a pool costs process start up and a copy of every column, it only
+# pays with two or more cores and days to spread over them
+def pool_workers(days, workers=None):
+    return min(workers or os.cpu_count() or 1, os.cpu_count() or 1, days)
+
+
+# query_events over a process pool of workers, one day file per task, parts come back through shared memory
+# and are concatenated in day order, the result is the same as the single process query_events
+# when pool_workers leaves fewer than 2 processes the days are read by query_events in this process instead,
+# fallback=False always starts the pool (benchmarks.py parallel_load)
+def query_events_parallel(save_location, start_date=None, end_date=None, event_types=None, token_ids=None,
+                          columns=None, workers=None, fallback=True):
+    days = [day for day in sorted(event_file_days(save_location)) if (start_date is None or day >= start_date) and
+            (end_date is None or day <= end_date)]
+    if fallback:
+        workers = pool_workers(len(days), workers)
+        if workers < 2:
+            return query_events(save_location, start_date, end_date, event_types, token_ids, columns)
+    # workers share the parent's tracker, so blocks unlinked here are not reported as leaked when they exit
+    resource_tracker.ensure_running()
+    parts = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_day_shared, save_location, day, event_types, token_ids, columns)
+                   for day in days]
+        taken = 0
+        try:
+            for future in futures:
+                parts.append(take_shared(future.result()))
+                taken += 1
+        finally:
+            # a failed day still lets the blocks of the other days be freed
+            for future in futures[taken:]:
+                if not future.cancel() and future.exception() is None:
+                    unlink_shared(future.result())
+    return concat_columns([part for part in parts if part], columns)
+
+
+# snapshots of a collection by day: {date: (kind, path)} with kind 'list' for <asset_name>_list<date>.npz,
+# 'columns' for the <asset_name>_assets<date>/ folders of pipeline.stream_asset_info and 'delta' for the days of
+# the base and diff files of snapshots.py, a full list wins over the other kinds on the same day
+def snapshot_sources(save_location, asset_name="animeta"):
+    sources = {}
+    for day, kind, path in snapshot_files(save_location, asset_name, since_base=False):
+        sources[day] = ('delta', path)
+    for path in glob.glob(str(save_location) + asset_name + '_assets' + '????-??-??'):
+        if os.path.isdir(path):
+            sources[date.fromisoformat(path[-len('????-??-??'):])] = ('columns', path)
+    for path in glob.glob(str(save_location) + asset_name + '_list' + '????-??-??.npz'):
+        sources[date.fromisoformat(path[-len('????-??-??.npz'):-len('.npz')])] = ('list', path)
+    return sources
+
+
+# name, size and modification time of a snapshot source, changes when the same day is downloaded again
+def snapshot_stamp(path):
+    stat = os.stat(path)
+    return os.path.basename(path) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns)
+
+
+# raw asset dicts (only the fields parse_assets_batch reads) of snapshot columns: a delta view or the folder of
+# stream_asset_info, where missing strings are '' and a missing num_sales is -1
+def columns_to_assets(columns):
+    def text(name):
+        values = columns[name]
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'utf-8')
+        return [value or None for value in values.tolist()]
+    assets = []
+    for token_id, owner_address, owner_username, creator_address, creator_username, num_sales, traits in zip(
+            text('asset_id'), text('owner_address'), text('owner_username'), text('creator_address'),
+            text('creator_username'), columns['num_sales'].tolist(), text('traits')):
+        assets.append({'token_id': token_id,
+                       'owner': {'address': owner_address, 'user': {'username': owner_username}},
+                       'creator': {'address': creator_address, 'user': {'username': creator_username}},
+                       'num_sales': None if num_sales < 0 else num_sales,
+                       'traits': json.loads(traits) if traits else []})
+    return assets
+
+
+# load the asset snapshot taken on or before snapshot_date (default the newest), chosen by the date in the file
+# name rather than the file time, optionally keeping only some token ids
+# full lists give the raw assets, streamed and delta snapshots the fields they keep (see columns_to_assets)
+def load_assets_snapshot(save_location, asset_name="animeta", snapshot_date=None, token_ids=None):
+    sources = {day: source for day, source in snapshot_sources(save_location, asset_name).items()
+               if snapshot_date is None or day <= snapshot_date}
+    if not sources:
+        return []
+    day = max(sources)
+    kind, path = sources[day]
+    if kind == 'list':
+        listofassets = np.load(path, allow_pickle=True)['arr_0']
+    elif kind == 'columns':
+        listofassets = columns_to_assets({filename[:-len('.npy')]: np.load(os.path.join(path, filename))
+                                          for filename in os.listdir(path) if filename.endswith('.npy')})
+    else:
+        listofassets = columns_to_assets(load_snapshot_view(save_location, asset_name, day, decode=False))
+    if token_ids is not None:
+        wanted = {str(token_id) for token_id in token_ids}
+        listofassets = [asset for asset in listofassets if str(asset['token_id']) in wanted]
+    return listofassets
@@ -0,0 +1,180 @@
+# Concurrent image / metadata fetcher with a content-addressed cache
+#   urls = asset_media_urls(save_location, 'animeta')                     ({token_id: image_url} of the snapshot)
+#   paths = fetch_media(urls.values(), 'static/media/', thumbnail_size=128)
+# Files are stored once per content under <cache_dir>/objects/<sha256[:2]>/<sha256><ext>, urls.jsonl remembers
+# which url gave which file so a rerun (or another collection sharing images) downloads nothing twice
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+import requests
+
+from client import RetryPolicy, api_session
+from load import load_assets_snapshot
+from metrics import NullMetrics
+
+# content type -> extension kept on cached files, so image viewers and PIL recognise them
+EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/webp': '.webp',
+              'image/svg+xml': '.svg', 'video/mp4': '.mp4', 'application/json': '.json'}
+
+
+class MediaCache:
+    '''
+    Content-addressed store of downloaded files under cache_dir
+    get(url) is the path of a url fetched before (None otherwise), put(url, ...) moves a downloaded tmp file to
+    the path named after its sha256 and records the url in urls.jsonl, appended so a crash loses at most one line
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.urls = {}
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'urls.jsonl')
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.urls[entry['url']] = entry['file']
+
+    def path(self, digest, extension=''):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest + extension)
+
+    def get(self, url):
+        relative = self.urls.get(url)
+        if relative is None:
+            return None
+        path = os.path.join(self.cache_dir, relative)
+        return path if os.path.isfile(path) else None
+
+    def put(self, url, tmp_path, digest, extension=''):
+        path = self.path(digest, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isfile(path):
+            # same content from another url, keep the stored copy
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        relative = os.path.relpath(path, self.cache_dir)
+        with self.lock:
+            self.urls[url] = relative
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps({'url': url, 'file': relative}) + '\n')
+        return path
+
+
+def media_extension(url, content_type):
+    extension = EXTENSIONS.get((content_type or '').split(';')[0].strip())
+    if extension is None:
+        extension = os.path.splitext(url.split('?')[0])[1].lower()
+        if not 1 < len(extension) <= 5:
+            extension = mimetypes.guess_extension((content_type or '').split(';')[0].strip()) or ''
+    return extension
+
+
+def download_to_cache(http, cache, url, chunk_size=1 << 16):
+    '''
+    Stream url into the cache while hashing it, returns the cached path (None if the request failed)
+    '''
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(cache.cache_dir, 'objects', 'tmp_' + str(threading.get_ident()))
+    try:
+        # closed whatever happens, so a failed or half read stream does not hold on to its pooled connection
+        with http.request('GET', url, stream=True) as response:
+            if response.status_code != 200:
+                print('error', response.status_code, url)
+                return None
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    digest.update(chunk)
+                    f.write(chunk)
+    except requests.RequestException as error:
+        print('error', url, error)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return None
+    return cache.put(url, tmp_path, digest.hexdigest(), media_extension(url, response.headers.get('Content-Type')))
+
+
+def thumbnail(path, cache_dir, size=128):
+    '''
+    size x size PNG of an image (aspect kept, padded transparent) under <cache_dir>/thumbnails/<size>/, made once
+    Needs Pillow
+    '''
+    from PIL import Image
+
+    digest = os.path.splitext(os.path.basename(path))[0]
+    thumb_path = os.path.join(cache_dir, 'thumbnails', str(size), digest[:2], digest + '.png')
+    if os.path.isfile(thumb_path):
+        return thumb_path
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    with Image.open(path) as image:
+        image.thumbnail((size, size))
+        canvas = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+        canvas.paste(image.convert('RGBA'), ((size - image.width) // 2, (size - image.height) // 2))
+    canvas.save(thumb_path + '.tmp', format='PNG')
+    os.replace(thumb_path + '.tmp', thumb_path)
+    return thumb_path
+
+
+def fetch_media(urls, cache_dir, workers=16, thumbnail_size=None, session=None, retry=None, metrics=None):
+    '''
+    Download urls into a MediaCache at cache_dir with workers threads sharing one pooled session
+    Urls already in the cache are not requested again, empty urls are skipped
+    thumbnail_size also makes a square thumbnail of every image (see thumbnail, needs Pillow)
+    session, retry and metrics as for the download functions (client.api_session), retries default to 3
+    Returns {url: cached path, or thumbnail path when thumbnail_size is set, None when it failed}
+    '''
+    metrics = metrics or NullMetrics()
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    http = api_session(session, metrics, retry or RetryPolicy(max_retries=3))
+    cache = MediaCache(cache_dir)
+    urls = list(dict.fromkeys(url for url in urls if url))
+    paths = {url: cache.get(url) for url in urls}
+    missing = [url for url, path in paths.items() if path is None]
+    print(str(len(urls) - len(missing)) + " cached, fetching " + str(len(missing)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for url, path in zip(missing, executor.map(lambda url: download_to_cache(http, cache, url), missing)):
+            paths[url] = path
+    if thumbnail_size:
+        images = [url for url, path in paths.items() if path is not None and
+                  os.path.splitext(path)[1] in ('.png', '.jpg', '.gif', '.webp')]
+
+        def make_thumbnail(url):
+            try:
+                return thumbnail(paths[url], cache_dir, thumbnail_size)
+            except OSError as error:
+                # not an image Pillow can read, the original file is returned instead
+                print('error', url, error)
+                return paths[url]
+
+        with metrics.stage('thumbnail'), ThreadPoolExecutor(max_workers=workers) as executor:
+            for url, path in zip(images, executor.map(make_thumbnail, images)):
+                paths[url] = path
+    return paths
+
+
+def asset_media_urls(save_location, asset_name="animeta", snapshot_date=None, field='image_url'):
+    '''
+    {token_id: url} of field ('image_url', 'image_original_url', 'image_thumbnail_url', 'animation_url' or
+    'token_metadata') in the asset snapshot taken on or before snapshot_date (see load.load_assets_snapshot)
+    Streamed and delta snapshots do not keep urls, a day saved only in those layouts gives no urls
+    '''
+    return {str(asset['token_id']): asset.get(field) for asset in
+            load_assets_snapshot(save_location, asset_name, snapshot_date) if asset.get(field)}
+
+
+def search_image_urls(results, field='original'):
+    '''
+    Image urls of a SerpApi Google Images result (the dict of GoogleSearch(...).get_dict())
+    '''
+    return [image[field] for image in results.get('images_results', []) if image.get(field)]
@@ -0,0 +1,298 @@
+# Instrumentation for the downloaders: every API call (endpoint, window, status, latency, bytes, retries,
+# records returned) and the time spent per stage (wait / sleep / parse / write), sent to pluggable sinks
+#   metrics = Metrics(JsonLinesSink('crawl.jsonl'), PrometheusSink('crawl.prom'))
+#   download_event_info(save_location, metrics=metrics)
+#   metrics.close(); print(metrics.summary())
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from cache import canonical_params
+
+# upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = [.05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+# query parameters describing the window of a request, kept in the per request records
+WINDOW_PARAMS = ['event_type', 'occurred_after', 'occurred_before', 'offset', 'limit']
+
+
+def endpoint_name(url):
+    # last path segment of API urls, the host for anything else (e.g. media.py image downloads)
+    if '/api/' not in url:
+        return urlsplit(url).netloc or url
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def count_records(body):
+    # number of events / assets of a page, None for other bodies
+    if isinstance(body, dict):
+        for key in ['asset_events', 'assets']:
+            if isinstance(body.get(key), list):
+                return len(body[key])
+    return None
+
+
+class JsonLinesSink:
+    '''
+    Appends every record as one JSON line to path
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def flush(self, metrics):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusSink:
+    '''
+    Rewrites path with the Prometheus text format of the aggregated counters on every flush, for
+    node_exporter's textfile collector or a quick look with cat
+    '''
+    def __init__(self, path, prefix='opensea'):
+        self.path = path
+        self.prefix = prefix
+
+    def emit(self, record):
+        pass
+
+    def flush(self, metrics):
+        # one tmp file per thread, like cache.ResponseCache.put, so a flush never replaces another one's file
+        tmp_path = self.path + '.%d.tmp' % threading.get_ident()
+        with open(tmp_path, 'w') as f:
+            f.write(self.render(metrics))
+        os.replace(tmp_path, self.path)
+
+    def render(self, metrics):
+        p = self.prefix
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE %s_%s %s' % (p, name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, value) for key, value in labels)
+                lines.append('%s_%s%s %s' % (p, name, '{' + label_text + '}' if label_text else '', repr(value)))
+
+        with metrics.lock:
+            # statuses are ints, or 'error' when no answer came back
+            requests_by = sorted(metrics.requests.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            endpoints = sorted(metrics.endpoints.items())
+            stages = sorted(metrics.stages.items())
+        metric('requests_total', 'counter',
+               [((('endpoint', endpoint), ('status', status)), count) for (endpoint, status), count in requests_by])
+        for name, field in [('request_bytes_total', 'bytes'), ('records_total', 'records'),
+                            ('empty_pages_total', 'empty_pages'), ('retries_total', 'retries')]:
+            metric(name, 'counter', [((('endpoint', endpoint),), entry[field]) for endpoint, entry in endpoints])
+        lines.append('# TYPE %s_request_seconds histogram' % p)
+        for endpoint, entry in endpoints:
+            for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], entry['buckets']):
+                lines.append('%s_request_seconds_bucket{endpoint="%s",le="%s"} %d' % (p, endpoint, bound, count))
+            lines.append('%s_request_seconds_sum{endpoint="%s"} %r' % (p, endpoint, entry['seconds']))
+            lines.append('%s_request_seconds_count{endpoint="%s"} %d' % (p, endpoint, entry['count']))
+        metric('stage_seconds_total', 'counter', [((('stage', stage),), entry['seconds']) for stage, entry in stages])
+        metric('stage_calls_total', 'counter', [((('stage', stage),), entry['count']) for stage, entry in stages])
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        pass
+
+
+class Metrics:
+    '''
+    Collects request and stage records, keeps running totals (see summary()) and forwards every record
+    to the sinks, which are flushed every flush_every seconds and on close()
+    Thread safe, the async downloader records from its executor threads
+    '''
+    def __init__(self, *sinks, flush_every=10):
+        self.sinks = list(sinks)
+        self.flush_every = flush_every
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+        # held while the sinks flush, emit is called from several threads
+        self.flush_lock = threading.Lock()
+        # (endpoint, status) -> count
+        self.requests = {}
+        # endpoint -> totals and latency histogram
+        self.endpoints = {}
+        # stage -> {'seconds', 'count'}
+        self.stages = {}
+        # (endpoint, params) of the requests whose last answer was not a 200, to count retries
+        self.failing = {}
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink.emit(record)
+        # a flush already running in another thread covers this record too
+        if time.monotonic() - self.flushed > self.flush_every and self.flush_lock.acquire(blocking=False):
+            try:
+                self.flush_sinks()
+            finally:
+                self.flush_lock.release()
+
+    def record_request(self, url, params, status, seconds, size, records, retries=0, cached=False):
+        endpoint = endpoint_name(url)
+        with self.lock:
+            self.requests[(endpoint, status)] = self.requests.get((endpoint, status), 0) + 1
+            entry = self.endpoints.setdefault(endpoint, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'records': 0,
+                                                         'empty_pages': 0, 'retries': 0,
+                                                         'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['bytes'] += size
+            entry['records'] += records or 0
+            entry['empty_pages'] += records == 0
+            # requests that repeat a failed one
+            entry['retries'] += retries > 0
+            for i, bound in enumerate(LATENCY_BUCKETS + [float('inf')]):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+        record = {'type': 'request', 'time': time.time(), 'endpoint': endpoint, 'status': status,
+                  'seconds': seconds, 'bytes': size, 'records': records, 'retries': retries, 'cached': cached}
+        for key in WINDOW_PARAMS:
+            if params and params.get(key) is not None:
+                record[key] = params[key]
+        if params and params.get('token_ids'):
+            token_ids = list(params['token_ids'])
+            record['token_ids'] = [token_ids[0], token_ids[-1]]
+        self.emit(record)
+
+    def record_stage(self, stage, seconds, **labels):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+            entry['seconds'] += seconds
+            entry['count'] += 1
+        self.emit(dict({'type': 'stage', 'time': time.time(), 'stage': stage, 'seconds': seconds}, **labels))
+
+    @contextmanager
+    def stage(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, **labels)
+
+    def sleep(self, seconds):
+        if seconds:
+            with self.stage('sleep'):
+                time.sleep(seconds)
+
+    def retries(self, url, params, status):
+        # failed answers in a row for the same request before this one
+        key = (url.rstrip('/'), json.dumps(canonical_params(params)))
+        with self.lock:
+            previous = self.failing.get(key, 0)
+            if status == 200:
+                self.failing.pop(key, None)
+            else:
+                self.failing[key] = previous + 1
+        return previous
+
+    def wrap(self, session=None):
+        '''
+        requests.Session recording every request sent through session (a plain requests.Session by default)
+        '''
+        return InstrumentedSession(self, session or requests.Session())
+
+    def summary(self):
+        '''
+        Totals per endpoint (requests, statuses, mean latency, bytes, records, empty pages, retries) and per stage
+        '''
+        with self.lock:
+            endpoints = {}
+            for endpoint, entry in self.endpoints.items():
+                endpoints[endpoint] = {'requests': entry['count'],
+                                       'statuses': {str(status): count for (name, status), count in
+                                                    self.requests.items() if name == endpoint},
+                                       'seconds': entry['seconds'],
+                                       'mean_seconds': entry['seconds'] / entry['count'],
+                                       'bytes': entry['bytes'],
+                                       'records': entry['records'],
+                                       'empty_pages': entry['empty_pages'],
+                                       'retries': entry['retries']}
+            stages = {stage: dict(entry) for stage, entry in self.stages.items()}
+        return {'endpoints': endpoints, 'stages': stages}
+
+    def flush(self):
+        with self.flush_lock:
+            self.flush_sinks()
+
+    def flush_sinks(self):
+        self.flushed = time.monotonic()
+        for sink in self.sinks:
+            sink.flush(self)
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+class NullMetrics:
+    '''
+    Stand-in used when no Metrics is given: no records, plain sleeps and the session unchanged
+    '''
+    @contextmanager
+    def stage(self, stage, **labels):
+        yield
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wrap(self, session=None):
+        return session or requests
+
+
+class InstrumentedSession(requests.Session):
+    '''
+    requests.Session that sends through another session (e.g. a cache.CachedSession or crawler.LimitedSession)
+    and records each request in a Metrics
+    '''
+    def __init__(self, metrics, session):
+        super().__init__()
+        self.metrics = metrics
+        self.session = session
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, url, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, params=params, **kwargs)
+        except requests.RequestException:
+            self.metrics.record_request(url, params, 'error', time.perf_counter() - start, 0, None,
+                                        self.metrics.retries(url, params, 'error'))
+            raise
+        seconds = time.perf_counter() - start
+        records = None
+        if kwargs.get('stream'):
+            # the caller reads the body in chunks (media downloads), only its announced size is recorded
+            size = int(response.headers.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            else:
+                records = count_records(body)
+                # callers read the body again, it is not parsed twice
+                response.json = lambda **kwargs: body
+        self.metrics.record_request(url, params, response.status_code, seconds, size, records,
+                                    self.metrics.retries(url, params, response.status_code),
+                                    cached=response.headers.get('X-Cache') == 'HIT')
+        return response
@@ -0,0 +1,337 @@
+# Market state rebuilt by replaying the events of a collection in time order: the live listings ('created')
+# and bids ('bid_entered') of every token, taken out again by 'cancelled' / 'bid_withdrawn' and by sales
+#   snapshots = orderbook_snapshots(save_location, 'day', as_frame=True)     (floor, best bid, spread, depth)
+#   book = replay(save_location)[0]; book.listings_of('1234')
+# Closed days are replayed once, the book is checkpointed under <save_location>/orderbook/ so a nightly run only
+# replays the days downloaded since
+# Bundles are skipped and listings never expire: the stored events carry no listing duration
+from bisect import bisect_left, bisect_right, insort
+from datetime import date
+import json
+import os
+import shutil
+
+import numpy as np
+
+from analytics import day_fingerprint
+from helpers import batch_result
+from load import event_file_days, iter_events
+from windows import utc_now
+
+# snapshot interval -> numpy time unit
+INTERVALS = {'minute': 'datetime64[m]', 'hour': 'datetime64[h]', 'day': 'datetime64[D]'}
+BOOK_COLUMNS = ['id', 'timestamp', 'event_type', 'token_id', 'is_bundle', 'total_price', 'starting_price',
+                'seller_address', 'buyer_address', 'from_address']
+SNAPSHOT_FIELDS = ['time', 'floor', 'best_bid', 'spread', 'listings', 'bids', 'listed_tokens', 'depth',
+                   'bid_depth']
+
+
+class Side:
+    '''
+    Live orders of one side of the book: (token, maker) -> price, the makers of every token, and the number of
+    orders at every price level with the levels kept sorted, so the best price and the depth near it are
+    bisections and only a new price level costs an insertion
+    '''
+    def __init__(self):
+        self.orders = {}
+        self.by_token = {}
+        self.counts = {}
+        self.levels = []
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, token, maker, price):
+        # a new order of the same maker on the same token replaces the previous one
+        if (token, maker) in self.orders:
+            self.remove(token, maker)
+        self.orders[(token, maker)] = price
+        makers = self.by_token.get(token)
+        if makers is None:
+            self.by_token[token] = {maker}
+        else:
+            makers.add(maker)
+        count = self.counts.get(price, 0)
+        if not count:
+            insort(self.levels, price)
+        self.counts[price] = count + 1
+
+    def remove(self, token, maker):
+        price = self.orders.pop((token, maker), None)
+        if price is None:
+            return
+        makers = self.by_token[token]
+        makers.discard(maker)
+        if not makers:
+            del self.by_token[token]
+        count = self.counts[price] - 1
+        if count:
+            self.counts[price] = count
+        else:
+            del self.counts[price]
+            del self.levels[bisect_left(self.levels, price)]
+
+    def clear_token(self, token):
+        for maker in list(self.by_token.get(token, ())):
+            self.remove(token, maker)
+
+    def of(self, token):
+        return {maker: self.orders[(token, maker)] for maker in self.by_token.get(token, ())}
+
+    def best(self, highest=False):
+        if not self.levels:
+            return np.nan
+        return self.levels[-1] if highest else self.levels[0]
+
+    def count_between(self, low, high):
+        return sum(self.counts[price] for price in
+                   self.levels[bisect_left(self.levels, low):bisect_right(self.levels, high)])
+
+    def arrays(self):
+        items = list(self.orders.items())
+        return {'token': np.array([token for (token, maker), price in items], dtype='U'),
+                'maker': np.array([maker for (token, maker), price in items], dtype='U'),
+                'price': np.array([price for key, price in items], dtype='float64')}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        side = cls()
+        for token, maker, price in zip(arrays['token'].tolist(), arrays['maker'].tolist(),
+                                       arrays['price'].tolist()):
+            side.orders[(token, maker)] = price
+            side.by_token.setdefault(token, set()).add(maker)
+            side.counts[price] = side.counts.get(price, 0) + 1
+        side.levels = sorted(side.counts)
+        return side
+
+
+class OrderBook:
+    '''
+    Listings (asks) and bids of every token of a collection, fed with events in time order
+    A sale removes every listing of its token (the owner changed) and the buyer's bid on it
+    depth_band is the share around the best price counted as depth: listings up to floor * (1 + depth_band)
+    and bids down to best_bid * (1 - depth_band)
+    '''
+    def __init__(self, depth_band=0.1):
+        self.depth_band = depth_band
+        self.asks = Side()
+        self.bids = Side()
+        self.last_time = None
+        self.skipped = 0
+
+    def feed(self, columns, interval=None, snapshots=None):
+        '''
+        Replay a {column: array} set of events (BOOK_COLUMNS, strings decoded) in (timestamp, id) order
+        With interval, the book as of the end of every interval is appended to snapshots ({field: list}),
+        also for quiet intervals in between, see advance
+        '''
+        stamps = np.asarray(columns['timestamp'], dtype='datetime64[s]')
+        keep = ~np.isnat(stamps) & ~np.asarray(columns['is_bundle'], dtype=bool)
+        self.skipped += int((~keep).sum())
+        order = np.flatnonzero(keep)[np.lexsort((columns['id'][keep], stamps[keep]))]
+        stamps = stamps[order]
+        types = columns['event_type'][order].tolist()
+        tokens = columns['token_id'][order].tolist()
+        sellers = columns['seller_address'][order].tolist()
+        buyers = columns['buyer_address'][order].tolist()
+        bidders = columns['from_address'][order].tolist()
+        # listings carry starting_price, sales and bids total_price, in ETH
+        prices = (np.where(np.isnan(columns['total_price'][order]), columns['starting_price'][order],
+                           columns['total_price'][order]) / 10. ** 18).tolist()
+        if interval is None:
+            bounds = [0, len(types)]
+        else:
+            buckets = stamps.astype(INTERVALS[interval])
+            # positions where a new interval starts, the intervals closed before are snapshot first
+            bounds = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]])).tolist() + [len(types)]
+        asks, bids = self.asks, self.bids
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if interval is not None:
+                self.advance(stamps[start], interval, snapshots)
+            # the hot loop of a replay, kept free of method lookups
+            for i in range(start, stop):
+                event_type = types[i]
+                if event_type == 'created':
+                    if prices[i] == prices[i]:
+                        asks.add(tokens[i], sellers[i], prices[i])
+                    else:
+                        self.skipped += 1
+                elif event_type == 'cancelled':
+                    asks.remove(tokens[i], sellers[i])
+                elif event_type == 'successful':
+                    asks.clear_token(tokens[i])
+                    bids.remove(tokens[i], buyers[i])
+                elif event_type == 'bid_entered':
+                    # bids come from from_account, older rows only have the winner
+                    if prices[i] == prices[i]:
+                        bids.add(tokens[i], bidders[i] or buyers[i], prices[i])
+                    else:
+                        self.skipped += 1
+                elif event_type == 'bid_withdrawn':
+                    bids.remove(tokens[i], bidders[i] or buyers[i])
+            if stop > start:
+                self.last_time = stamps[stop - 1]
+
+    def advance(self, time, interval, snapshots):
+        '''
+        Snapshot the book at the end of every interval closed between the last event and time
+        '''
+        if self.last_time is None:
+            return
+        unit = INTERVALS[interval]
+        current = self.last_time.astype(unit)
+        while current + 1 <= np.datetime64(time, 's'):
+            current = current + 1
+            self.snapshot(current.astype('datetime64[s]'), snapshots)
+        self.last_time = max(self.last_time, np.datetime64(time, 's'))
+
+    def floor(self):
+        return self.asks.best()
+
+    def best_bid(self):
+        return self.bids.best(highest=True)
+
+    def listings_of(self, token):
+        '''
+        {seller: price} of the live listings of token
+        '''
+        return self.asks.of(str(token))
+
+    def bids_of(self, token):
+        return self.bids.of(str(token))
+
+    def snapshot(self, time=None, snapshots=None):
+        '''
+        {field: value} of the book now (SNAPSHOT_FIELDS), appended to snapshots ({field: list}) when given
+        '''
+        floor, best_bid = self.floor(), self.best_bid()
+        row = {'time': np.datetime64(time if time is not None else self.last_time, 's'),
+               'floor': floor,
+               'best_bid': best_bid,
+               'spread': floor - best_bid,
+               'listings': len(self.asks),
+               'bids': len(self.bids),
+               'listed_tokens': len(self.asks.by_token),
+               'depth': self.asks.count_between(floor, floor * (1 + self.depth_band)) if len(self.asks) else 0,
+               'bid_depth': self.bids.count_between(best_bid * (1 - self.depth_band), best_bid) if len(self.bids)
+               else 0}
+        if snapshots is not None:
+            for name in SNAPSHOT_FIELDS:
+                snapshots.setdefault(name, []).append(row[name])
+        return row
+
+    def state(self):
+        state = {'ask_' + name: values for name, values in self.asks.arrays().items()}
+        state.update({'bid_' + name: values for name, values in self.bids.arrays().items()})
+        state['last_time'] = np.array([self.last_time if self.last_time is not None else 'NaT'],
+                                      dtype='datetime64[s]')
+        state['skipped'] = np.array([self.skipped])
+        return state
+
+    @classmethod
+    def from_state(cls, state, depth_band=0.1):
+        book = cls(depth_band)
+        book.asks = Side.from_arrays({name: state['ask_' + name] for name in ['token', 'maker', 'price']})
+        book.bids = Side.from_arrays({name: state['bid_' + name] for name in ['token', 'maker', 'price']})
+        book.last_time = None if np.isnat(state['last_time'][0]) else state['last_time'][0]
+        book.skipped = int(state['skipped'][0])
+        return book
+
+
+def orderbook_folder(save_location):
+    return os.path.join(save_location, 'orderbook')
+
+
+def load_book(save_location, interval, depth_band=0.1):
+    '''
+    (book, snapshots, replayed days) checkpointed by replay for interval, (None, {}, {}) when there is none
+    '''
+    folder = orderbook_folder(save_location)
+    try:
+        with open(os.path.join(folder, 'days.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, {}, {}
+    if meta.get('interval') != interval or meta.get('depth_band') != depth_band:
+        return None, {}, {}
+    with np.load(os.path.join(folder, 'book.npz'), allow_pickle=False) as data:
+        book = OrderBook.from_state({name: data[name] for name in data.files}, depth_band)
+    with np.load(os.path.join(folder, 'snapshots.npz'), allow_pickle=False) as data:
+        snapshots = {name: data[name].tolist() for name in SNAPSHOT_FIELDS}
+    snapshots['time'] = [np.datetime64(time, 's') for time in snapshots['time']]
+    return book, snapshots, meta['days']
+
+
+def save_book(save_location, book, snapshots, days, interval, depth_band):
+    # written to a tmp folder swapped in one step, like analytics.save_states
+    folder = orderbook_folder(save_location)
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    np.savez(os.path.join(tmp_folder, 'book.npz'), **book.state())
+    np.savez(os.path.join(tmp_folder, 'snapshots.npz'), **snapshot_arrays(snapshots))
+    with open(os.path.join(tmp_folder, 'days.json'), 'w') as f:
+        json.dump({'interval': interval, 'depth_band': depth_band, 'days': days}, f)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+
+def snapshot_arrays(snapshots):
+    columns = {name: np.array(snapshots.get(name, []), dtype='float64') for name in SNAPSHOT_FIELDS}
+    columns['time'] = np.array(snapshots.get('time', []), dtype='datetime64[s]')
+    for name in ['listings', 'bids', 'listed_tokens', 'depth', 'bid_depth']:
+        columns[name] = columns[name].astype('int64')
+    return columns
+
+
+def replay_days(book, save_location, days, interval, snapshots):
+    for day in days:
+        for _, columns in iter_events(save_location, day, day, columns=BOOK_COLUMNS):
+            book.feed(columns, interval, snapshots)
+
+
+def replay(save_location, interval='day', depth_band=0.1, rebuild=False):
+    '''
+    Replay the events of a collection and return (book as of the last event, {field: array} snapshots of every
+    interval up to the last one closed)
+    The book after the last closed day (before today in UTC) is checkpointed with its snapshots, later calls start
+    from it and only replay the days after; a replayed day file that changed since (downloaded again) makes
+    everything be replayed from scratch, a sale or cancel cannot be taken back out
+    Today's events are replayed on top every call without being checkpointed
+    '''
+    file_days = event_file_days(save_location)
+    closed = {str(day): day_fingerprint(save_location, day, kind)
+              for day, kind in file_days.items() if day < utc_now().date()}
+    book, snapshots, days = (None, {}, {}) if rebuild else load_book(save_location, interval, depth_band)
+    last = max(days) if days else None
+    if book is not None and (any(closed.get(day) != fingerprint for day, fingerprint in days.items()) or
+                             any(day < last for day in closed if day not in days)):
+        print('event files changed since the last replay, replaying from scratch')
+        book, snapshots, days = None, {}, {}
+    if book is None:
+        book = OrderBook(depth_band)
+    new_days = sorted(day for day in closed if day not in days)
+    replay_days(book, save_location, [date.fromisoformat(day) for day in new_days], interval, snapshots)
+    if new_days:
+        # the last closed day is over, its intervals can be snapshot without waiting for the next event
+        book.advance(np.datetime64(date.fromisoformat(new_days[-1])) + np.timedelta64(1, 'D'), interval, snapshots)
+        days.update({day: closed[day] for day in new_days})
+        save_book(save_location, book, snapshots, days, interval, depth_band)
+    replay_days(book, save_location, sorted(day for day in file_days if day >= utc_now().date()), interval, snapshots)
+    return book, snapshot_arrays(snapshots)
+
+
+def orderbook_snapshots(save_location, interval='day', start=None, end=None, depth_band=0.1, as_frame=False):
+    '''
+    Floor, best bid, spread, order counts and depth of a collection at the end of every interval
+    ('minute', 'hour', 'day') between start and end (dates or datetimes), see replay
+    '''
+    snapshots = replay(save_location, interval, depth_band)[1]
+    keep = np.ones(len(snapshots['time']), dtype=bool)
+    if start is not None:
+        keep &= snapshots['time'] >= np.datetime64(start, 's')
+    if end is not None:
+        keep &= snapshots['time'] <= np.datetime64(end, 's')
+    return batch_result({name: values[keep] for name, values in snapshots.items()}, as_frame)
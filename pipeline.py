@@ -0,0 +1,293 @@
+# Streaming download: pages flow fetch -> parse (helpers batch parsers) -> buffered writer in fixed size batches
+# so memory is bounded by batch_size instead of the collection size or the busiest day
+from datetime import date, timedelta, datetime
+import json
+import os
+import shutil
+
+import numpy as np
+import requests
+
+from checkpoint import Checkpoint
+from client import api_session
+from event_index import NO_KEY, EventIndex, column_keys
+from event_store import events_to_columns, day_folder, read_event_day
+from helpers import parse_assets_batch
+from metrics import NullMetrics
+from windows import AdaptiveWindow, utc_now
+
+EVENT_TYPES = ['created', 'successful', 'cancelled', 'bid_entered', 'bid_withdrawn']
+KEY_COLUMNS = ['id', 'transaction_hash', 'token_id', 'event_type', 'timestamp']
+
+
+def iter_asset_pages(contract, limit=1000, request_buffer=0, url="https://api.opensea.io/api/v1/assets",
+                     session=None, metrics=None, failed=None):
+    '''
+    Yield the raw pages of download_asset_info one at a time (30 token ids per request) until an empty page
+    A request that still fails after the session's retries ends the pages, its block is appended to failed
+    '''
+    metrics = metrics or NullMetrics()
+    for i in range(0, limit):
+        metrics.sleep(request_buffer)
+        querystring = {"token_ids": list(range((i * 30), (i * 30) + 30)),
+                       "asset_contract_address": contract,
+                       "order_direction": "desc",
+                       "offset": "0",
+                       "limit": "30"}
+        try:
+            response = (session or requests).request("GET", url, params=querystring)
+        except requests.RequestException as error:
+            print('error', error)
+            if failed is not None:
+                failed.append(i)
+            return
+        if response.status_code != 200:
+            print('error', response.status_code, 'at block', i)
+            print(response.text)
+            if failed is not None:
+                failed.append(i)
+            return
+        assets = response.json()['assets']
+        if assets == []:
+            return
+        yield assets
+
+
+def iter_event_pages(contract, day, event_types=EVENT_TYPES, request_buffer=.5, page_size=300,
+                     url="https://api.opensea.io/api/v1/events", session=None, metrics=None, failed=None):
+    '''
+    Yield the raw pages of one day, every event type swept with an AdaptiveWindow so busy days are complete
+    Pages at a bisection boundary can repeat a few events, stream_event_info drops them with the event index
+    A request that still fails after the session's retries ends the window of its event type, which is
+    appended to failed, and the sweep goes on with the next type
+    '''
+    metrics = metrics or NullMetrics()
+    after = datetime.combine(day, datetime.min.time())
+    before = min(after + timedelta(days=1), utc_now())
+    for e_type in event_types:
+        window = AdaptiveWindow(after, before, page_size=page_size, keep_events=False)
+        while not window.done:
+            changed_after, changed_before, offset = window.next_request()
+            metrics.sleep(request_buffer)
+            querystring = {"asset_contract_address": contract,
+                           "event_type": e_type,
+                           "only_opensea": "false",
+                           "offset": offset,
+                           "occurred_before": changed_before,
+                           "occurred_after": changed_after,
+                           "limit": str(page_size)}
+            try:
+                response = (session or requests).request("GET", url, headers={"Accept": "application/json"},
+                                                         params=querystring)
+            except requests.RequestException as error:
+                print('error', e_type, changed_after, error)
+                if failed is not None:
+                    failed.append(e_type)
+                break
+            if response.status_code != 200:
+                print('error', response.status_code, e_type, changed_after)
+                print(response.text)
+                if failed is not None:
+                    failed.append(e_type)
+                break
+            asset_events = response.json()['asset_events']
+            window.feed(asset_events)
+            yield asset_events
+
+
+def batched(pages, batch_size):
+    '''
+    Regroup a stream of pages into lists of at most batch_size records
+    '''
+    batch = []
+    for page in pages:
+        for record in page:
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class PartWriter:
+    '''
+    Buffered writer for {column: array} batches: each batch becomes one part folder of .npy files in a staging
+    folder, finish() copies the parts one at a time into the destination files and removes the staging, so no
+    more than a part of a column is in memory
+    '''
+    def __init__(self, staging_folder):
+        self.staging_folder = staging_folder
+        if os.path.isdir(staging_folder):
+            shutil.rmtree(staging_folder)
+        os.makedirs(staging_folder)
+        self.parts = 0
+        self.rows = 0
+        self.names = None
+
+    def write(self, columns):
+        part = os.path.join(self.staging_folder, 'part%05d' % self.parts)
+        os.makedirs(part)
+        for name, values in columns.items():
+            np.save(os.path.join(part, name + '.npy'), values, allow_pickle=False)
+        self.names = list(columns)
+        self.parts += 1
+        self.rows += len(next(iter(columns.values())))
+
+    def part(self, i, name):
+        return np.load(os.path.join(self.staging_folder, 'part%05d' % i, name + '.npy'), mmap_mode='r')
+
+    def finish(self, folder, base=None, chunk_rows=100000):
+        '''
+        Write every column as <folder>/<name>.npy, the rows of base (a previous version of the same columns, e.g.
+        memory-mapped) first, through a tmp folder that replaces folder in one step
+        Byte string columns get the widest width of any part, returns the number of rows written
+        '''
+        base_rows = len(next(iter(base.values()))) if base else 0
+        if self.parts:
+            tmp_folder = folder + '.tmp'
+            if os.path.isdir(tmp_folder):
+                shutil.rmtree(tmp_folder)
+            os.makedirs(tmp_folder)
+            for name in self.names:
+                sources = ([base[name]] if base is not None else []) + \
+                          [self.part(i, name) for i in range(self.parts)]
+                out = np.lib.format.open_memmap(os.path.join(tmp_folder, name + '.npy'), mode='w+',
+                                                dtype=np.result_type(*[source.dtype for source in sources]),
+                                                shape=(base_rows + self.rows,))
+                position = 0
+                for source in sources:
+                    for start in range(0, len(source), chunk_rows):
+                        values = source[start:start + chunk_rows]
+                        out[position:position + len(values)] = values
+                        position += len(values)
+                out.flush()
+                del out, sources
+            if base is not None:
+                # base may be memory-mapped from folder itself, release it before replacing the folder
+                base.clear()
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+            os.replace(tmp_folder, folder)
+        shutil.rmtree(self.staging_folder)
+        return base_rows + self.rows
+
+
+def assets_to_columns(assets):
+    '''
+    Typed columns for a batch of raw assets via helpers.parse_assets_batch, traits are kept as JSON strings
+    '''
+    parsed = parse_assets_batch(assets)
+    columns = {}
+    for name, values in parsed.items():
+        if name == 'num_sales':
+            columns[name] = values
+        elif name == 'traits':
+            columns[name] = np.char.encode(np.array([json.dumps(traits) for traits in values], dtype='U'), 'utf-8')
+        else:
+            columns[name] = np.char.encode(np.array(['' if value is None else str(value) for value in values],
+                                                    dtype='U'), 'utf-8')
+    return columns
+
+
+def stream_asset_info(save_location, asset_name="animeta", contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
+                      limit=1000, request_buffer=0, batch_size=1000, url="https://api.opensea.io/api/v1/assets",
+                      session=None, metrics=None, retry=None):
+    '''
+    Streaming counterpart of download.download_asset_info
+    Pages are parsed with parse_assets_batch every batch_size assets and written as typed columns to
+    <save_location><asset_name>_assets<date>/ (one .npy per field, traits as JSON), no raw page is kept
+    load.load_assets_snapshot (and so rarity, features and media) reads the folder back like a _list<date>.npz
+    Returns the number of assets written, None when a request still failed after its retries: nothing is written
+    then, so an incomplete snapshot never replaces a complete one
+    metrics (a metrics.Metrics) records every request and the time spent parsing and writing
+    retry (a client.RetryPolicy) sets the timeouts, retries and circuit breaker of the requests
+    '''
+    metrics = metrics or NullMetrics()
+    if not os.path.isdir(save_location):
+        os.makedirs(save_location)
+    folder = save_location + asset_name + '_assets' + str(date.today())
+    writer = PartWriter(folder + '.parts')
+    failed = []
+    pages = iter_asset_pages(contract, limit, request_buffer, url, api_session(session, metrics, retry), metrics,
+                             failed)
+    for batch in batched(pages, batch_size):
+        with metrics.stage('parse'):
+            columns = assets_to_columns(batch)
+        with metrics.stage('write'):
+            writer.write(columns)
+        print(writer.rows, end=" ")
+    if failed:
+        shutil.rmtree(writer.staging_folder)
+        print("assets download failed at block " + str(failed[0]) + ", nothing saved")
+        return None
+    with metrics.stage('write'):
+        count = writer.finish(folder)
+    print(str(count) + " assets saved to" + folder)
+    return count
+
+
+def stream_event_info(save_location, contract="0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5",
+                      start_date=date(2021, 7, 30), end_date=utc_now().date(), event_type='all', request_buffer=.5,
+                      batch_size=5000, resume=True, url="https://api.opensea.io/api/v1/events", session=None,
+                      metrics=None, retry=None):
+    '''
+    Streaming counterpart of download.download_event_info writing the columnar layout of event_store
+    Each day's pages are parsed every batch_size events and staged as part files, then consolidated column by
+    column into <save_location>/events/<date>/, so neither a busy day nor the raw JSON is ever held in memory
+    Days already complete in the save_location checkpoint are skipped when resume is set, events already stored
+    in any day (see event_index) are dropped
+    metrics (a metrics.Metrics) records every request and the time spent parsing and writing
+    retry (a client.RetryPolicy) sets the timeouts, retries and circuit breaker of the requests
+    '''
+    metrics = metrics or NullMetrics()
+    session = api_session(session, metrics, retry)
+    if not os.path.isdir(save_location):
+        os.makedirs(save_location)
+    checkpoint = Checkpoint(save_location)
+    index = EventIndex(save_location)
+    event_types = EVENT_TYPES if event_type == 'all' else [event_type]
+    for i in range((end_date - start_date).days + 1):
+        day = start_date + timedelta(days=i)
+        if resume and checkpoint.day_complete(contract, day, save_location):
+            continue
+        # a day already stored is appended to when resuming, otherwise replaced
+        # the index keeps the replaced day's events until the new folder is in place
+        base = None
+        replacing = day
+        if resume and os.path.isdir(day_folder(save_location, day)):
+            base = read_event_day(save_location, day, mmap=True, decode=False)
+            replacing = None
+        writer = PartWriter(day_folder(save_location, day) + '.parts')
+        failed = []
+        pages = iter_event_pages(contract, day, event_types, request_buffer, url=url, session=session,
+                                 metrics=metrics, failed=failed)
+        # repeats are dropped batch by batch, only the keys of the day's kept events stay in memory
+        kept_keys = []
+        seen = np.array([], dtype='uint64')
+        for batch in batched(pages, batch_size):
+            with metrics.stage('parse'):
+                columns = events_to_columns(batch)
+                keys = column_keys({name: columns[name] for name in KEY_COLUMNS})
+                keep = index.new_rows(keys, replacing)
+                if len(seen):
+                    for values in keys:
+                        position = np.minimum(np.searchsorted(seen, values), len(seen) - 1)
+                        keep &= (seen[position] != values) | (values == NO_KEY)
+                kept_keys.append(tuple(values[keep] for values in keys))
+                added = np.concatenate(kept_keys[-1])
+                seen = np.union1d(seen, added[added != NO_KEY])
+            with metrics.stage('write'):
+                writer.write({name: values[keep] for name, values in columns.items()})
+
+        with metrics.stage('write', day=str(day)):
+            count = writer.finish(day_folder(save_location, day), base)
+        if replacing is not None and writer.parts:
+            index.remove_day(day)
+        if kept_keys:
+            index.add(day, tuple(np.concatenate(values) for values in zip(*kept_keys)))
+        print(str(count) + " events saved to" + day_folder(save_location, day))
+        # a type whose window failed stays unfinished, the next run fetches the day again
+        for e_type in event_types:
+            checkpoint.update_unit(contract, day, 'stream', e_type, 0, e_type not in failed)
+        checkpoint.finish_day(contract, day, count, closed=day < utc_now().date())
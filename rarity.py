@@ -0,0 +1,164 @@
+# Trait rarity engine: the traits of a snapshot are integer encoded once into a sparse asset x trait matrix
+# (CSR: indptr / trait ids) and every score is then a few vectorized numpy operations over it
+#   index = trait_index(save_location, 'animeta')        (built from the latest snapshot, then reused from disk)
+#   scores = rarity_scores(index, as_frame=True)
+import os
+
+import numpy as np
+
+from helpers import batch_result
+from load import load_assets_snapshot, snapshot_sources, snapshot_stamp
+
+MISSING = '<none>'
+
+
+class TraitIndex:
+    '''
+    asset_id[i] owns the traits indices[indptr[i]:indptr[i + 1]], trait t is value trait_value[t] of
+    type trait_types[trait_type[t]]
+    rows holds the asset of every entry of indices so per asset sums are one np.bincount
+    '''
+    def __init__(self, asset_id, indptr, indices, trait_type, trait_value, trait_types, source=''):
+        self.asset_id = asset_id
+        self.indptr = indptr
+        self.indices = indices
+        self.trait_type = trait_type
+        self.trait_value = trait_value
+        self.trait_types = trait_types
+        self.source = source
+        self.rows = np.repeat(np.arange(len(asset_id)), np.diff(indptr))
+
+    def __len__(self):
+        return len(self.asset_id)
+
+    def traits_of(self, position):
+        traits = self.indices[self.indptr[position]:self.indptr[position + 1]]
+        return [(str(self.trait_types[self.trait_type[t]]), str(self.trait_value[t])) for t in traits]
+
+    def save(self, path):
+        np.savez(path, asset_id=self.asset_id, indptr=self.indptr, indices=self.indices, trait_type=self.trait_type,
+                 trait_value=self.trait_value, trait_types=self.trait_types, source=np.array(self.source))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['asset_id'], data['indptr'], data['indices'], data['trait_type'], data['trait_value'],
+                       data['trait_types'], str(data['source']))
+
+
+def build_trait_index(assets, source=''):
+    '''
+    TraitIndex of raw assets (e.g. load_assets_info), the one pass over the traits lists in Python
+    Trait types and values are compared as strings, an asset listing the same type/value twice counts it once
+    '''
+    type_codes = {}
+    trait_codes = {}
+    indptr = np.zeros(len(assets) + 1, dtype='int64')
+    indices = []
+    for i, asset in enumerate(assets):
+        traits = set()
+        for trait in asset.get('traits') or []:
+            type_name = str(trait.get('trait_type'))
+            key = (type_codes.setdefault(type_name, len(type_codes)), str(trait.get('value')))
+            traits.add(trait_codes.setdefault(key, len(trait_codes)))
+        indices.extend(sorted(traits))
+        indptr[i + 1] = len(indices)
+    trait_type = np.array([key[0] for key in trait_codes], dtype='int32')
+    trait_value = np.array([key[1] for key in trait_codes], dtype='U')
+    return TraitIndex(np.array([str(asset.get('token_id')) for asset in assets], dtype='U'), indptr,
+                      np.array(indices, dtype='int32'), trait_type, trait_value,
+                      np.array(list(type_codes), dtype='U'), source)
+
+
+def index_file(save_location, asset_name):
+    return save_location + asset_name + '_rarity.npz'
+
+
+def trait_index(save_location, asset_name="animeta", rebuild=False):
+    '''
+    TraitIndex of the latest asset snapshot (full, streamed or delta, see load.snapshot_sources), saved next to
+    it as <asset_name>_rarity.npz and loaded from there while the snapshot it was built from is still the latest
+    and unchanged (same load.snapshot_stamp, so a snapshot of the same day downloaded again is indexed again)
+    The latest snapshot is the one with the latest date in its name, as for load.load_assets_snapshot, not the
+    newest file on disk
+    '''
+    sources = snapshot_sources(save_location, asset_name)
+    source = snapshot_stamp(sources[max(sources)][1]) if sources else ''
+    path = index_file(save_location, asset_name)
+    if not rebuild and os.path.isfile(path):
+        index = TraitIndex.load(path)
+        if index.source == source:
+            return index
+    index = build_trait_index(load_assets_snapshot(save_location, asset_name), source)
+    index.save(path)
+    return index
+
+
+def trait_counts(index, include_missing=True):
+    '''
+    (assets per trait, assets missing each trait type, asset x trait type presence, traits per asset)
+    '''
+    n = len(index)
+    counts = np.bincount(index.indices, minlength=len(index.trait_value))
+    # assets that have at least one value of each type
+    present = np.zeros((n, len(index.trait_types)), dtype=bool)
+    present[index.rows, index.trait_type[index.indices]] = True
+    missing = n - present.sum(axis=0) if include_missing else np.zeros(len(index.trait_types), dtype='int64')
+    trait_number = present.sum(axis=1)
+    return counts, missing, present, trait_number
+
+
+def rarity_scores(index, include_missing=True, trait_count=True, as_frame=False):
+    '''
+    Scores of every asset of a TraitIndex:
+      rarity_score  sum of 1 / frequency of each trait (rarity.tools), higher is rarer
+      statistical   product of the frequencies of the traits, lower is rarer
+      average       mean 1 / frequency of the traits, so assets with many traits are not favoured
+      rank          1 for the rarest asset by rarity_score
+    include_missing counts a missing trait type as its own value ('<none>'), trait_count adds the number of traits
+    of an asset as one more trait
+    '''
+    n = len(index)
+    counts, missing, present, trait_number = trait_counts(index, include_missing)
+    entry_count = counts[index.indices]
+    score = np.bincount(index.rows, weights=n / entry_count, minlength=n)
+    log_frequency = np.bincount(index.rows, weights=np.log(entry_count / n), minlength=n)
+    traits = trait_number.astype('float64')
+    if include_missing and missing.any():
+        absent = ~present & (missing > 0)
+        score += (absent * (n / np.maximum(missing, 1))).sum(axis=1)
+        log_frequency += (absent * np.log(np.maximum(missing, 1) / n)).sum(axis=1)
+        traits += absent.sum(axis=1)
+    if trait_count:
+        number_count = np.bincount(trait_number)[trait_number]
+        score += n / number_count
+        log_frequency += np.log(number_count / n)
+        traits += 1
+    order = np.argsort(-score, kind='stable')
+    rank = np.empty(n, dtype='int64')
+    rank[order] = np.arange(1, n + 1)
+    columns = {'asset_id': index.asset_id,
+               'rarity_score': score,
+               'statistical': np.exp(log_frequency),
+               'average': np.divide(score, traits, out=np.zeros(n), where=traits > 0),
+               'trait_count': trait_number,
+               'rank': rank}
+    return batch_result(columns, as_frame)
+
+
+def trait_table(index, include_missing=True, as_frame=False):
+    '''
+    One row per trait type/value with its count and frequency, missing values as '<none>' (what
+    all_trait_values_dict of Collection_Traits_Rarities.ipynb builds, without zero count values)
+    '''
+    n = len(index)
+    counts, missing, present, trait_number = trait_counts(index, include_missing)
+    types = index.trait_types[index.trait_type]
+    values = index.trait_value
+    if include_missing:
+        has_missing = missing > 0
+        types = np.concatenate([types, index.trait_types[has_missing]])
+        values = np.concatenate([values, np.full(has_missing.sum(), MISSING)])
+        counts = np.concatenate([counts, missing[has_missing]])
+    columns = {'trait_type': types, 'value': values, 'count': counts, 'frequency': counts / n if n else counts * 0.}
+    return batch_result(columns, as_frame)
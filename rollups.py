@@ -0,0 +1,188 @@
+# Precomputed price series of a collection: OHLC, median and volume of sales and the floor (cheapest new
+# listing, from 'created' events) per minute, hour and day, kept under <save_location>/rollups/
+#   daily = rollup_series(save_location, 'day', start=date.today() - timedelta(days=30), as_frame=True)
+#   floors = compare_collections({'animeta': 'static/animeta/', 'BAYC': 'static/BAYC/'}, 'floor', as_frame=True)
+# Every bucket lies inside one day, so a day file that is new or was saved again only recomputes that day's rows
+from datetime import date
+import json
+import os
+
+import numpy as np
+
+from analytics import day_fingerprint
+from helpers import batch_result
+from load import event_file_days, iter_events
+
+# granularity -> numpy time unit of its buckets
+GRANULARITIES = {'minute': 'datetime64[m]', 'hour': 'datetime64[h]', 'day': 'datetime64[D]'}
+ROLLUP_FIELDS = ['bucket', 'open', 'high', 'low', 'close', 'median', 'sales', 'volume_eth', 'volume_usd', 'floor',
+                 'listings']
+ROLLUP_COLUMNS = ['timestamp', 'event_type', 'total_price', 'starting_price', 'usd_price']
+
+
+def empty_rollup(granularity):
+    rollup = {name: np.array([], dtype='float64') for name in ROLLUP_FIELDS}
+    rollup['bucket'] = np.array([], dtype=GRANULARITIES[granularity])
+    rollup['sales'] = np.array([], dtype='int64')
+    rollup['listings'] = np.array([], dtype='int64')
+    return rollup
+
+
+def bucket_rollup(columns, granularity='day'):
+    '''
+    Rollup rows of a {column: array} set of events (ROLLUP_COLUMNS, event types decoded), one per bucket with
+    a sale or a listing, sorted by bucket
+    Prices are in ETH (total_price / 10**18 as in the notebook, starting_price for listings), open / close are the
+    first / last sale of the bucket by time, buckets without sales have NaN prices and floor is NaN without listings
+    '''
+    unit = GRANULARITIES[granularity]
+    stamps = np.asarray(columns['timestamp'], dtype='datetime64[s]')
+    prices = columns['total_price'] / 10. ** 18
+    sold = (columns['event_type'] == 'successful') & ~np.isnan(prices) & ~np.isnat(stamps)
+    asks = columns['starting_price'] / 10. ** 18
+    listed = (columns['event_type'] == 'created') & ~np.isnan(asks) & ~np.isnat(stamps)
+    buckets = np.unique(np.concatenate([stamps[sold].astype(unit), stamps[listed].astype(unit)]))
+    rollup = empty_rollup(granularity)
+    rollup['bucket'] = buckets
+    n = len(buckets)
+    for name in ['open', 'high', 'low', 'close', 'median', 'floor']:
+        rollup[name] = np.full(n, np.nan)
+    rollup['sales'] = np.zeros(n, dtype='int64')
+    rollup['listings'] = np.zeros(n, dtype='int64')
+    rollup['volume_eth'] = np.zeros(n)
+    rollup['volume_usd'] = np.zeros(n)
+    if sold.any():
+        sale_bucket = np.searchsorted(buckets, stamps[sold].astype(unit))
+        sale_price = prices[sold]
+        sale_usd = np.nan_to_num(sale_price * columns['usd_price'][sold])
+        # sales in time order for open / close, in price order for high / low / median
+        by_time = np.lexsort((stamps[sold], sale_bucket))
+        by_price = np.lexsort((sale_price, sale_bucket))
+        count = np.bincount(sale_bucket, minlength=n)
+        has = count > 0
+        indptr = np.concatenate([[0], np.cumsum(count)])
+        first, last = indptr[:-1][has], indptr[1:][has] - 1
+        ordered = sale_price[by_price]
+        rollup['open'][has] = sale_price[by_time][first]
+        rollup['close'][has] = sale_price[by_time][last]
+        rollup['low'][has] = ordered[first]
+        rollup['high'][has] = ordered[last]
+        rollup['median'][has] = (ordered[first + (count[has] - 1) // 2] + ordered[first + count[has] // 2]) / 2
+        rollup['sales'] = count
+        rollup['volume_eth'] = np.bincount(sale_bucket, weights=sale_price, minlength=n)
+        rollup['volume_usd'] = np.bincount(sale_bucket, weights=sale_usd, minlength=n)
+    if listed.any():
+        ask_bucket = np.searchsorted(buckets, stamps[listed].astype(unit))
+        floor = np.full(n, np.inf)
+        np.minimum.at(floor, ask_bucket, asks[listed])
+        rollup['listings'] = np.bincount(ask_bucket, minlength=n)
+        rollup['floor'] = np.where(rollup['listings'] > 0, floor, np.nan)
+    return rollup
+
+
+def rollups_folder(save_location):
+    return os.path.join(save_location, 'rollups')
+
+
+def load_rollups(save_location):
+    '''
+    ({granularity: rollup}, rolled up days) persisted by update_rollups, ({}, {}) when there are none
+    '''
+    folder = rollups_folder(save_location)
+    try:
+        with open(os.path.join(folder, 'days.json')) as f:
+            days = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    rollups = {}
+    for granularity in GRANULARITIES:
+        with np.load(os.path.join(folder, granularity + '.npz'), allow_pickle=False) as data:
+            rollups[granularity] = {name: data[name] for name in ROLLUP_FIELDS}
+    return rollups, days
+
+
+def save_rollups(save_location, rollups, days):
+    # each file is replaced in one step and days.json last, a crash in between only means some days get redone
+    folder = rollups_folder(save_location)
+    os.makedirs(folder, exist_ok=True)
+    for granularity, rollup in rollups.items():
+        path = os.path.join(folder, granularity + '.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **rollup)
+        os.replace(path + '.tmp', path)
+    with open(os.path.join(folder, 'days.json.tmp'), 'w') as f:
+        json.dump(days, f)
+    os.replace(os.path.join(folder, 'days.json.tmp'), os.path.join(folder, 'days.json'))
+
+
+def update_rollups(save_location, rebuild=False):
+    '''
+    Bring the persisted rollups up to date with the day files and return them
+    Days that are new or were saved again since the last update (today's file while it is still being downloaded)
+    are rolled up again and replace their old rows, a day file that disappeared drops its rows
+    '''
+    file_days = event_file_days(save_location)
+    current = {str(day): day_fingerprint(save_location, day, kind) for day, kind in file_days.items()}
+    rollups, days = ({}, {}) if rebuild else load_rollups(save_location)
+    if not rollups:
+        days = {}
+    stale = sorted(day for day in days if current.get(day) != days[day])
+    changed = sorted(day for day in current if days.get(day) != current[day])
+    if not stale and not changed:
+        return rollups
+    fresh = {granularity: [] for granularity in GRANULARITIES}
+    for day in changed:
+        parts = [columns for _, columns in iter_events(save_location, date.fromisoformat(day), date.fromisoformat(day),
+                                                        event_types=['successful', 'created'],
+                                                        columns=ROLLUP_COLUMNS)]
+        if not parts:
+            continue
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in ROLLUP_COLUMNS}
+        for granularity in GRANULARITIES:
+            fresh[granularity].append(bucket_rollup(columns, granularity))
+    dropped = np.array(stale + changed, dtype='datetime64[D]')
+    for granularity in GRANULARITIES:
+        rollup = rollups.get(granularity) or empty_rollup(granularity)
+        keep = ~np.isin(rollup['bucket'].astype('datetime64[D]'), dropped)
+        parts = [{name: values[keep] for name, values in rollup.items()}] + fresh[granularity]
+        merged = {name: np.concatenate([part[name] for part in parts]) for name in ROLLUP_FIELDS}
+        order = np.argsort(merged['bucket'], kind='stable')
+        rollups[granularity] = {name: values[order] for name, values in merged.items()}
+    save_rollups(save_location, rollups, current)
+    return rollups
+
+
+def rollup_series(save_location, granularity='day', start=None, end=None, fields=None, as_frame=False,
+                  update=True):
+    '''
+    {field: array} of the rollup rows of a collection with start <= bucket <= end (dates or datetimes),
+    brought up to date first when update is set, fields defaults to every ROLLUP_FIELDS
+    '''
+    rollups = update_rollups(save_location) if update else load_rollups(save_location)[0]
+    rollup = rollups.get(granularity) or empty_rollup(granularity)
+    unit = GRANULARITIES[granularity]
+    keep = np.ones(len(rollup['bucket']), dtype=bool)
+    if start is not None:
+        keep &= rollup['bucket'] >= np.datetime64(start).astype(unit)
+    if end is not None:
+        keep &= rollup['bucket'] <= np.datetime64(end).astype(unit)
+    fields = ['bucket'] + [name for name in fields or ROLLUP_FIELDS if name != 'bucket']
+    return batch_result({name: rollup[name][keep] for name in fields}, as_frame)
+
+
+def compare_collections(save_locations, field='floor', granularity='day', start=None, end=None, as_frame=False,
+                        update=True):
+    '''
+    One field of the rollups of several collections side by side, save_locations maps a name to its folder
+    Returns {'bucket': every bucket of any collection, name: values (NaN where it has no row)}
+    '''
+    series = {name: rollup_series(location, granularity, start, end, [field], update=update)
+              for name, location in save_locations.items()}
+    buckets = np.unique(np.concatenate([np.array([], dtype=GRANULARITIES[granularity])] +
+                                       [values['bucket'] for values in series.values()]))
+    columns = {'bucket': buckets}
+    for name, values in series.items():
+        column = np.full(len(buckets), np.nan)
+        column[np.searchsorted(buckets, values['bucket'])] = values[field]
+        columns[name] = column
+    return batch_result(columns, as_frame)
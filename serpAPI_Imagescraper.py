@@ -1,6 +1,9 @@
-import os, urllib.request, json  # json for pretty output
+import os, json  # json for pretty output
+import requests
 from serpapi import GoogleSearch
 
+from media import fetch_media, search_image_urls
+
 
 def get_google_images():
     params = {
@@ -15,29 +18,28 @@ def get_google_images():
 
     # print(json.dumps(results['suggested_searches'], indent=2, ensure_ascii=False))
     print(json.dumps(results["images_results"], indent=2, ensure_ascii=False))
-    # save files to /SerpApi_Images/ if it doesn't exist create the folder
-    if not os.path.exists("./SerpApi_Images/"):
-        os.makedirs("./SerpApi_Images/")
-
     # -----------------------
     # Downloading images
-
+    # in parallel into a content-addressed cache under ./SerpApi_Images/, images fetched by an earlier run are
+    # not downloaded again, see media.py
+    paths = fetch_media(search_image_urls(results), "./SerpApi_Images/", workers=16,
+                        session=browser_session())
     for index, image in enumerate(results["images_results"]):
-
-        print(f"Downloading {index} image...")
-
-        opener = urllib.request.build_opener()
-        opener.addheaders = [
-            (
-                "User-Agent",
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.102 Safari/537.36 Edge/18.19582",
-            )
-        ]
-        urllib.request.install_opener(opener)
-        # filepath is current working directory + SerpApi_Images + params["q"] + index + .jpg
-        filepath = os.path.join("./SerpApi_Images/", params["q"] + str(index) + ".jpg")
-
-        urllib.request.urlretrieve(image["original"], filepath)
+        print(index, paths.get(image.get("original")))
+    return paths
+
+
+def browser_session():
+    # some image hosts refuse the default python user agent
+    session = requests.Session()
+    session.headers["User-Agent"] = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/70.0.3538.102 Safari/537.36 Edge/18.19582"
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 get_google_images()
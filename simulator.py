@@ -0,0 +1,369 @@
+# Local stand-in for the OpenSea API so the downloaders can be exercised offline
+# Serves /api/v1/events and /api/v1/assets with the same query parameters download.py sends,
+# with optional latency, a requests-per-second limit and injected errors
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import bisect
+import json
+import random
+import threading
+import time
+
+from windows import AdaptiveWindow, FixedWindow
+
+EVENT_TYPES = ['created', 'successful', 'cancelled', 'bid_entered', 'bid_withdrawn']
+
+
+def make_events(start, days=1, events_per_day=100, num_tokens=1000,
+                contract="0x0000000000000000000000000000000000000000", event_types=EVENT_TYPES, seed=0):
+    '''
+    Generate synthetic events shaped like OpenSea /events records
+    Events are spread uniformly over each day starting at the datetime start
+    events_per_day can be an int or a list with one count per day to simulate busy mint days
+    '''
+    rng = random.Random(seed)
+    if isinstance(events_per_day, int):
+        events_per_day = [events_per_day] * days
+    events = []
+    event_id = 0
+    for day, count in enumerate(events_per_day):
+        day_start = start + timedelta(days=day)
+        for _ in range(count):
+            event_id += 1
+            occurred = day_start + timedelta(seconds=rng.randrange(0, 86400))
+            stamp = occurred.strftime('%Y-%m-%dT%H:%M:%S')
+            price = str(rng.randrange(1, 100) * 10 ** 16)
+            seller = {'address': '0x%040x' % rng.randrange(0, 500), 'user': {'username': None}}
+            winner = {'address': '0x%040x' % rng.randrange(500, 1000), 'user': None}
+            events.append({'id': event_id,
+                           'event_type': rng.choice(event_types),
+                           'created_date': stamp,
+                           'asset': {'token_id': str(rng.randrange(0, num_tokens)),
+                                     'asset_contract': {'address': contract}},
+                           'asset_bundle': None,
+                           'auction_type': None,
+                           'seller': seller,
+                           'winner_account': winner,
+                           'total_price': price,
+                           'starting_price': price,
+                           'payment_token': {'symbol': 'ETH', 'usd_price': '3000.0'},
+                           'transaction': {'timestamp': stamp,
+                                           'transaction_hash': '0x%064x' % event_id}})
+    # OpenSea returns newest events first
+    events.sort(key=lambda event: event['created_date'], reverse=True)
+    return events
+
+
+def make_assets(num_tokens=1000, contract="0x0000000000000000000000000000000000000000", trait_types=6,
+                values_per_type=8, seed=0, token_ids=None):
+    '''
+    Generate synthetic assets shaped like OpenSea /assets records with token ids 0 .. num_tokens - 1
+    (or the token_ids given, e.g. a sparse range(10 ** 6, 10 ** 7, 97))
+    Each asset gets a value for most of trait_types trait types, rarer values are picked less often,
+    trait_count is the number of assets sharing the value as the API reports it
+    '''
+    rng = random.Random(seed)
+    weights = [1 / (value + 1) for value in range(values_per_type)]
+    assets = []
+    for token_id in (range(num_tokens) if token_ids is None else token_ids):
+        traits = []
+        for trait_type in range(trait_types):
+            if rng.random() < .9:
+                value = rng.choices(range(values_per_type), weights)[0]
+                traits.append({'trait_type': 'type_%d' % trait_type, 'value': 'value_%d' % value,
+                               'display_type': None, 'max_value': None, 'trait_count': 0, 'order': None})
+        owner = rng.randrange(0, num_tokens // 2 + 1)
+        assets.append({'id': token_id + 1,
+                       'token_id': str(token_id),
+                       'num_sales': rng.randrange(0, 5),
+                       'name': '#%d' % token_id,
+                       'image_url': 'https://example.com/%d.png' % token_id,
+                       'asset_contract': {'address': contract},
+                       'owner': {'address': '0x%040x' % owner,
+                                 'user': {'username': 'owner%d' % owner} if owner % 3 else None},
+                       'creator': {'address': '0x%040x' % 1, 'user': {'username': 'creator'}},
+                       'traits': traits})
+    counts = {}
+    for asset in assets:
+        for trait in asset['traits']:
+            key = (trait['trait_type'], trait['value'])
+            counts[key] = counts.get(key, 0) + 1
+    for asset in assets:
+        for trait in asset['traits']:
+            trait['trait_count'] = counts[(trait['trait_type'], trait['value'])]
+    return assets
+
+
+def parse_time(value):
+    '''
+    Accept the same occurred_before/after formats as the API: unix seconds or a datetime string
+    '''
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+class FakeOpenSea:
+    '''
+    In-memory event and asset feed with offset paging and optional 429 injection
+    throttle_every = answer every nth request with a 429 (0 disables it)
+    requests_per_second = answer requests above that rate with a 429 like the real API (0 disables it)
+    latency = seconds every answer is delayed, error_rate = share of requests answered with a 500
+    max_offset mirrors the API ceiling, requests past it get a 400
+    '''
+    def __init__(self, events=(), throttle_every=0, retry_after=0, max_offset=10000, max_limit=300, assets=(),
+                 max_asset_limit=50, latency=0, requests_per_second=0, error_rate=0, seed=0):
+        self.events = list(events)
+        self.assets = {str(asset['token_id']): asset for asset in assets}
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.max_offset = max_offset
+        self.max_limit = max_limit
+        self.max_asset_limit = max_asset_limit
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.request_count = 0
+        self.throttled_count = 0
+        self.error_count = 0
+        self.recent = deque()
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def add_events(self, events):
+        '''
+        Publish more events while the feed is being served (see LiveFeed)
+        '''
+        with self.lock:
+            self.events.extend(events)
+            self.index = {}
+
+    def handle(self, path, query):
+        '''
+        Return (status, headers, body) for a request path and parsed query dict
+        List parameters (token_ids) can be given as a list of values
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.request_count += 1
+            count = self.request_count
+            # requests let through in the last second, for the rate limit
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 1:
+                self.recent.popleft()
+            limited = self.requests_per_second and len(self.recent) >= self.requests_per_second
+            if not limited:
+                self.recent.append(now)
+            failed = self.error_rate and self.rng.random() < self.error_rate
+        if (self.throttle_every and count % self.throttle_every == 0) or limited:
+            with self.lock:
+                self.throttled_count += 1
+            return 429, {'Retry-After': str(self.retry_after)}, {'detail': 'Request was throttled.'}
+        if failed:
+            with self.lock:
+                self.error_count += 1
+            return 500, {}, {'detail': 'Internal server error.'}
+
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 20))
+        if path.rstrip('/') == '/api/v1/assets':
+            if offset > self.max_offset or limit > self.max_asset_limit:
+                return 400, {}, {'detail': 'offset or limit out of range'}
+            assets = self.filter_assets(query)
+            return 200, {}, {'assets': assets[offset:offset + limit]}
+        if path.rstrip('/') != '/api/v1/events':
+            return 404, {}, {'detail': 'Not found.'}
+        if offset > self.max_offset or limit > self.max_limit:
+            return 400, {}, {'detail': 'offset or limit out of range'}
+        events = self.filter_events(query)
+        return 200, {}, {'asset_events': events[offset:offset + limit]}
+
+    def filter_assets(self, query):
+        '''
+        Assets of the token_ids asked for (every asset without token_ids), ordered by token id
+        '''
+        token_ids = query.get('token_ids')
+        if token_ids is None:
+            assets = list(self.assets.values())
+        else:
+            if not isinstance(token_ids, list):
+                token_ids = [token_ids]
+            assets = [self.assets[str(token_id)] for token_id in token_ids if str(token_id) in self.assets]
+        assets.sort(key=lambda asset: int(asset['token_id']), reverse=query.get('order_direction', 'desc') == 'desc')
+        return assets
+
+    def filter_events(self, query):
+        '''
+        Events matching event_type and the [occurred_after, occurred_before) range, newest first
+        '''
+        event_type = query.get('event_type') or None
+        with self.lock:
+            if event_type not in self.index:
+                events = [event for event in self.events if event_type is None or event['event_type'] == event_type]
+                events.sort(key=lambda event: event['created_date'])
+                self.index[event_type] = ([event['created_date'] for event in events], events)
+            times, events = self.index[event_type]
+        # created_date strings sort chronologically so the range is two bisections
+        low, high = 0, len(times)
+        if query.get('occurred_after'):
+            low = bisect.bisect_left(times, parse_time(query['occurred_after']).strftime('%Y-%m-%dT%H:%M:%S'))
+        if query.get('occurred_before'):
+            high = bisect.bisect_left(times, parse_time(query['occurred_before']).strftime('%Y-%m-%dT%H:%M:%S'))
+        return events[low:high][::-1]
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            # repeated parameters (token_ids=1&token_ids=2) stay lists
+            query = {key: values if len(values) > 1 else values[0]
+                     for key, values in parse_qs(parsed.query).items()}
+            status, headers, body = api.handle(parsed.path, query)
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(api, host='127.0.0.1', port=0):
+    '''
+    Serve a FakeOpenSea on a background thread
+    Returns the server and the base url to pass as url= to the downloaders, call server.shutdown() when done
+    '''
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://%s:%d' % server.server_address[:2]
+    return server, base_url
+
+
+class LiveFeed:
+    '''
+    Publishes events_per_second synthetic events (make_events records) to a FakeOpenSea from a background thread,
+    stamped with the current UTC time, or up to late seconds earlier to mimic events the API indexes late
+    published keeps every event sent so a tail can be checked against it
+    '''
+    def __init__(self, api, events_per_second=5, late=0, tick=.2, num_tokens=1000,
+                 contract="0x0000000000000000000000000000000000000000", seed=0):
+        self.api = api
+        self.events_per_second = events_per_second
+        self.late = late
+        self.tick = tick
+        self.num_tokens = num_tokens
+        self.contract = contract
+        self.rng = random.Random(seed)
+        self.published = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def publish(self, count):
+        now = datetime.utcnow()
+        events = make_events(now, events_per_day=count, num_tokens=self.num_tokens, contract=self.contract,
+                             seed=self.rng.randrange(2 ** 32))
+        for event in events:
+            stamp = (now - timedelta(seconds=self.rng.uniform(0, self.late))).strftime('%Y-%m-%dT%H:%M:%S')
+            event['id'] = len(self.published) + 1
+            event['created_date'] = stamp
+            event['transaction'] = {'timestamp': stamp, 'transaction_hash': '0x%064x' % event['id']}
+            self.published.append(event)
+        self.api.add_events(events)
+
+    def run(self):
+        carry = 0.
+        while not self.stopped.wait(self.tick):
+            carry += self.events_per_second * self.tick
+            if carry >= 1:
+                self.publish(int(carry))
+                carry -= int(carry)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def drive_window(api, window, event_type):
+    '''
+    Run a windows.AdaptiveWindow / FixedWindow to completion against api without going through HTTP
+    '''
+    while not window.done:
+        after, before, offset = window.next_request()
+        status, headers, body = api.handle('/api/v1/events', {'event_type': event_type,
+                                                              'occurred_after': str(after),
+                                                              'occurred_before': str(before),
+                                                              'offset': offset,
+                                                              'limit': window.page_size})
+        if status != 200:
+            raise RuntimeError('simulator answered ' + str(status))
+        window.feed(body['asset_events'])
+    return window.result()
+
+
+def window_report(events_per_day=(5, 40, 25000, 300, 0, 3, 12000), start=datetime(2021, 8, 1), hour_chunks=24,
+                  page_size=300, max_offset=10000, event_type='successful', check=True):
+    '''
+    Test harness for adaptive windowing: generates synthetic days (quiet days and busy mint days),
+    downloads them with fixed hour_chunks windows and with AdaptiveWindow, and reports for each mode
+    the events lost against the generator and the requests spent per event
+    Fixed windows are expected to lose events on the busy days, AdaptiveWindow is not: with check set an
+    AssertionError carrying the report is raised when it lost any
+    '''
+    events = make_events(start, events_per_day=list(events_per_day), event_types=[event_type])
+    expected = {event['id'] for event in events}
+    end = start + timedelta(days=len(events_per_day))
+    report = {}
+
+    api = FakeOpenSea(events, max_offset=max_offset, max_limit=page_size)
+    fetched = []
+    requests = 0
+    day = start
+    while day < end:
+        for chunk in range(24 // hour_chunks):
+            window = FixedWindow(day + timedelta(hours=hour_chunks * chunk),
+                                 day + timedelta(hours=hour_chunks * (chunk + 1)),
+                                 page_size=page_size, max_offset=max_offset)
+            fetched.extend(drive_window(api, window, event_type))
+            requests += window.requests
+        day += timedelta(days=1)
+    report['hour_chunks=' + str(hour_chunks)] = summarize(expected, fetched, requests)
+
+    api = FakeOpenSea(events, max_offset=max_offset, max_limit=page_size)
+    window = AdaptiveWindow(start, end, page_size=page_size, max_offset=max_offset, initial_window=timedelta(days=1))
+    fetched = drive_window(api, window, event_type)
+    report['adaptive'] = summarize(expected, fetched, window.requests)
+    report['adaptive']['splits'] = window.splits
+    if check and report['adaptive']['lost']:
+        raise AssertionError('adaptive windowing lost ' + str(report['adaptive']['lost']) + ' events: ' + str(report))
+    return report
+
+
+def summarize(expected, fetched, requests):
+    ids = {event['id'] for event in fetched}
+    return {'events': len(expected),
+            'lost': len(expected - ids),
+            'requests': requests,
+            'requests_per_event': requests / max(1, len(expected))}
+
+
+if __name__ == '__main__':
+    # exits with an error status when adaptive windowing lost events
+    for mode, stats in window_report().items():
+        print(mode, stats)
@@ -0,0 +1,181 @@
+# Delta asset snapshots: one base snapshot plus one small diff per run instead of a full <name>_list<date>.npz a day
+#   <save_location><asset_name>_snapshots/base_2021-08-01.npz, diff_2021-08-02.npz, ...
+# Files hold typed arrays sorted by token id (no pickles): asset_id, owner/creator address and username,
+# num_sales and traits as JSON, diffs hold the full row of every new or changed token plus the removed token ids
+from datetime import date
+import glob
+import json
+import os
+
+import numpy as np
+
+from helpers import parse_assets_batch
+
+SNAPSHOT_FIELDS = ['owner_address', 'owner_username', 'creator_address', 'creator_username', 'num_sales', 'traits']
+
+
+def snapshot_folder(save_location, asset_name):
+    return save_location + asset_name + '_snapshots'
+
+
+def encode(values):
+    values = ['' if value is None else str(value) for value in values]
+    if not values:
+        return np.array([], dtype='S1')
+    return np.char.encode(np.array(values, dtype='U'), 'utf-8')
+
+
+def assets_to_snapshot(assets):
+    '''
+    Tracked fields of raw assets as typed arrays sorted by token id, traits sorted so their order is not a change
+    '''
+    parsed = parse_assets_batch(assets)
+    traits = [json.dumps(sorted(traits, key=lambda trait: (str(trait.get('trait_type')), str(trait.get('value')))),
+                         sort_keys=True) for traits in parsed['traits']]
+    columns = {'asset_id': encode(parsed['asset_id']),
+               'owner_address': encode(parsed['owner_address']),
+               'owner_username': encode(parsed['owner_username']),
+               'creator_address': encode(parsed['creator_address']),
+               'creator_username': encode(parsed['creator_username']),
+               'num_sales': parsed['num_sales'],
+               'traits': encode(traits)}
+    order = np.argsort(columns['asset_id'], kind='stable')
+    return {name: values[order] for name, values in columns.items()}
+
+
+def snapshot_files(save_location, asset_name, snapshot_date=None, since_base=True):
+    '''
+    [(date, kind, path)] sorted by date up to snapshot_date (default all)
+    since_base keeps only the latest base and the diffs after it, what is needed to rebuild snapshot_date
+    '''
+    files = []
+    for path in glob.glob(os.path.join(snapshot_folder(save_location, asset_name), '*_????-??-??.npz')):
+        kind, day = os.path.basename(path)[:-len('.npz')].split('_')
+        day = date.fromisoformat(day)
+        if snapshot_date is None or day <= snapshot_date:
+            files.append((day, kind, path))
+    files.sort()
+    if not since_base:
+        return files
+    bases = [i for i, (day, kind, path) in enumerate(files) if kind == 'base']
+    return files[bases[-1]:] if bases else []
+
+
+def apply_diff(view, diff):
+    '''
+    New view from a view and a diff: removed and changed tokens are dropped, then the diff rows are merged in
+    '''
+    drop = np.isin(view['asset_id'], np.concatenate([diff['removed'], diff['asset_id']]))
+    merged = {name: np.concatenate([view[name][~drop], diff[name]]) for name in view}
+    order = np.argsort(merged['asset_id'], kind='stable')
+    return {name: values[order] for name, values in merged.items()}
+
+
+def load_snapshot_view(save_location, asset_name="animeta", snapshot_date=None, decode=True):
+    '''
+    Reconstruct the collection as of snapshot_date (default the latest run) from its base and diffs
+    Returns {field: array} sorted by asset_id
+    '''
+    files = snapshot_files(save_location, asset_name, snapshot_date)
+    if not files:
+        return None
+    view = None
+    for day, kind, path in files:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+        view = arrays if kind == 'base' else apply_diff(view, arrays)
+        view.pop('removed', None)
+    if decode:
+        view = {name: np.char.decode(values, 'utf-8') if values.dtype.kind == 'S' else values
+                for name, values in view.items()}
+    return view
+
+
+def diff_snapshots(old, new):
+    '''
+    Rows of new that are new or changed against old, and the token ids of old missing from new
+    '''
+    common, old_index, new_index = np.intersect1d(old['asset_id'], new['asset_id'], return_indices=True)
+    changed = np.zeros(len(common), dtype=bool)
+    for name in SNAPSHOT_FIELDS:
+        changed |= old[name][old_index] != new[name][new_index]
+    added = ~np.isin(new['asset_id'], old['asset_id'])
+    keep = added.copy()
+    keep[new_index[changed]] = True
+    diff = {name: values[keep] for name, values in new.items()}
+    diff['removed'] = old['asset_id'][~np.isin(old['asset_id'], new['asset_id'])]
+    return diff
+
+
+def save_snapshot(save_location, asset_name, assets, snapshot_date=None, rebase_every=30):
+    '''
+    Store a downloaded snapshot as a diff against the reconstructed previous one
+    A new base is written on the first run, after rebase_every diffs, or when the diff would not be smaller
+    Returns the path written
+    '''
+    snapshot_date = snapshot_date or date.today()
+    folder = snapshot_folder(save_location, asset_name)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    new = assets_to_snapshot(assets)
+    # a rerun on the same day replaces that day's file
+    for kind in ['base', 'diff']:
+        path = os.path.join(folder, kind + '_' + str(snapshot_date) + '.npz')
+        if os.path.isfile(path):
+            os.remove(path)
+    files = snapshot_files(save_location, asset_name, snapshot_date)
+    kind = 'base'
+    if files and len(files) <= rebase_every:
+        old = load_snapshot_view(save_location, asset_name, snapshot_date, decode=False)
+        diff = diff_snapshots(old, new)
+        if len(diff['asset_id']) + len(diff['removed']) < len(new['asset_id']):
+            kind = 'diff'
+            new = diff
+    path = os.path.join(folder, kind + '_' + str(snapshot_date) + '.npz')
+    np.savez(path, **new)
+    print(kind + ' snapshot of ' + str(len(new['asset_id'])) + ' assets saved to' + path)
+    return path
+
+
+def token_history(save_location, asset_name, token_id, field='owner_address'):
+    '''
+    [(date, value)] every time field changed for one token, reading only the asset_id and field arrays
+    '''
+    token = str(token_id).encode('utf-8')
+    history = []
+    for day, kind, path in snapshot_files(save_location, asset_name, since_base=False):
+        with np.load(path, allow_pickle=False) as data:
+            ids = data['asset_id']
+            i = np.searchsorted(ids, token)
+            if i < len(ids) and ids[i] == token:
+                value = data[field][i]
+                value = value.decode('utf-8') if isinstance(value, bytes) else value.item()
+                if not history or history[-1][1] != value:
+                    history.append((day, value))
+            elif history and history[-1][1] is not None:
+                # gone from a base, or listed as removed in a diff
+                if kind == 'base' or (data['removed'] == token).any():
+                    history.append((day, None))
+    return history
+
+
+def owner_on(save_location, asset_name, token_id, day):
+    '''
+    Owner address of token_id as of day, None when it was not in the collection
+    '''
+    owner = None
+    for changed, value in token_history(save_location, asset_name, token_id):
+        if changed > day:
+            break
+        owner = value
+    return owner
+
+
+def convert_snapshots(save_location, asset_name="animeta", rebase_every=30):
+    '''
+    Turn the existing full <asset_name>_list<date>.npz snapshots into a base and diffs (the originals are kept)
+    '''
+    for path in sorted(glob.glob(str(save_location) + asset_name + '_list' + '????-??-??.npz')):
+        snapshot_date = date.fromisoformat(path[-len('????-??-??.npz'):-len('.npz')])
+        assets = np.load(path, allow_pickle=True)['arr_0']
+        save_snapshot(save_location, asset_name, assets, snapshot_date, rebase_every)
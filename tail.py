@@ -0,0 +1,173 @@
+# Live tail of the /events feed: each watched collection is polled from a moving occurred_after watermark, new
+# events reach consumers as soon as a poll sees them (callback and / or queue) and are appended to the day files
+#   tail = EventTail('static/animeta/', "0x18df6c571f6fe9283b87f910e41dc5c8b77b7da5", callback=print_events)
+#   run_tail([tail], interval=10)                                  (until Ctrl-C or stop.set())
+#   python cli.py tail static --interval 10                        (the collections of crawler.COLLECTIONS)
+# A poll asks for every event type in one window [watermark - overlap, now) and the watermark moves to now, so a
+# quiet collection costs one request per poll however long the tail runs; the overlap reads the last minutes again
+# for events the API indexes late, repeats are dropped by event key and against the stored events (EventIndex)
+from datetime import datetime, timedelta
+import threading
+import time
+
+import numpy as np
+import requests
+
+from client import api_session
+from checkpoint import event_key
+from event_index import EventIndex
+from event_store import save_event_day
+from load import event_file_days, iter_events
+from metrics import NullMetrics
+from windows import AdaptiveWindow, event_time, split_by_day, utc_now
+
+
+def stored_watermark(save_location):
+    '''
+    Time of the newest event stored for a collection, None without day files
+    '''
+    try:
+        file_days = event_file_days(save_location)
+    except FileNotFoundError:
+        return None
+    for day in sorted(file_days, reverse=True):
+        stamps = [columns['timestamp'] for _, columns in iter_events(save_location, day, day, columns=['timestamp'])]
+        stamps = np.concatenate(stamps) if stamps else np.array([], dtype='datetime64[s]')
+        stamps = stamps[~np.isnat(stamps)]
+        if len(stamps):
+            return stamps.max().astype(datetime)
+    return None
+
+
+class EventTail:
+    '''
+    Tail of one contract's events into save_location
+    poll() fetches what happened since the last poll and returns the new events oldest first, after handing them
+    to callback(tail, events) and queue.put((asset_name, events)); they are written to the day files by flush(),
+    called by poll at most every flush_every seconds so a busy day file is not rewritten on every poll
+    The first watermark is the newest stored event (or now - lookback), a poll that fails part way keeps the
+    watermark so the next one fetches the same range again
+    session, url, metrics and retry as for download_event_info
+    '''
+    def __init__(self, save_location, contract, asset_name=None, event_type='all', overlap=timedelta(minutes=5),
+                 lookback=timedelta(hours=1), page_size=300, storage='npz', flush_every=60, callback=None,
+                 queue=None, session=None, url="https://api.opensea.io/api/v1/events", metrics=None, retry=None):
+        self.save_location = save_location
+        self.contract = contract
+        self.asset_name = asset_name or contract
+        self.event_type = event_type
+        self.overlap = overlap
+        self.page_size = page_size
+        self.storage = storage
+        self.flush_every = flush_every
+        self.callback = callback
+        self.queue = queue
+        self.url = url
+        self.metrics = metrics or NullMetrics()
+        self.http = api_session(session, self.metrics, retry)
+        self.index = EventIndex(save_location)
+        self.watermark = stored_watermark(save_location) or utc_now() - lookback
+        # keys of the events seen inside the overlap, older ones cannot come back and are dropped
+        self.seen = {}
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.polls = 0
+        self.requests = 0
+        self.events = 0
+
+    def fetch(self, after, before):
+        '''
+        (events of [after, before), complete) through an AdaptiveWindow, so a burst past the offset ceiling is
+        bisected like in download_event_info_adaptive
+        '''
+        window = AdaptiveWindow(after, before, page_size=self.page_size)
+        while not window.done:
+            changed_after, changed_before, offset = window.next_request()
+            querystring = {"asset_contract_address": self.contract,
+                           "only_opensea": "false",
+                           "offset": offset,
+                           "occurred_before": changed_before,
+                           "occurred_after": changed_after,
+                           "limit": str(self.page_size)}
+            if self.event_type != 'all':
+                querystring["event_type"] = self.event_type
+            headers = {"Accept": "application/json"}
+            self.requests += 1
+            try:
+                response = self.http.request("GET", self.url, headers=headers, params=querystring)
+            except requests.RequestException as error:
+                print('error', self.asset_name, error)
+                return window.result(), False
+            if response.status_code != 200:
+                print('error', self.asset_name, response.status_code)
+                print(response.text)
+                return window.result(), False
+            window.feed(response.json()['asset_events'])
+        return window.result(), True
+
+    def poll(self, now=None):
+        now = now or utc_now()
+        # occurred_before is exclusive and whole seconds, the current second is read again by the next poll
+        before = now.replace(microsecond=0)
+        events, complete = self.fetch(self.watermark - self.overlap, before)
+        self.polls += 1
+        new = []
+        for event in events:
+            key = event_key(event)
+            if key not in self.seen:
+                self.seen[key] = event_time(event)
+                new.append(event)
+        # events stored by an earlier run, e.g. the overlap after a restart
+        new = self.index.filter_events(new)[0]
+        new.sort(key=event_time)
+        if complete:
+            self.watermark = max(self.watermark, before)
+        horizon = self.watermark - self.overlap
+        self.seen = {key: stamp for key, stamp in self.seen.items() if stamp >= horizon}
+        self.events += len(new)
+        if new:
+            self.pending.extend(new)
+            if self.callback is not None:
+                self.callback(self, new)
+            if self.queue is not None:
+                self.queue.put((self.asset_name, new))
+        if time.monotonic() - self.last_flush >= self.flush_every:
+            self.flush()
+        return new
+
+    def flush(self):
+        '''
+        Append the events polled since the last flush to their day files
+        '''
+        for day, day_events in split_by_day(self.pending).items():
+            with self.metrics.stage('write', day=str(day)):
+                save_event_day(self.save_location, day, day_events, storage=self.storage, merge=True,
+                               index=self.index)
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def stats(self):
+        return {'asset_name': self.asset_name, 'polls': self.polls, 'requests': self.requests,
+                'events': self.events, 'watermark': str(self.watermark)}
+
+
+def run_tail(tails, interval=10, stop=None, max_polls=None):
+    '''
+    Poll every EventTail once per interval seconds until stop (a threading.Event) is set, max_polls rounds are
+    done or the process is interrupted, then flush what is still pending
+    A round that takes longer than interval starts the next one right away
+    '''
+    stop = stop or threading.Event()
+    rounds = 0
+    try:
+        while not stop.is_set() and (max_polls is None or rounds < max_polls):
+            start = time.monotonic()
+            for tail in tails:
+                tail.poll()
+            rounds += 1
+            if max_polls is None or rounds < max_polls:
+                stop.wait(max(0., interval - (time.monotonic() - start)))
+    finally:
+        for tail in tails:
+            tail.flush()
+    return [tail.stats() for tail in tails]
@@ -0,0 +1,108 @@
+# Offline runs of the event downloaders against simulator.start_server: paging, the API's rate limit and
+# injected server errors must neither lose nor duplicate an event
+#   python -m pytest test_download.py
+from datetime import date, datetime
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import async_download
+import download
+from client import CircuitBreaker, RetryPolicy
+from load import query_events
+from simulator import FakeOpenSea, make_events, start_server
+
+START = date(2021, 8, 1)
+END = date(2021, 8, 3)
+
+
+@pytest.fixture
+def events():
+    # one busy day paged over several offsets, a quiet one and an empty one
+    return make_events(datetime(2021, 8, 1), events_per_day=[700, 40, 0], seed=3)
+
+
+@pytest.fixture
+def sales():
+    # download_event_info waits half a second between pages of event_type='all', the sync tests fetch one type
+    return make_events(datetime(2021, 8, 1), events_per_day=[700, 40, 0], event_types=['successful'], seed=3)
+
+
+@contextlib.contextmanager
+def serve(api):
+    server, base_url = start_server(api)
+    try:
+        yield base_url + '/api/v1/events'
+    finally:
+        server.shutdown()
+
+
+def quiet(function, *args, **kwargs):
+    # the downloaders print their progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def fast_retry():
+    return RetryPolicy(max_retries=20, backoff=.01, max_backoff=.05, breaker=CircuitBreaker(threshold=10 ** 6))
+
+
+def stored_ids(save_location):
+    return query_events(save_location, columns=['id'])['id']
+
+
+def assert_complete(save_location, events):
+    ids = stored_ids(save_location)
+    assert len(ids) == len(np.unique(ids)), 'duplicated events'
+    assert set(ids.tolist()) == {event['id'] for event in events}, 'lost events'
+
+
+@pytest.mark.parametrize('storage', ['npz', 'columnar'])
+def test_download_event_info(tmp_path, sales, storage):
+    save_location = str(tmp_path) + '/'
+    with serve(FakeOpenSea(sales)) as url:
+        quiet(download.download_event_info, save_location, start_date=START, end_date=END, event_type='successful',
+              request_buffer=0, storage=storage, url=url, retry=fast_retry())
+    assert_complete(save_location, sales)
+
+
+def test_download_event_info_rate_limit_and_errors(tmp_path, sales):
+    save_location = str(tmp_path) + '/'
+    # every 3rd request is throttled like a burst over the rate limit
+    api = FakeOpenSea(sales, throttle_every=3, error_rate=.2, seed=1)
+    with serve(api) as url:
+        quiet(download.download_event_info, save_location, start_date=START, end_date=END, event_type='successful',
+              hour_chunks=6, request_buffer=0, url=url, retry=fast_retry())
+    assert api.throttled_count and api.error_count
+    assert_complete(save_location, sales)
+
+
+def test_download_event_info_rerun(tmp_path, sales):
+    # a second run over the same days stores nothing twice
+    save_location = str(tmp_path) + '/'
+    with serve(FakeOpenSea(sales)) as url:
+        for resume in [True, False]:
+            quiet(download.download_event_info, save_location, start_date=START, end_date=END,
+                  event_type='successful', request_buffer=0, resume=resume, url=url, retry=fast_retry())
+    assert_complete(save_location, sales)
+
+
+@pytest.mark.parametrize('hour_chunks', [6, 'adaptive'])
+def test_async_download(tmp_path, events, hour_chunks):
+    save_location = str(tmp_path) + '/'
+    with serve(FakeOpenSea(events)) as url:
+        quiet(async_download.download_event_info_concurrent, save_location, start_date=START, end_date=END,
+              hour_chunks=hour_chunks, requests_per_second=200, concurrency=4, url=url, retry=fast_retry())
+    assert_complete(save_location, events)
+
+
+def test_async_download_rate_limit_and_errors(tmp_path, events):
+    save_location = str(tmp_path) + '/'
+    api = FakeOpenSea(events, requests_per_second=20, error_rate=.2, seed=2)
+    with serve(api) as url:
+        quiet(async_download.download_event_info_concurrent, save_location, start_date=START, end_date=END,
+              hour_chunks=6, requests_per_second=60, concurrency=4, max_retries=50, url=url, retry=fast_retry())
+    assert api.throttled_count and api.error_count
+    assert_complete(save_location, events)
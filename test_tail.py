@@ -0,0 +1,103 @@
+# tail.EventTail against simulator.start_server: the overlap re-reads late events, repeats are dropped and every new
+# event reaches the callback once
+#   python -m pytest test_tail.py
+from datetime import datetime, timedelta
+import contextlib
+import io
+import time
+
+import pytest
+
+from load import query_events
+from simulator import FakeOpenSea, LiveFeed, make_events, start_server
+from tail import EventTail
+
+T0 = datetime(2021, 8, 1, 12)
+
+
+@pytest.fixture
+def api():
+    api = FakeOpenSea()
+    server, base_url = start_server(api)
+    api.url = base_url + '/api/v1/events'
+    yield api
+    server.shutdown()
+
+
+def quiet(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def stamped(events, stamp):
+    for event in events:
+        event['created_date'] = stamp.strftime('%Y-%m-%dT%H:%M:%S')
+    return events
+
+
+def make_tail(api, save_location, delivered, watermark=None, **kwargs):
+    tail = EventTail(save_location, '0x0', 'sim', storage='columnar', flush_every=0,
+                     callback=lambda tail, events: delivered.extend(events), url=api.url, **kwargs)
+    if watermark is not None:
+        tail.watermark = watermark
+    return tail
+
+
+def ids(events):
+    return sorted(event['id'] for event in events)
+
+
+def test_tail_overlap_and_repeats(api, tmp_path):
+    save_location = str(tmp_path) + '/'
+    events = make_events(T0, events_per_day=6, seed=1)
+    api.add_events(stamped(events[:3], T0 + timedelta(seconds=10)))
+    delivered = []
+    tail = make_tail(api, save_location, delivered, watermark=T0, overlap=timedelta(minutes=1))
+
+    assert ids(quiet(tail.poll, T0 + timedelta(seconds=30))) == ids(events[:3])
+    assert tail.watermark == T0 + timedelta(seconds=30)
+    # indexed late: older than the watermark but inside the overlap, so the next poll still sees it
+    api.add_events(stamped(events[3:4], T0 + timedelta(seconds=20)))
+    # older than the overlap: out of reach of the tail
+    api.add_events(stamped(events[4:5], T0 - timedelta(minutes=5)))
+    assert ids(quiet(tail.poll, T0 + timedelta(seconds=40))) == ids(events[3:4])
+    # the overlap reads the first four again, none of them is delivered twice
+    api.add_events(stamped(events[5:], T0 + timedelta(seconds=45)))
+    assert ids(quiet(tail.poll, T0 + timedelta(seconds=50))) == ids(events[5:])
+    assert quiet(tail.poll, T0 + timedelta(seconds=60)) == []
+
+    assert ids(delivered) == ids(events[:4] + events[5:])
+    assert sorted(query_events(save_location, columns=['id'])['id'].tolist()) == ids(delivered)
+
+
+def test_tail_restart_drops_stored_events(api, tmp_path):
+    save_location = str(tmp_path) + '/'
+    events = stamped(make_events(T0, events_per_day=4, seed=2), T0 + timedelta(seconds=10))
+    api.add_events(events)
+    delivered = []
+    quiet(make_tail(api, save_location, delivered, watermark=T0).poll, T0 + timedelta(seconds=30))
+    # a new tail starts at the newest stored event and reads the overlap again
+    restarted = make_tail(api, save_location, delivered)
+    assert restarted.watermark == T0 + timedelta(seconds=10)
+    assert quiet(restarted.poll, T0 + timedelta(seconds=40)) == []
+    assert ids(delivered) == ids(events)
+
+
+def test_tail_live_feed(api, tmp_path):
+    save_location = str(tmp_path) + '/'
+    delivered = []
+    tail = make_tail(api, save_location, delivered, overlap=timedelta(seconds=10), lookback=timedelta(minutes=1))
+    feed = LiveFeed(api, events_per_second=100, late=3, tick=.05, seed=3).start()
+    try:
+        for _ in range(6):
+            time.sleep(.3)
+            quiet(tail.poll)
+    finally:
+        feed.stop()
+    # the last poll ends past every published second
+    time.sleep(1.1)
+    quiet(tail.poll)
+    assert feed.published
+    assert ids(delivered) == ids(feed.published)
+    stored = query_events(save_location, columns=['id'])['id'].tolist()
+    assert sorted(stored) == ids(delivered)
@@ -0,0 +1,43 @@
+# windows.AdaptiveWindow against simulator.FakeOpenSea on a dense feed, with a small offset ceiling so the busy days
+# overflow it many times over
+#   python -m pytest test_windows.py
+from datetime import datetime, timedelta
+
+from simulator import FakeOpenSea, drive_window, make_events, summarize, window_report
+from windows import AdaptiveWindow, split_by_day
+
+START = datetime(2021, 8, 1)
+
+
+def test_window_report_dense_feed():
+    report = window_report(events_per_day=(5, 40, 5000, 300, 0, 3, 2400), page_size=100, max_offset=600,
+                           check=False)
+    assert report['hour_chunks=24']['lost'] > 0
+    assert report['adaptive']['lost'] == 0
+    assert report['adaptive']['splits'] > 0
+
+
+def test_adaptive_window_keeps_every_event_once():
+    events = make_events(START, events_per_day=[3000, 0, 20], event_types=['successful'], seed=5)
+    api = FakeOpenSea(events, max_offset=500, max_limit=100)
+    window = AdaptiveWindow(START, START + timedelta(days=3), page_size=100, max_offset=500)
+    fetched = drive_window(api, window, 'successful')
+    assert sorted(event['id'] for event in fetched) == sorted(event['id'] for event in events)
+    assert window.truncated == []
+    assert sum(len(day) for day in split_by_day(fetched).values()) == len(events)
+
+
+def test_adaptive_window_truncates_at_min_window():
+    # more events in one second than the ceiling lets through: the window cannot be split below min_window
+    events = make_events(START, events_per_day=[1000], event_types=['successful'], seed=6)
+    burst = START + timedelta(hours=12)
+    for event in events[:800]:
+        event['created_date'] = burst.strftime('%Y-%m-%dT%H:%M:%S')
+    api = FakeOpenSea(events, max_offset=300, max_limit=100)
+    window = AdaptiveWindow(START, START + timedelta(days=1), page_size=100, max_offset=300)
+    fetched = drive_window(api, window, 'successful')
+    assert window.truncated == [(burst, burst + timedelta(seconds=1))]
+    stats = summarize({event['id'] for event in events}, fetched, window.requests)
+    # only the burst second lost events, the ceiling's worth of it was kept
+    assert stats['lost'] == 800 - 400
+    assert len(fetched) == len({event['id'] for event in fetched})
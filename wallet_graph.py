@@ -0,0 +1,316 @@
+# Wallet graph of the sales of every downloaded collection: wallets are integer encoded once and each sale is an
+# edge seller -> buyer with its collection, token, price and time, stored as CSR arrays sorted by seller (and a
+# permutation sorted by buyer) so a wallet's trades are two slices
+#   graph = wallet_graph({'animeta': 'static/animeta/', 'BAYC': 'static/BAYC/'}, 'static/wallet_graph/')
+#   graph.counterparties('0xabc...', as_frame=True); graph.holdings_history('0xabc...'); graph.wash_candidates()
+# <graph_location>/addresses.npy     every wallet seen, the position is its id (new wallets are appended)
+# <graph_location>/parts/<collection>/<date>.npz   encoded edges of one day file, redone when the file changes
+# <graph_location>/graph.npz         the CSR arrays of all parts, rebuilt from the parts after an update
+from datetime import date
+import json
+import os
+import shutil
+
+import numpy as np
+
+from analytics import day_fingerprint
+from helpers import batch_result
+from load import event_file_days, iter_events
+
+EDGE_COLUMNS = ['src', 'dst', 'price', 'time', 'token_id', 'transaction_hash']
+SALE_COLUMNS = ['timestamp', 'token_id', 'total_price', 'seller_address', 'buyer_address', 'transaction_hash']
+
+
+def collection_locations(root):
+    '''
+    {collection: save_location} of the sub folders of root holding event files (the crawler.py layout)
+    '''
+    locations = {}
+    for name in sorted(os.listdir(root)):
+        location = os.path.join(root, name, '')
+        if os.path.isdir(location) and event_file_days(location):
+            locations[name] = location
+    return locations
+
+
+class AddressBook:
+    '''
+    Wallet address <-> integer id, ids never change once given so encoded parts stay valid
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.addresses = list(np.load(path).tolist()) if os.path.isfile(path) else []
+        self.ids = {address: i for i, address in enumerate(self.addresses)}
+        self.saved = len(self.addresses)
+
+    def encode(self, addresses):
+        ids = self.ids
+        encoded = np.empty(len(addresses), dtype='int32')
+        for i, address in enumerate(addresses):
+            code = ids.get(address)
+            if code is None:
+                code = ids[address] = len(self.addresses)
+                self.addresses.append(address)
+            encoded[i] = code
+        return encoded
+
+    def save(self):
+        if len(self.addresses) != self.saved or not os.path.isfile(self.path):
+            np.save(self.path + '.tmp.npy', np.array(self.addresses, dtype='U42'))
+            os.replace(self.path + '.tmp.npy', self.path)
+            self.saved = len(self.addresses)
+
+
+def encode_day(save_location, day, book):
+    '''
+    Edges (EDGE_COLUMNS) of the sales of one day file, addresses lowercased, sales missing a wallet are skipped
+    '''
+    parts = [columns for _, columns in iter_events(save_location, day, day, event_types=['successful'],
+                                                    columns=SALE_COLUMNS)]
+    if not parts:
+        return None
+    sales = {name: np.concatenate([part[name] for part in parts]) for name in SALE_COLUMNS}
+    keep = (sales['seller_address'] != '') & (sales['buyer_address'] != '') & ~np.isnat(sales['timestamp'])
+    return {'src': book.encode(np.char.lower(sales['seller_address'][keep]).tolist()),
+            'dst': book.encode(np.char.lower(sales['buyer_address'][keep]).tolist()),
+            'price': sales['total_price'][keep] / 10. ** 18,
+            'time': sales['timestamp'][keep].astype('datetime64[s]'),
+            'token_id': np.char.encode(sales['token_id'][keep], 'utf-8'),
+            'transaction_hash': np.char.encode(sales['transaction_hash'][keep], 'utf-8')}
+
+
+def part_path(graph_location, collection, day):
+    return os.path.join(graph_location, 'parts', collection, str(day) + '.npz')
+
+
+class WalletGraph:
+    '''
+    Sales of every collection as edges seller -> buyer, sorted by (seller, time): the sales of wallet w are
+    edges out_ptr[w]:out_ptr[w + 1], its purchases are edges in_order[in_ptr[w]:in_ptr[w + 1]] (in time order)
+    token_order lists the sales of each (collection, token) in time order
+    collection[e] indexes collections, addresses[id] is the wallet of an id
+    '''
+    def __init__(self, arrays, addresses, collections):
+        for name, values in arrays.items():
+            setattr(self, name, values)
+        self.addresses = addresses
+        self.collections = collections
+
+    def __len__(self):
+        return len(self.src)
+
+    def wallet_id(self, address):
+        # -1 for a wallet that never traded
+        address = address.lower()
+        position = np.searchsorted(self.addresses, address, sorter=self.address_order)
+        if position < len(self.addresses) and self.addresses[self.address_order[position]] == address:
+            return int(self.address_order[position])
+        return -1
+
+    def sold(self, wallet):
+        return np.arange(self.out_ptr[wallet], self.out_ptr[wallet + 1])
+
+    def bought(self, wallet):
+        return self.in_order[self.in_ptr[wallet]:self.in_ptr[wallet + 1]]
+
+    def edges(self, rows):
+        '''
+        {column: array} of some edges with wallets and collections decoded
+        '''
+        return {'collection': self.collections[self.collection[rows]],
+                'token_id': np.char.decode(self.token_id[rows], 'utf-8'),
+                'seller': self.addresses[self.src[rows]],
+                'buyer': self.addresses[self.dst[rows]],
+                'price': self.price[rows],
+                'time': self.time[rows],
+                'transaction_hash': np.char.decode(self.transaction_hash[rows], 'utf-8')}
+
+    def counterparties(self, address, as_frame=False):
+        '''
+        Every wallet address traded with: sales to it, purchases from it and the ETH volume each way,
+        sorted by number of trades
+        '''
+        wallet = self.wallet_id(address)
+        if wallet < 0:
+            sold, bought = np.array([], dtype='int64'), np.array([], dtype='int64')
+        else:
+            sold, bought = self.sold(wallet), self.bought(wallet)
+        others = np.concatenate([self.dst[sold], self.src[bought]])
+        wallets, inverse = np.unique(others, return_inverse=True)
+        is_sale = np.arange(len(others)) < len(sold)
+        prices = np.nan_to_num(np.concatenate([self.price[sold], self.price[bought]]).astype('float64'))
+        n = len(wallets)
+        columns = {'counterparty': self.addresses[wallets],
+                   'sold_to': np.bincount(inverse, weights=is_sale, minlength=n).astype('int64'),
+                   'bought_from': np.bincount(inverse, weights=~is_sale, minlength=n).astype('int64'),
+                   'volume_sold': np.bincount(inverse, weights=prices * is_sale, minlength=n).astype('float64'),
+                   'volume_bought': np.bincount(inverse, weights=prices * ~is_sale, minlength=n).astype('float64')}
+        order = np.argsort(-(columns['sold_to'] + columns['bought_from']), kind='stable')
+        return batch_result({name: values[order] for name, values in columns.items()}, as_frame)
+
+    def holdings_history(self, address, as_frame=False):
+        '''
+        Every purchase and sale of address across collections in time order, side is 'buy' or 'sell' (a sale to
+        itself is both) and holding marks the last trade of each token the wallet still held afterwards
+        '''
+        wallet = self.wallet_id(address)
+        if wallet < 0:
+            rows = np.array([], dtype='int64')
+            sides = np.array([], dtype='U4')
+        else:
+            sold, bought = self.sold(wallet), self.bought(wallet)
+            rows = np.concatenate([bought, sold])
+            sides = np.concatenate([np.full(len(bought), 'buy'), np.full(len(sold), 'sell')])
+        order = np.argsort(self.time[rows], kind='stable')
+        rows, sides = rows[order], sides[order]
+        columns = self.edges(rows)
+        columns['side'] = sides
+        # the last trade of each (collection, token) decides whether it is still held
+        key = np.char.add(np.char.add(columns['collection'], '/'), columns['token_id'])
+        last = np.zeros(len(rows), dtype=bool)
+        if len(rows):
+            reverse_unique = np.unique(key[::-1], return_index=True)[1]
+            last[len(rows) - 1 - reverse_unique] = True
+        columns['holding'] = last & (self.dst[rows] == wallet)
+        return batch_result(columns, as_frame)
+
+    def wash_candidates(self, max_days=7, max_hops=3, as_frame=False):
+        '''
+        Tokens that came back to a wallet that sold them within max_days and at most max_hops sales
+        (A -> B -> A, A -> B -> C -> A, ...), the pattern of wash trading
+        One row per cycle: collection, token, the wallets in order, start / end time, hops and the volume traded
+        '''
+        order = self.token_order
+        collection, token = self.collection[order], self.token_id[order]
+        src, dst, time, price = self.src[order], self.dst[order], self.time[order], np.nan_to_num(self.price[order])
+        window = np.timedelta64(int(max_days * 86400), 's')
+        found = []
+        for hops in range(2, max_hops + 1):
+            if len(order) < hops:
+                break
+            start = np.arange(len(order) - hops + 1)
+            end = start + hops - 1
+            cycle = ((collection[start] == collection[end]) & (token[start] == token[end]) &
+                     (dst[end] == src[start]) & (time[end] - time[start] <= window))
+            # the sales in between are the same token passed on, and no shorter cycle inside
+            for k in range(1, hops):
+                cycle &= dst[start + k - 1] == src[start + k]
+                if k < hops - 1:
+                    cycle &= dst[start + k - 1] != src[start]
+            for i in np.flatnonzero(cycle):
+                found.append((i, hops))
+        wallets = [' -> '.join(self.addresses[src[i:i + hops]].tolist() + [self.addresses[src[i]]])
+                   for i, hops in found]
+        first = np.array([i for i, hops in found], dtype='int64')
+        hops = np.array([hops for i, hops in found], dtype='int64')
+        columns = {'collection': self.collections[collection[first]],
+                   'token_id': np.char.decode(token[first], 'utf-8'),
+                   'wallets': np.array(wallets, dtype='U') if wallets else np.array([], dtype='U1'),
+                   'start': time[first],
+                   'end': time[first + hops - 1] if len(first) else time[first],
+                   'hops': hops,
+                   'volume': np.array([price[i:i + h].sum() for i, h in found], dtype='float64')}
+        return batch_result(columns, as_frame)
+
+
+def build_graph(parts, wallets):
+    '''
+    CSR arrays of a list of (collection code, edges) parts over wallets wallet ids
+    '''
+    if parts:
+        edges = {name: np.concatenate([part[name] for code, part in parts]) for name in EDGE_COLUMNS}
+        collection = np.concatenate([np.full(len(part['src']), code, dtype='int16') for code, part in parts])
+    else:
+        edges = {'src': np.array([], dtype='int32'), 'dst': np.array([], dtype='int32'),
+                 'price': np.array([], dtype='float64'), 'time': np.array([], dtype='datetime64[s]'),
+                 'token_id': np.array([], dtype='S1'), 'transaction_hash': np.array([], dtype='S1')}
+        collection = np.array([], dtype='int16')
+    order = np.lexsort((edges['time'], edges['src']))
+    arrays = {name: values[order] for name, values in edges.items()}
+    arrays['collection'] = collection[order]
+    arrays['out_ptr'] = np.concatenate([[0], np.cumsum(np.bincount(arrays['src'], minlength=wallets))])
+    arrays['in_order'] = np.lexsort((arrays['time'], arrays['dst']))
+    arrays['in_ptr'] = np.concatenate([[0], np.cumsum(np.bincount(arrays['dst'], minlength=wallets))])
+    # every token's sales in time order, the ownership chains wash_candidates follows
+    arrays['token_order'] = np.lexsort((arrays['time'], arrays['token_id'], arrays['collection']))
+    return arrays
+
+
+def update_wallet_graph(save_locations, graph_location):
+    '''
+    Encode the day files of every collection ({collection: save_location}) that are new or were saved again
+    since the last update, drop the parts of day files that are gone, and rebuild graph.npz when anything changed
+    Returns True when the graph changed
+    '''
+    os.makedirs(graph_location, exist_ok=True)
+    manifest_path = os.path.join(graph_location, 'days.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    book = AddressBook(os.path.join(graph_location, 'addresses.npy'))
+    changed = not os.path.isfile(os.path.join(graph_location, 'graph.npz'))
+    for collection in list(manifest):
+        if collection not in save_locations:
+            shutil.rmtree(os.path.join(graph_location, 'parts', collection), ignore_errors=True)
+            del manifest[collection]
+            changed = True
+    for collection, save_location in save_locations.items():
+        file_days = event_file_days(save_location)
+        current = {str(day): day_fingerprint(save_location, day, kind) for day, kind in file_days.items()}
+        days = manifest.setdefault(collection, {})
+        for day in [day for day in days if day not in current]:
+            os.remove(part_path(graph_location, collection, day))
+            del days[day]
+            changed = True
+        for day in sorted(current):
+            if days.get(day) == current[day]:
+                continue
+            edges = encode_day(save_location, date.fromisoformat(day), book)
+            path = part_path(graph_location, collection, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.savez(path, **(edges or build_graph([], 0)))
+            days[day] = current[day]
+            changed = True
+    if not changed:
+        return False
+    # addresses first: a part never refers to an id that is not saved
+    book.save()
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    collections = sorted(manifest)
+    parts = []
+    for code, collection in enumerate(collections):
+        for day in sorted(manifest[collection]):
+            with np.load(part_path(graph_location, collection, day), allow_pickle=False) as data:
+                parts.append((code, {name: data[name] for name in EDGE_COLUMNS}))
+    arrays = build_graph(parts, len(book.addresses))
+    arrays['address_order'] = np.argsort(np.array(book.addresses, dtype='U42'))
+    arrays['collections'] = np.array(collections, dtype='U')
+    path = os.path.join(graph_location, 'graph.npz')
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def load_wallet_graph(graph_location):
+    with np.load(os.path.join(graph_location, 'graph.npz'), allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    addresses = np.load(os.path.join(graph_location, 'addresses.npy'))
+    collections = arrays.pop('collections')
+    return WalletGraph(arrays, addresses, collections)
+
+
+def wallet_graph(save_locations, graph_location, update=True):
+    '''
+    WalletGraph of the sales of every collection of save_locations ({collection: save_location}, or a root
+    folder with one sub folder per collection), brought up to date first when update is set
+    '''
+    if isinstance(save_locations, str):
+        save_locations = collection_locations(save_locations)
+    if update:
+        update_wallet_graph(save_locations, graph_location)
+    return load_wallet_graph(graph_location)
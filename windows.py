@@ -0,0 +1,146 @@
+# Adaptive time windows for /events so busy days are not cut off at the offset ceiling
+# and quiet stretches are fetched with as few requests as possible
+from datetime import datetime, timedelta, timezone
+
+from checkpoint import event_key
+
+
+def utc_now():
+    # naive UTC like the created_date of the events, the clock every downloader splits days and windows by
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def event_time(event):
+    '''
+    Time an event occurred, the field occurred_before / occurred_after filter on
+    '''
+    return datetime.fromisoformat(event['created_date'][:19])
+
+
+class AdaptiveWindow:
+    '''
+    Plans the requests for one event type over [after, before), walking from newest to oldest like the API pages
+    Starts with initial_window (default the whole range) and pages through it by offset
+    When a window reaches the max_offset ceiling, the events fetched so far are kept and the older remainder of the
+    window is bisected, so nothing past the ceiling is lost
+    When a window answers in a single short page it was quiet and the next window doubles, up to max_window
+    A second that still overflows (or a window of min_window) is recorded in truncated instead of splitting forever
+    Drive it with next_request() -> (after, before, offset) and feed(asset_events) until done
+    keep_events=False only plans the requests, for callers that stream the pages elsewhere
+    '''
+    def __init__(self, after, before, page_size=300, max_offset=10000, initial_window=None,
+                 min_window=timedelta(seconds=1), max_window=timedelta(days=7), keep_events=True):
+        self.after = after
+        self.keep_events = keep_events
+        self.page_size = page_size
+        self.max_offset = max_offset
+        self.min_window = min_window
+        self.max_window = max_window
+        self.events = []
+        self.requests = 0
+        self.splits = 0
+        self.truncated = []
+        self.start_window(before, initial_window or (before - after))
+
+    def start_window(self, end, window):
+        self.end = end
+        self.window = window
+        self.start = max(self.after, end - window)
+        self.offset = 0
+        self.window_requests = 0
+        self.window_oldest = None
+
+    @property
+    def done(self):
+        return self.end <= self.after
+
+    def next_request(self):
+        return self.start, self.end, self.offset
+
+    def feed(self, asset_events):
+        self.requests += 1
+        self.window_requests += 1
+        if self.keep_events:
+            self.events.extend(asset_events)
+        if asset_events:
+            oldest = min(event_time(event) for event in asset_events)
+            if self.window_oldest is None or oldest < self.window_oldest:
+                self.window_oldest = oldest
+
+        if len(asset_events) == self.page_size:
+            if self.offset + self.page_size <= self.max_offset:
+                self.offset += self.page_size
+                return
+            # ceiling reached: everything newer than window_oldest is in hand, bisect what is left
+            # the boundary second is fetched again and the repeats dropped in result()
+            remainder_end = self.window_oldest + timedelta(seconds=1)
+            if self.end - self.start > self.min_window and remainder_end < self.end:
+                self.splits += 1
+                self.start_window(remainder_end, max(self.min_window, (remainder_end - self.start) / 2))
+                return
+            # every event fetched is in the window's last second: only that second is cut off, not what is older
+            overflow_start = max(self.start, self.window_oldest)
+            print('window ' + str(overflow_start) + ' - ' + str(self.end) + ' still has more than ' +
+                  str(self.max_offset + self.page_size) + ' events, truncated')
+            self.truncated.append((overflow_start, self.end))
+            if overflow_start > self.start:
+                self.splits += 1
+                self.start_window(overflow_start, max(self.min_window, (overflow_start - self.start) / 2))
+                return
+
+        window = self.window
+        if self.window_requests == 1:
+            window = min(self.max_window, window * 2)
+        self.start_window(self.start, window)
+
+    def result(self):
+        '''
+        Fetched events with the repeats from window boundaries removed
+        '''
+        seen = set()
+        events = []
+        for event in self.events:
+            key = event_key(event)
+            if key not in seen:
+                seen.add(key)
+                events.append(event)
+        return events
+
+
+def split_by_day(events):
+    '''
+    Group events into {date: [events]} by the day they occurred
+    '''
+    days = {}
+    for event in events:
+        days.setdefault(event_time(event).date(), []).append(event)
+    return days
+
+
+class FixedWindow:
+    '''
+    Pages a single [after, before) window by offset until a short page or the max_offset ceiling
+    This is the hour_chunks behaviour, with the same interface as AdaptiveWindow
+    '''
+    def __init__(self, after, before, page_size=300, max_offset=10000, offset=0):
+        self.after = after
+        self.before = before
+        self.page_size = page_size
+        self.max_offset = max_offset
+        self.offset = offset
+        self.events = []
+        self.requests = 0
+        self.done = False
+
+    def next_request(self):
+        return self.after, self.before, self.offset
+
+    def feed(self, asset_events):
+        self.requests += 1
+        self.events.extend(asset_events)
+        if len(asset_events) < self.page_size or self.offset + self.page_size > self.max_offset:
+            self.done = True
+        self.offset += self.page_size
+
+    def result(self):
+        return self.events